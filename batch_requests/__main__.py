@@ -0,0 +1,211 @@
+import argparse
+import importlib
+import os
+import sys
+import time
+
+# One entry point for the scripts, run from the root of the repo with
+#   python -m batch_requests <send|status|list|retrieve|recover|split|serve|submit|queue> ...
+# Only argparse is imported up front. openai, yaml, rich, tqdm and the rest of the package are imported by the subcommand that
+# needs them, so status and list only ever read the local job store and return straight away, which keeps cron checks cheap.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_script(name: str):
+    # send_batch_request.py and recover_batch_requests.py live at the root of the repo, next to the package.
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    return importlib.import_module(name)
+
+def format_time(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) if timestamp else "-"
+
+def format_counts(counts: dict) -> str:
+    return ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "no batch files"
+
+def require_config(args) -> None:
+    if not args.config:
+        raise ValueError("--config is required to look anything up on the api.")
+
+def send(args) -> None:
+    if args.pipeline:
+        import_script("send_pipeline").make_and_send_pipeline(args.input_file, args.output_file, args.config, args.data_key, args.pipeline,
+                                                             args.max_in_flight, args.max_enqueued_tokens)
+    else:
+        import_script("send_batch_request").make_and_send_batch_request(args.input_file, args.step, args.response_key, args.output_file, args.config,
+                                                                       args.data_key, args.max_in_flight, args.max_enqueued_tokens, args.pack)
+
+def status(args) -> None:
+    if args.batch_id:
+        # A single batch is looked up on the api, everything else comes from the local store unless --remote is given.
+        require_config(args)
+        from .batch_request_checker import main as check_main
+        check_main(args.config, args.batch_id)
+        return
+
+    from .batch_request_store import DEFAULT_DB, get_store
+    store = get_store(args.db or DEFAULT_DB)
+    job = store.get_job(args.job_id)
+    if job is None:
+        raise ValueError("No job was found.")
+    if args.remote:
+        require_config(args)
+        from .batch_request_viewer import main as viewer_main
+        viewer_main(args.config, job_id=job["job_id"], statuses=args.status, watch_batches=args.watch, interval=args.interval,
+                    db_path=args.db or DEFAULT_DB)
+        return
+    steps = job["step"] or f"pipeline {job['options'].get('pipeline')}"
+    print(f"job {job['job_id']} {job['status']}: {steps} on {job['input_file']}, started {format_time(job['created_at'])}")
+    print(f"  batch files: {format_counts(store.count_batch_files(job['job_id']))}")
+    if args.verbose:
+        for batch in store.get_batch_files(job["job_id"]):
+            print(f"  {batch['status']:>12} {batch['batch_id'] or '-':>40} {batch['tokens'] or '-':>10} {batch['batch_file']}")
+
+def list_jobs(args) -> None:
+    if args.remote:
+        require_config(args)
+        from .batch_request_store import DEFAULT_DB
+        from .batch_request_viewer import main as viewer_main
+        viewer_main(args.config, args.limit or None, statuses=args.status, watch_batches=args.watch, interval=args.interval,
+                    db_path=args.db or DEFAULT_DB)
+        return
+
+    from .batch_request_store import DEFAULT_DB, get_store
+    for job in get_store(args.db or DEFAULT_DB).list_jobs(args.limit):
+        steps = job["step"] or f"pipeline {job['options'].get('pipeline')}"
+        print(f"{job['job_id']:>6} {job['status']:>10} {format_time(job['created_at'])} {steps} on {job['input_file']}: {format_counts(job['batch_counts'])}")
+
+def retrieve(args) -> None:
+    from .batch_request_retriever import main as retrieve_main
+    retrieve_main(args.config, args.file_id, args.input_file, args.output_file, args.response_key, args.data_key)
+
+def recover(args) -> None:
+    from .batch_request_store import DEFAULT_DB
+    import_script("recover_batch_requests").recover_job(args.job_id, args.db or DEFAULT_DB)
+
+def split(args) -> None:
+    from .batch_request_splitter import pack_jsonl_file, split_jsonl_file
+    if args.pack:
+        limits = {"max_bytes": args.max_bytes, "max_requests": args.max_requests, "max_tokens": args.max_tokens}
+        pack_jsonl_file(args.input_file, args.step, **{name: limit for name, limit in limits.items() if limit is not None})
+    else:
+        split_jsonl_file(args.input_file, args.step)
+
+def serve(args) -> None:
+    import_script("serve_batch_requests").main(args.config, args.until_done)
+
+def submit(args) -> None:
+    server = import_script("serve_batch_requests")
+    request = server.make_job_request(args.input_file, args.config, args.step, args.pipeline, args.output_file, args.response_key, args.data_key,
+                                      args.max_in_flight, args.max_enqueued_tokens, args.pack)
+    print(f"submitted job {server.submit_job(request, args.socket, args.queue)}")
+
+def queue(args) -> None:
+    # Read straight from the queue file, so it works whether or not the server is running.
+    server = import_script("serve_batch_requests")
+    for job in server.JobQueue(args.queue).list(limit=args.limit):
+        request = job["request"]
+        steps = request["step"] or f"pipeline {request['pipeline']}"
+        stored = f", job {job['job_id']}" if job["job_id"] else ""
+        print(f"{job['queue_id']:>6} {job['status']:>10} {format_time(job['submitted_at'])} {steps} on {request['input_file']}{stored}")
+        if job["error"]:
+            print(f"         {job['error']}")
+
+def add_viewer_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--status", "-s", type=str, nargs="+", required=False, help="With --remote, only show batches in these statuses")
+    parser.add_argument("--watch", "-w", action="store_true", help="With --remote, keep refreshing the running batches until they are all done")
+    parser.add_argument("--interval", type=float, default=30, help="With --watch, shortest time in seconds between checks on a running batch")
+
+def make_parser() -> argparse.ArgumentParser:
+    # Defaults that live in other modules are filled in by the subcommands, so that building the parser imports nothing.
+    parser = argparse.ArgumentParser(prog="python -m batch_requests", description="Make, send, watch and recover batch requests")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_send = subparsers.add_parser("send", help="Make the requests for a step, or a pipeline of steps, and send them")
+    parser_send.add_argument("--input_file", "-i", type=str, required=True, help="Path to the input file")
+    parser_send.add_argument("--output_file", "-o", type=str, required=False, help="Path to the output file")
+    parser_send.add_argument("--config", "-c", type=str, required=True, help="Path to the config file")
+    step = parser_send.add_mutually_exclusive_group(required=True)
+    step.add_argument("--step", "-s", type=str, help="Step to perform")
+    step.add_argument("--pipeline", type=str, help="Key of the step graph in the config to run instead of a single step")
+    parser_send.add_argument("--response_key", "-r", type=str, required=False, help="Response key to use")
+    parser_send.add_argument("--data_key", "-d", type=str, default="image_path", help="The key used to identify each data point")
+    parser_send.add_argument("--max_in_flight", "-n", type=int, required=False, help="Maximum number of batches to have running at once")
+    parser_send.add_argument("--max_enqueued_tokens", "-t", type=int, required=False, help="Maximum number of estimated tokens to have enqueued at once")
+    parser_send.add_argument("--pack", "-p", action="store_true", help="Fill each batch file up to the size, request and token limits")
+    parser_send.set_defaults(handler=send)
+
+    parser_status = subparsers.add_parser("status", help="Show the state of a job from the local store, or of a single batch from the api")
+    parser_status.add_argument("--job_id", "-j", type=int, required=False, help="Job to show, defaults to the most recent job")
+    parser_status.add_argument("--batch_id", "-b", type=str, required=False, help="Look up this batch on the api instead, needs --config")
+    parser_status.add_argument("--config", "-c", type=str, required=False, help="Path to the config file with the api key")
+    parser_status.add_argument("--verbose", "-v", action="store_true", help="Also list every batch file of the job")
+    parser_status.add_argument("--remote", action="store_true", help="Show the progress of the batches of the job on the api, needs --config")
+    add_viewer_arguments(parser_status)
+    parser_status.add_argument("--db", type=str, required=False, help="Path to the job store, defaults to batch_state.db")
+    parser_status.set_defaults(handler=status)
+
+    parser_list = subparsers.add_parser("list", help="List the most recent jobs from the local store, or the most recent batches from the api")
+    parser_list.add_argument("--limit", "-n", type=int, default=10, help="Number of jobs or batches to list, 0 for every batch on the api")
+    parser_list.add_argument("--remote", action="store_true", help="List the batches on the api instead, needs --config")
+    parser_list.add_argument("--config", "-c", type=str, required=False, help="Path to the config file with the api key")
+    add_viewer_arguments(parser_list)
+    parser_list.add_argument("--db", type=str, required=False, help="Path to the job store, defaults to batch_state.db")
+    parser_list.set_defaults(handler=list_jobs)
+
+    parser_retrieve = subparsers.add_parser("retrieve", help="Retrieve the output file of a batch and write it into a dataset")
+    parser_retrieve.add_argument("--config", "-c", type=str, required=True, help="Path to the config file")
+    parser_retrieve.add_argument("--file_id", "-f", type=str, required=True, help="ID of the file to retrieve")
+    parser_retrieve.add_argument("--input_file", "-i", type=str, required=False, help="Path to the dataset to write the responses into")
+    parser_retrieve.add_argument("--output_file", "-o", type=str, required=False, help="Path to save the output file")
+    parser_retrieve.add_argument("--response_key", "-r", type=str, required=True, help="Key to store the response in the input data")
+    parser_retrieve.add_argument("--data_key", "-d", type=str, default="image_path", help="The key used to identify each data point")
+    parser_retrieve.set_defaults(handler=retrieve)
+
+    parser_recover = subparsers.add_parser("recover", help="Recover a crashed job")
+    parser_recover.add_argument("--job_id", "-j", type=int, required=False, help="Job to recover, defaults to the most recent job")
+    parser_recover.add_argument("--db", type=str, required=False, help="Path to the job store, defaults to batch_state.db")
+    parser_recover.set_defaults(handler=recover)
+
+    parser_split = subparsers.add_parser("split", help="Split or pack a jsonl file of requests into batch files")
+    parser_split.add_argument("--input_file", "-i", type=str, required=True, help="Path to the input jsonl file")
+    parser_split.add_argument("--step", "-s", type=str, required=True, help="Step name for the batch files")
+    parser_split.add_argument("--pack", "-p", action="store_true", help="Fill each batch file up to the limits instead of splitting every 1000 lines")
+    parser_split.add_argument("--max_bytes", type=int, required=False, help="Maximum size of each batch file in bytes when packing")
+    parser_split.add_argument("--max_requests", type=int, required=False, help="Maximum number of requests in each batch file when packing")
+    parser_split.add_argument("--max_tokens", type=int, required=False, help="Maximum estimated tokens in each batch file when packing")
+    parser_split.set_defaults(handler=split)
+
+    parser_serve = subparsers.add_parser("serve", help="Run the jobs in the local queue under the shared limits of the config")
+    parser_serve.add_argument("--config", "-c", type=str, required=True, help="Path to the config file with the api keys, limits and server settings")
+    parser_serve.add_argument("--until_done", action="store_true", help="Stop once every queued job is done instead of waiting for more")
+    parser_serve.set_defaults(handler=serve)
+
+    parser_submit = subparsers.add_parser("submit", help="Add a job to the queue of the job server")
+    parser_submit.add_argument("--input_file", "-i", type=str, required=True, help="Path to the input file")
+    parser_submit.add_argument("--output_file", "-o", type=str, required=False, help="Path to the output file")
+    parser_submit.add_argument("--config", "-c", type=str, required=True, help="Path to the config file of the job")
+    step = parser_submit.add_mutually_exclusive_group(required=True)
+    step.add_argument("--step", "-s", type=str, help="Step to perform")
+    step.add_argument("--pipeline", type=str, help="Key of the step graph in the config to run instead of a single step")
+    parser_submit.add_argument("--response_key", "-r", type=str, required=False, help="Response key to use")
+    parser_submit.add_argument("--data_key", "-d", type=str, default="image_path", help="The key used to identify each data point")
+    parser_submit.add_argument("--max_in_flight", "-n", type=int, required=False, help="Maximum number of batches the job can have running at once")
+    parser_submit.add_argument("--max_enqueued_tokens", "-t", type=int, required=False, help="Maximum number of estimated tokens the job can have enqueued at once")
+    parser_submit.add_argument("--pack", "-p", action="store_true", help="Fill each batch file up to the size, request and token limits")
+    parser_submit.add_argument("--socket", type=str, default="batch_server.sock", help="Socket the job server listens on")
+    parser_submit.add_argument("--queue", type=str, default="job_queue.db", help="Queue file the job is added to when the server is not running")
+    parser_submit.set_defaults(handler=submit)
+
+    parser_queue = subparsers.add_parser("queue", help="List the jobs in the queue of the job server")
+    parser_queue.add_argument("--limit", "-n", type=int, default=20, help="Number of jobs to list, 0 for every job")
+    parser_queue.add_argument("--queue", type=str, default="job_queue.db", help="Path to the queue file")
+    parser_queue.set_defaults(handler=queue)
+    return parser
+
+def main(argv: list=None) -> None:
+    args = make_parser().parse_args(argv)
+    args.handler(args)
+
+if __name__ == "__main__":
+    main()
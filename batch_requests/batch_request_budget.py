@@ -0,0 +1,74 @@
+from typing import Dict, List, Union
+
+from .batch_request_estimator import describe_token_estimates
+
+# Checked before anything is uploaded, so a step that would cost more than expected is stopped while it is still free to stop.
+# Every limit can be set for all steps at the top of the config, or overridden under a single step, like the packing limits.
+
+def get_budget(config_data: dict, step: str) -> dict:
+    step_config = config_data.get(step, {})
+    def get(key: str, default=None):
+        return step_config.get(key, config_data.get(key, default))
+    return {
+        "max_step_tokens": get("max_step_tokens"),
+        "max_step_cost": get("max_step_cost"),
+        "token_prices": get("token_prices") or {}, # USD per million input, cached_input and output tokens
+        "expected_output_tokens": get("expected_output_tokens", 0), # per request, only used for the cost
+    }
+
+def get_batch_token_cap(config_data: dict, step: str, max_enqueued_tokens: int=None, api_keys: Union[str, List[Dict]]=None) -> int:
+    # The most estimated tokens a single batch file can have. A batch over the enqueued token limit of the key it is sent with
+    # fails validation every time, so the smallest limit of any key caps the batch files as well as max_batch_tokens.
+    step_config = config_data.get(step, {})
+    caps = [step_config.get("max_batch_tokens", config_data.get("max_batch_tokens")), max_enqueued_tokens]
+    if isinstance(api_keys, list):
+        caps.extend(entry.get("max_enqueued_tokens") for entry in api_keys)
+    caps = [cap for cap in caps if cap]
+    return min(caps) if caps else None
+
+def estimate_cost(tokens: int, cached_tokens: int, output_tokens: int, prices: dict) -> float:
+    # Returns None when no prices are set.
+    if not prices:
+        return None
+    input_price = prices.get("input", 0)
+    cached_price = prices.get("cached_input", input_price)
+    return ((tokens - cached_tokens) * input_price + cached_tokens * cached_price + output_tokens * prices.get("output", 0)) / 1000000
+
+def make_budget_report(step: str, stats: List[dict], budget: dict) -> dict:
+    requests = sum(stat["requests"] for stat in stats)
+    tokens = sum(stat["tokens"] for stat in stats)
+    cached_tokens = sum(stat.get("cached_tokens", 0) for stat in stats)
+    output_tokens = requests * (budget["expected_output_tokens"] or 0)
+    return {
+        "step": step,
+        "batches": len(stats),
+        "requests": requests,
+        "tokens": tokens,
+        "cached_tokens": cached_tokens,
+        "output_tokens": output_tokens,
+        "largest_batch_tokens": max((stat["tokens"] for stat in stats), default=0),
+        "cost": estimate_cost(tokens, cached_tokens, output_tokens, budget["token_prices"]),
+        "estimated_with": describe_token_estimates(),
+    }
+
+def print_budget_report(report: dict, budget: dict) -> None:
+    print(f"budget for {report['step']}: {report['requests']} requests in {report['batches']} batch files")
+    print(f"  input tokens: ~{report['tokens']} (~{report['cached_tokens']} from the prompt cache), largest batch ~{report['largest_batch_tokens']}"
+          + (f", limit {budget['max_step_tokens']}" if budget["max_step_tokens"] else ""))
+    print(f"  tokens estimated with {report['estimated_with']}")
+    if report["output_tokens"]:
+        print(f"  output tokens: ~{report['output_tokens']}")
+    if report["cost"] is not None:
+        print(f"  cost: ~${report['cost']:.2f}" + (f", limit ${budget['max_step_cost']:.2f}" if budget["max_step_cost"] else ""))
+
+def check_budget(report: dict, budget: dict) -> None:
+    problems = []
+    if budget["max_step_tokens"] and report["tokens"] > budget["max_step_tokens"]:
+        problems.append(f"~{report['tokens']} input tokens is over max_step_tokens of {budget['max_step_tokens']}")
+    if budget["max_step_cost"] is not None:
+        if report["cost"] is None:
+            problems.append("max_step_cost is set but there are no token_prices to estimate the cost with")
+        elif report["cost"] > budget["max_step_cost"]:
+            problems.append(f"~${report['cost']:.2f} is over max_step_cost of ${budget['max_step_cost']:.2f}")
+    if problems:
+        raise ValueError(f"Step {report['step']} was not sent: {', '.join(problems)}")
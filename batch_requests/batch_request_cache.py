@@ -0,0 +1,176 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+DEFAULT_CACHE = "response_cache.db"
+LOOKUP_CHUNK = 500 # Keeps each lookup under sqlite's limit on the number of query parameters.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_by_access ON responses (accessed_at);
+
+CREATE TABLE IF NOT EXISTS cache_stats (
+    step TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+"""
+
+def request_cache_key(body: dict) -> str:
+    # The body holds the model, the prompts and the image url, so two requests with the same body get the same response.
+    return hashlib.sha256(json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+# Local cache of responses keyed by a hash of the request body, so that re-running a step, or running it on data that overlaps
+# an earlier run, only sends the requests that have not been answered before.
+# Entries older than ttl are treated as misses, and the least recently used entries are evicted past max_entries.
+class ResponseCache:
+    def __init__(self, db_path: str=DEFAULT_CACHE, max_entries: int=1000000, ttl: float=None):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        self.stats: Dict[str, Dict[str, int]] = {}
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        now = time.time()
+        oldest = now - self.ttl if self.ttl else 0
+        found = {}
+        with self.connection() as conn:
+            for i in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[i:i + LOOKUP_CHUNK]
+                placeholders = ', '.join('?' for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT key, content FROM responses WHERE key IN ({placeholders}) AND created_at >= ?",
+                    (*chunk, oldest)
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    conn.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?", [(now, key) for key, _ in rows])
+        return found
+
+    def put_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        now = time.time()
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO responses (key, content, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, content, now, now) for key, content in items]
+            )
+        self.evict()
+
+    def evict(self) -> None:
+        with self.connection() as conn:
+            if self.ttl:
+                conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            excess = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                    (excess,)
+                )
+
+    def record(self, step: str, hits: int, misses: int) -> None:
+        step_stats = self.stats.setdefault(step, {"hits": 0, "misses": 0})
+        step_stats["hits"] += hits
+        step_stats["misses"] += misses
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO cache_stats (step, hits, misses, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (step) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses, updated_at = excluded.updated_at",
+                (step, hits, misses, time.time())
+            )
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        rows = self.connection().execute("SELECT step, hits, misses FROM cache_stats ORDER BY step").fetchall()
+        return {step: {"hits": hits, "misses": misses} for step, hits, misses in rows}
+
+def filter_cached_requests(requests: List[Dict[str, Any]], cache: ResponseCache, step: str, cached_outputs: Dict[str, str]) -> List[Dict[str, Any]]:
+    # Fills cached_outputs with the cached response of every hit, and returns the requests that still have to be sent.
+    keys = [request_cache_key(request["body"]) for request in requests]
+    found = cache.get_many(list(set(keys)))
+
+    misses = []
+    for request, key in zip(requests, keys):
+        if key in found:
+            cached_outputs[request["custom_id"]] = found[key]
+        else:
+            misses.append(request)
+
+    hits = len(requests) - len(misses)
+    cache.record(step, hits, len(misses))
+    print(f"response cache for {step}: {hits} hits, {len(misses)} misses")
+    return misses
+
+def filter_cached_lines(lines: Iterable[Tuple[str, int]], cache: ResponseCache, step: str, cached_outputs: Dict[str, str],
+                        chunk_size: int=LOOKUP_CHUNK * 20) -> Iterator[Tuple[str, int]]:
+    # Same as filter_cached_requests for (serialized request, estimated tokens) pairs, looked up a chunk at a time
+    # so that the requests never have to be held all at once.
+    hits = 0
+    misses = 0
+    lines = iter(lines)
+    while True:
+        chunk = [pair for _, pair in zip(range(chunk_size), lines)]
+        if not chunk:
+            break
+        requests = [json.loads(line) for line, _ in chunk]
+        keys = [request_cache_key(request["body"]) for request in requests]
+        found = cache.get_many(list(set(keys)))
+        for pair, request, key in zip(chunk, requests, keys):
+            if key in found:
+                cached_outputs[request["custom_id"]] = found[key]
+                hits += 1
+            else:
+                misses += 1
+                yield pair
+
+    cache.record(step, hits, misses)
+    print(f"response cache for {step}: {hits} hits, {misses} misses")
+
+def cache_batch_responses(cache: ResponseCache, batch_file: str, messages: Iterable[tuple]) -> Iterator[tuple]:
+    # Passes the (custom_id, message, ...) tuples of a batch through unchanged, and caches the messages against the request bodies in the batch file.
+    keys = {}
+    with open(batch_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                keys[request["custom_id"]] = request_cache_key(request["body"])
+
+    responses = []
+    for item in messages:
+        custom_id, message = item[0], item[1]
+        if custom_id in keys:
+            responses.append((keys[custom_id], message))
+        yield item
+    cache.put_many(responses)
+
+def get_response_cache(config_data: dict) -> ResponseCache:
+    cache_config = config_data.get("response_cache")
+    if not cache_config:
+        return None
+    if cache_config is True:
+        cache_config = {}
+    ttl_days = cache_config.get("ttl_days")
+    return ResponseCache(
+        db_path=cache_config.get("path", DEFAULT_CACHE),
+        max_entries=cache_config.get("max_entries", 1000000),
+        ttl=ttl_days * 24 * 60 * 60 if ttl_days else None
+    )
@@ -1,19 +1,18 @@
-from openai import OpenAI
-import yaml
+from .batch_request_client import get_client
+from .batch_request_config import load_config
 import json
-from rich import print_json
 
 def check_request(api_key: str, batch_id: str=None):
 
-    client = OpenAI(api_key=api_key)
+    client = get_client(api_key)
 
     batch = client.batches.retrieve(batch_id)
     
     return batch
 
 def main(config: str, batch_id: str):
-    with open(config, 'r') as file:
-        config_data = yaml.safe_load(file)
+    from rich import print_json
+    config_data = load_config(config)
     
     api_key = config_data.get('api_key')
     if not api_key:
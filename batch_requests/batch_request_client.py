@@ -0,0 +1,17 @@
+import threading
+from typing import TYPE_CHECKING, Dict
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+_clients: Dict[str, "OpenAI"] = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key: str) -> "OpenAI":
+    # One client per api key for the whole process, so every call reuses the same pooled http connections.
+    # openai takes over a second to import, so it is only imported once a client is needed.
+    from openai import OpenAI
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = OpenAI(api_key=api_key)
+        return _clients[api_key]
@@ -0,0 +1,20 @@
+import os
+import threading
+from typing import Dict, Tuple
+
+_configs: Dict[str, Tuple[int, dict]] = {}
+_configs_lock = threading.Lock()
+
+def load_config(config_path: str) -> dict:
+    # Each config is parsed once per process and parsed again only when the file changes, so the scripts and the cli can all
+    # load the config they are given without paying for it more than once. yaml is only imported the first time.
+    path = os.path.abspath(config_path)
+    mtime = os.stat(path).st_mtime_ns
+    with _configs_lock:
+        cached = _configs.get(path)
+        if cached is None or cached[0] != mtime:
+            import yaml
+            with open(path, 'r') as file:
+                cached = (mtime, yaml.safe_load(file))
+            _configs[path] = cached
+        return cached[1]
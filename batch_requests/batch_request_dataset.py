@@ -0,0 +1,255 @@
+import argparse
+import atexit
+import json
+import mmap
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Union
+
+INDEX_CHUNK = 10000 # Rows written to the index in one transaction.
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS records (
+    position INTEGER PRIMARY KEY,
+    key TEXT,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_by_key ON records (key);
+"""
+
+OVERLAY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS overlay (
+    position INTEGER PRIMARY KEY,
+    record TEXT NOT NULL
+);
+"""
+
+# A dataset kept as a jsonl file with one record per line, read through a memory map instead of being loaded as a whole.
+# An index of the byte offset of every line under its data_key is kept in a SQLite file next to the dataset, and is rebuilt
+# whenever the dataset changes. Records that are updated are written to an overlay database instead of the dataset,
+# and the dataset is only written out again with the updates applied in write.
+#
+# get returns the records under a key the same way as the index from build_index, and remembers them so that the changes made
+# to them are saved to the overlay by flush. Iterating over the dataset streams every record with its updates applied.
+class JsonlDataset:
+    def __init__(self, path: str, data_key: str, index_path: str=None):
+        self.path = path
+        self.data_key = data_key
+        self.index_path = index_path or f"{path}.index.db"
+        self.overlay_path = None
+        self.local = threading.local()
+        self.touched: Dict[int, Dict[str, Any]] = {} # position -> record handed out by get since the last flush
+        self.lock = threading.Lock()
+
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.build_index()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def overlay(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "overlay", None)
+        if conn is None or getattr(self.local, "overlay_path", None) != self.overlay_path:
+            conn = sqlite3.connect(self.overlay_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF") # The overlay is rebuilt from the partial results after a crash, so it never has to survive one.
+            self.local.overlay = conn
+            self.local.overlay_path = self.overlay_path
+        return conn
+
+    def build_index(self) -> None:
+        stat = os.stat(self.path)
+        signature = f"{stat.st_size}:{stat.st_mtime_ns}:{self.data_key}"
+        with self.connection() as conn:
+            conn.executescript(INDEX_SCHEMA)
+            row = conn.execute("SELECT value FROM meta WHERE name = 'signature'").fetchone()
+            if row and row[0] == signature:
+                return
+            conn.execute("DELETE FROM records")
+
+        print(f"indexing {self.path}")
+        rows = []
+        position = 0
+        offset = 0
+        end = len(self.data)
+        while offset < end:
+            newline = self.data.find(b"\n", offset)
+            if newline == -1:
+                newline = end
+            line = self.data[offset:newline]
+            if line.strip():
+                key = json.loads(line).get(self.data_key)
+                rows.append((position, key if key is None else str(key), offset, newline - offset))
+                position += 1
+                if len(rows) >= INDEX_CHUNK:
+                    self.insert_index(rows)
+                    rows = []
+            offset = newline + 1
+        self.insert_index(rows)
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('signature', ?)", (signature,))
+
+    def insert_index(self, rows: List[tuple]) -> None:
+        with self.connection() as conn:
+            conn.executemany("INSERT INTO records (position, key, offset, length) VALUES (?, ?, ?, ?)", rows)
+
+    def open_overlay(self, overlay_path: str) -> None:
+        # Starts from an empty overlay the first time it is opened in a process, since any updates in it from an earlier run are
+        # either replayed from the partial results or were never committed.
+        if self.overlay_path == overlay_path:
+            return
+        self.close_overlay()
+        self.overlay_path = overlay_path
+        with self.overlay() as conn:
+            conn.executescript(OVERLAY_SCHEMA)
+            conn.execute("DELETE FROM overlay")
+        # Kept for as long as the dataset is in use, so that results merged by separate mergers build on each other like they do on a list.
+        atexit.register(self.close_overlay)
+
+    def close_overlay(self) -> None:
+        if self.overlay_path is None:
+            return
+        conn = getattr(self.local, "overlay", None)
+        if conn is not None:
+            conn.close()
+            self.local.overlay = None
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.overlay_path + suffix):
+                os.remove(self.overlay_path + suffix)
+        self.overlay_path = None
+
+    def __len__(self) -> int:
+        return self.connection().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def keys(self) -> Iterator[str]:
+        # Each key once, in the order it first appears in the dataset.
+        for (key,) in self.connection().execute("SELECT key FROM records GROUP BY key ORDER BY MIN(position)"):
+            yield key
+
+    def read(self, offset: int, length: int) -> Dict[str, Any]:
+        return json.loads(self.data[offset:offset + length])
+
+    def get(self, key: str, default: Any=None) -> Union[List[Dict[str, Any]], Any]:
+        rows = self.connection().execute("SELECT position, offset, length FROM records WHERE key = ? ORDER BY position", (str(key),)).fetchall()
+        if not rows:
+            return default
+
+        records = []
+        with self.lock:
+            for position, offset, length in rows:
+                if position not in self.touched:
+                    updated = None
+                    if self.overlay_path:
+                        updated = self.overlay().execute("SELECT record FROM overlay WHERE position = ?", (position,)).fetchone()
+                    self.touched[position] = json.loads(updated[0]) if updated else self.read(offset, length)
+                records.append(self.touched[position])
+        return records
+
+    def flush(self) -> None:
+        # Saves the records handed out by get, along with any changes made to them, to the overlay.
+        with self.lock:
+            if self.touched and self.overlay_path:
+                with self.overlay() as conn:
+                    conn.executemany("INSERT OR REPLACE INTO overlay (position, record) VALUES (?, ?)",
+                                     [(position, json.dumps(record)) for position, record in self.touched.items()])
+            self.touched = {}
+
+    def iter_rows(self) -> Iterator[tuple]:
+        # Yields (position, raw line, updated record or None) in order, walking the overlay alongside the index.
+        self.flush()
+        updates = iter(self.overlay().execute("SELECT position, record FROM overlay ORDER BY position")) if self.overlay_path else iter([])
+        update = next(updates, None)
+        for position, offset, length in self.connection().execute("SELECT position, offset, length FROM records ORDER BY position"):
+            while update is not None and update[0] < position:
+                update = next(updates, None)
+            if update is not None and update[0] == position:
+                yield position, None, update[1]
+            else:
+                yield position, self.data[offset:offset + length], None
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for _, line, updated in self.iter_rows():
+            yield json.loads(updated if updated is not None else line)
+
+    def write(self, output_file: str, as_json: bool=False) -> None:
+        # Writes every record with its updates applied, as jsonl, or as the indented json list the other scripts write.
+        with open(output_file, 'wb') as f:
+            if as_json:
+                write_json_list(f, iter(self))
+            else:
+                for _, line, updated in self.iter_rows():
+                    # Lines that were never updated are copied as they are.
+                    f.write(updated.encode('utf-8') if updated is not None else line)
+                    f.write(b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self) -> None:
+        self.flush()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+def write_json_list(f, records: Iterator[Dict[str, Any]]) -> None:
+    # Same output as json.dump(records, f, indent=4), written one record at a time.
+    first = True
+    for record in records:
+        f.write(b"[\n" if first else b",\n")
+        f.write(b"\n".join(b"    " + line for line in json.dumps(record, indent=4).encode('utf-8').split(b"\n")))
+        first = False
+    f.write(b"[]" if first else b"\n]")
+
+def load_dataset(input_file: str, data_key: str="image_path") -> Union[list, JsonlDataset]:
+    # jsonl datasets are read lazily, anything else is loaded as a json list like before.
+    if input_file.endswith(".jsonl"):
+        return JsonlDataset(input_file, data_key)
+    with open(input_file, 'r') as f:
+        return json.load(f)
+
+def json_to_jsonl(input_file: str, output_file: str) -> int:
+    with open(input_file, 'r') as f:
+        records = json.load(f)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    return len(records)
+
+def jsonl_to_json(input_file: str, output_file: str) -> int:
+    count = 0
+    def records():
+        nonlocal count
+        with open(input_file, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    count += 1
+                    yield json.loads(line)
+    with open(output_file, 'wb') as f:
+        write_json_list(f, records())
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a dataset between a json list and jsonl")
+    parser.add_argument("--input_file", "-i", type=str, required=True, help="Dataset to convert, a .json list or a .jsonl file")
+    parser.add_argument("--output_file", "-o", type=str, required=True, help="Converted dataset, jsonl if it ends with .jsonl and a json list otherwise")
+    args = parser.parse_args()
+
+    if args.output_file.endswith(".jsonl"):
+        count = json_to_jsonl(args.input_file, args.output_file)
+    else:
+        count = jsonl_to_json(args.input_file, args.output_file)
+    print(f"converted {count} records from {args.input_file} to {args.output_file}")
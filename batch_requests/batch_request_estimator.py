@@ -0,0 +1,228 @@
+import base64
+import hashlib
+import json
+import math
+import os
+import tempfile
+from functools import lru_cache
+from typing import List, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Rough heuristics used to keep the enqueued token count of in-flight batches under the org limit.
+# These deliberately over-estimate slightly so that batches are not rejected for exceeding the limit.
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+IMAGE_TOKENS = 765 # Cost of a 1024x1024 image at high detail, which is the default when no detail is given.
+
+# Tile model for image inputs at high detail. The image is scaled to fit in 2048x2048, then down to 768 on its shortest side,
+# and costs a base amount plus an amount for every 512x512 tile it covers. Low detail images only cost the base amount.
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+
+DEFAULT_ENCODING = "o200k_base" # Used for models that tiktoken does not know yet.
+TOKEN_CACHE_SIZE = 100000 # Texts whose token count is kept, so repeated field values are only counted once.
+
+# The arguments tiktoken_ext.openai_public builds each encoding with, and the sha256 of its .tiktoken file. The encodings are made
+# from a local file here instead of through tiktoken.get_encoding, which downloads the file when its cache does not have it.
+R50K_PATTERN = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}++| ?\p{N}++| ?[^\s\p{L}\p{N}]++|\s++$|\s+(?!\S)|\s"""
+CL100K_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+O200K_PATTERN = "|".join([
+    r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+    r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+    r"""\p{N}{1,3}""",
+    r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+    r"""\s*[\r\n]+""",
+    r"""\s+(?!\S)""",
+    r"""\s+""",
+])
+ENCODINGS = {
+    "r50k_base": (R50K_PATTERN, {"<|endoftext|>": 50256}, "306cd27f03c1a714eca7108e03d66b7dc042abe8c258b44c199a7ed9838dd930"),
+    "p50k_base": (R50K_PATTERN, {"<|endoftext|>": 50256}, "94b5ca7dff4d00767bc256fdd1b27e5b17361d7b8a5f968547f9f23eb70d2069"),
+    "cl100k_base": (CL100K_PATTERN, {"<|endoftext|>": 100257, "<|fim_prefix|>": 100258, "<|fim_middle|>": 100259, "<|fim_suffix|>": 100260,
+                                     "<|endofprompt|>": 100276}, "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7"),
+    "o200k_base": (O200K_PATTERN, {"<|endoftext|>": 199999, "<|endofprompt|>": 200018}, "446a9538cb6c348e3516120d7c08b09f57c36495e2acfffe59a5bf8b0cfb1a2d"),
+}
+
+_tokenizers = {}
+_fallbacks = {} # model -> why its tokens are estimated from the length of the text
+_tokenizer_dir = None
+
+def set_tokenizer_dir(path: str) -> None:
+    # tokenizer_dir in the config, a directory with the encodings as <name>.tiktoken files.
+    global _tokenizer_dir
+    if path != _tokenizer_dir:
+        _tokenizer_dir = path
+        _tokenizers.clear()
+        _fallbacks.clear()
+        count_text_tokens.cache_clear()
+
+def get_tokenizer_dirs() -> List[str]:
+    # tokenizer_dir, then the directories tiktoken keeps its cache in.
+    dirs = [_tokenizer_dir] if _tokenizer_dir else []
+    dirs.extend(os.environ[name] for name in ("TIKTOKEN_CACHE_DIR", "DATA_GYM_CACHE_DIR") if os.environ.get(name))
+    return dirs + [os.path.join(tempfile.gettempdir(), "data-gym-cache")]
+
+def get_encoding_name(model: str=None) -> str:
+    if not model:
+        return DEFAULT_ENCODING
+    from tiktoken.model import encoding_name_for_model
+    try:
+        return encoding_name_for_model(model)
+    except KeyError:
+        return DEFAULT_ENCODING
+
+def find_encoding(name: str) -> str:
+    # The first <name>.tiktoken file, as downloaded from https://openaipublic.blob.core.windows.net/encodings/, or None.
+    for directory in get_tokenizer_dirs():
+        path = os.path.join(directory, f"{name}.tiktoken")
+        if os.path.exists(path):
+            return path
+    return None
+
+def load_encoding(name: str, path: str):
+    # Each line of the file is a token in base64 and its rank.
+    pattern, special_tokens, expected_hash = ENCODINGS[name]
+    with open(path, "rb") as f:
+        contents = f.read()
+    if hashlib.sha256(contents).hexdigest() != expected_hash:
+        raise ValueError(f"{path} does not match the hash of {name}")
+    mergeable_ranks = {}
+    for line in contents.splitlines():
+        if line:
+            token, rank = line.split()
+            mergeable_ranks[base64.b64decode(token)] = int(rank)
+    return tiktoken.Encoding(name, pat_str=pattern, mergeable_ranks=mergeable_ranks, special_tokens=special_tokens)
+
+def get_tokenizer(model: str=None):
+    # The tiktoken encoding of the model, loaded only from a local copy. tiktoken downloads an encoding that it does not have, which
+    # fails or hangs without a network, so the encoding is built from its file here. Token counts fall back to the length of the
+    # text when there is no such file, and the reason is kept for describe_token_estimates.
+    if model not in _tokenizers:
+        tokenizer = None
+        if tiktoken is None:
+            reason = "tiktoken is not installed"
+        else:
+            name = get_encoding_name(model)
+            path = find_encoding(name)
+            if name not in ENCODINGS:
+                reason = f"{name} is not one of {', '.join(ENCODINGS)}"
+            elif path is None:
+                reason = f"{name}.tiktoken is not in {', '.join(get_tokenizer_dirs())}, set tokenizer_dir or TIKTOKEN_CACHE_DIR"
+            else:
+                try:
+                    tokenizer = load_encoding(name, path)
+                except Exception as e:
+                    reason = f"{name} could not be loaded ({e})"
+        if tokenizer is None:
+            _fallbacks[model] = reason
+            print(f"no tokenizer for {model or DEFAULT_ENCODING}: {reason}. Estimating tokens from the length of the text instead")
+        _tokenizers[model] = tokenizer
+    return _tokenizers[model]
+
+def describe_token_estimates() -> str:
+    # How the tokens counted so far were estimated, for the budget report.
+    parts = [f"the {name} tokenizer" for name in sorted({tokenizer.name for tokenizer in _tokenizers.values() if tokenizer is not None})]
+    parts.extend(f"the length of the text for {model or DEFAULT_ENCODING} ({reason})" for model, reason in _fallbacks.items())
+    return ", ".join(parts) or "the length of the text"
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def count_text_tokens(text: str, model: str=None) -> int:
+    tokenizer = get_tokenizer(model)
+    if tokenizer is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(tokenizer.encode_ordinary(text))
+
+def estimate_text_tokens(text: str, model: str=None) -> int:
+    if get_tokenizer(model) is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return count_text_tokens(text, model)
+
+def estimate_image_tokens(size: Tuple[int, int]=None, detail: str="auto") -> int:
+    if detail == "low":
+        return IMAGE_BASE_TOKENS
+    if not size or not size[0] or not size[1]:
+        return IMAGE_TOKENS
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+
+def estimate_request_tokens(request: dict) -> int:
+    tokens = 0
+    model = request.get("body", {}).get("model")
+    for message in request.get("body", {}).get("messages", []):
+        tokens += TOKENS_PER_MESSAGE
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += estimate_text_tokens(content, model)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += estimate_text_tokens(part.get("text", ""), model)
+            elif part.get("type") == "image_url":
+                tokens += estimate_image_tokens(detail=part.get("image_url", {}).get("detail", "auto"))
+    # The schema of a structured response is part of the prompt as well.
+    schema = request.get("body", {}).get("response_format", {}).get("json_schema", {}).get("schema")
+    if schema:
+        tokens += estimate_text_tokens(json.dumps(schema), model)
+    return tokens
+
+def estimate_batch_tokens(batch_file: str) -> int:
+    tokens = 0
+    with open(batch_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                tokens += estimate_request_tokens(json.loads(line))
+    return tokens
+
+# Prompts are only cached by the provider once they are this long, and the cached part grows in steps.
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+def get_request_body(line: str) -> str:
+    # The part of a serialized request that is sent to the model. Quotes in the custom_id are escaped, so it cannot match earlier.
+    return line[line.find('"body": '):]
+
+def shared_prefix_length(a: str, b: str) -> int:
+    # Compares in blocks that double in size, then narrows down within the block that differs,
+    # so the cost grows with the length of the shared prefix rather than the length of the strings.
+    end = min(len(a), len(b))
+    low = 0
+    block = 64
+    while low < end:
+        high = min(low + block, end)
+        if a[low:high] != b[low:high]:
+            break
+        low = high
+        block *= 2
+    else:
+        return end
+    while high - low > 1:
+        middle = (low + high) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle
+    return low
+
+def estimate_cached_tokens(previous_line: str, line: str) -> int:
+    # Tokens of a request that can be read from the prompt cache, if the request before it in the same batch left its prompt there.
+    if previous_line is None:
+        return 0
+    previous_start = previous_line.find('"body": ')
+    start = line.find('"body": ')
+    # Most requests differ well before the shortest prefix that is cached, which takes a single comparison to rule out.
+    shortest = CACHE_MIN_TOKENS * CHARS_PER_TOKEN
+    if previous_line[previous_start:previous_start + shortest] != line[start:start + shortest]:
+        return 0
+    tokens = shared_prefix_length(previous_line[previous_start:], line[start:]) // CHARS_PER_TOKEN
+    if tokens < CACHE_MIN_TOKENS:
+        return 0
+    return tokens - (tokens - CACHE_MIN_TOKENS) % CACHE_INCREMENT
@@ -0,0 +1,138 @@
+import base64
+import hashlib
+import io
+import multiprocessing
+import os
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+from tqdm import tqdm
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+DEFAULT_CACHE_DIR = ".image_cache"
+MIME_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+IMAGE_DEFAULTS = {
+    "path_key": "image_path", # key of the local path of each image
+    "max_size": 768, # longest side in pixels, smaller images are left at their size
+    "format": "webp",
+    "quality": 80,
+    "processes": 1,
+    "cache_dir": DEFAULT_CACHE_DIR,
+}
+
+# Images that are on disk instead of at a public url are downscaled, re-encoded and sent inline as data urls.
+# Every image is encoded once into a disk cache under the hash of its contents and the settings it was encoded with,
+# so the later steps over the same images, such as the questions and answers after the captions, read the encoded bytes back
+# instead of encoding them again, and a copy of an image under another path is only encoded once.
+
+def get_image_settings(config_data: dict, step: str) -> dict:
+    # image_preprocess can be set for all steps at the top of the config and changed under a single step, where false turns it off.
+    # Returns None when the step does not preprocess its images.
+    top = config_data.get("image_preprocess")
+    step_settings = config_data.get(step, {}).get("image_preprocess", top)
+    if not step_settings:
+        return None
+    settings = dict(IMAGE_DEFAULTS)
+    for layer in (top, step_settings):
+        if isinstance(layer, dict):
+            settings.update(layer)
+    if settings["format"] not in MIME_TYPES:
+        raise ValueError(f"image_preprocess format has to be one of {', '.join(MIME_TYPES)}")
+    if Image is None:
+        raise ValueError("image_preprocess needs Pillow, install it with pip install pillow")
+    return settings
+
+def get_cache_file(digest: str, settings: dict) -> str:
+    tag = f"{settings['max_size']}_{settings['quality']}"
+    return os.path.join(settings["cache_dir"], digest[:2], f"{digest}_{tag}.{settings['format']}")
+
+def encode_image(path: str, settings: dict) -> Tuple[str, str, int, int]:
+    # Returns (path, cache file, width, height) for the encoded image, or None for the cache file when it cannot be read.
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        cache_file = get_cache_file(hashlib.sha256(data).hexdigest(), settings)
+        if os.path.exists(cache_file):
+            # Only the header is read to get the size back.
+            with Image.open(cache_file) as image:
+                return path, cache_file, image.width, image.height
+
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((settings["max_size"], settings["max_size"]))
+            if settings["format"] == "jpeg" and image.mode != "RGB":
+                image = image.convert("RGB")
+            elif image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            encoded = io.BytesIO()
+            image.save(encoded, format=settings["format"].upper(), quality=settings["quality"])
+            width, height = image.width, image.height
+    except (OSError, ValueError) as e:
+        print(f"could not preprocess {path}: {e}")
+        return path, None, 0, 0
+
+    # Written to a temporary file first, so a crash or another process never leaves a half written image in the cache.
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(encoded.getvalue())
+    os.replace(tmp_file, cache_file)
+    return path, cache_file, width, height
+
+def _encode_image(args: Tuple[str, dict]) -> Tuple[str, str, int, int]:
+    return encode_image(*args)
+
+def get_image_paths(records: Iterable[Dict[str, Any]], path_key: str) -> list:
+    # Each path once, skipping the records that are never made into requests.
+    paths = {}
+    for data in records:
+        path = data.get(path_key)
+        if not path or 'mp4' in path or 'gif' in path or 'REMOVE_IMAGE' in data.get('generated_caption', ''):
+            continue
+        paths[path] = None
+    return list(paths)
+
+def prepare_images(records: Iterable[Dict[str, Any]], settings: dict) -> Dict[str, Tuple[str, int, int]]:
+    # Encodes every image of the records that is not in the cache yet, and returns path -> (cache file, width, height).
+    paths = get_image_paths(records, settings["path_key"])
+    processes = min(settings["processes"], os.cpu_count() or 1, max(1, len(paths)))
+    work = ((path, settings) for path in paths)
+    if processes <= 1:
+        results = map(_encode_image, work)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_encode_image, work, chunksize=16)
+    images = {}
+    failed = 0
+    try:
+        for path, cache_file, width, height in tqdm(results, total=len(paths), desc="Preprocessing images"):
+            if cache_file is None:
+                failed += 1
+                continue
+            images[path] = (cache_file, width, height)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if failed:
+        print(f"{failed} images could not be preprocessed, their records keep their image_url")
+    return images
+
+def to_data_url(cache_file: str, image_format: str) -> str:
+    with open(cache_file, 'rb') as f:
+        return f"data:{MIME_TYPES[image_format]};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+def inline_images(records: Iterable[Dict[str, Any]], images: Dict[str, Tuple[str, int, int]], settings: dict) -> Iterator[Dict[str, Any]]:
+    # Yields a copy of each record with its image_url replaced by the encoded image and its image_width and image_height set to
+    # the encoded size, so that the records in the dataset never hold a data url.
+    for data in records:
+        image = images.get(data.get(settings["path_key"]))
+        if image is None:
+            yield data
+            continue
+        cache_file, width, height = image
+        yield {**data, "image_url": to_data_url(cache_file, settings["format"]), "image_width": width, "image_height": height}
@@ -1,46 +1,37 @@
-import json
-from pathlib import Path
-
-def create_log_files(api_key: str, input_file: str, response_key: str, data_key: str, output_file: str) -> None:
-    queue_log = {
-        "api_key": api_key,
-        "input_file": input_file,
-        "output_file": output_file,
-        "response_key": response_key,
-        "data_key": data_key,
-        "batches": []
-    }
-    with open("batch_queue_log.json", 'w') as f:
-        json.dump(queue_log, f, indent=4)
-
-    with open("batch_log.json", 'w') as log_file:
-        json.dump([], log_file)
-
-def log_batch_request(batches: list) -> None:
-    with open("batch_queue_log.json", 'r') as f:
-        log = json.load(f)
-    
-    log["batches"] = batches
-
-    with open("batch_queue_log.json", 'w') as f:
-        json.dump(log, f, indent=4)
-
-def log_response_history(action: str, batch_file: str, batch_id: str=None, file_id: str=None, status: str=None) -> None:
-    #This is added as a safety check, but if this is called from send_batch_request, an empty list will be initialized before everything starts.
-    with open("batch_log.json", 'r') as f:
-        log = json.load(f)
-
-    lsn = len(log) + 1
-    log_entry = {
-        "LSN": lsn,
-        "action": action,
-        "batch_file": batch_file,
-        "batch_id": batch_id,
-        "file_id": file_id,
-        "status": status
-    }
-
-    log.append(log_entry)
-
-    with open("batch_log.json", 'w') as f:
-        json.dump(log, f, indent=4)
+from .batch_request_store import DEFAULT_DB, get_store
+
+def create_log_files(api_key: str, input_file: str, response_key: str, data_key: str, output_file: str, max_in_flight: int=4,
+                     max_enqueued_tokens: int=None, step: str=None, options: dict=None, db_path: str=DEFAULT_DB) -> int:
+    return get_store(db_path).create_job(
+        api_key=api_key,
+        input_file=input_file,
+        output_file=output_file,
+        step=step,
+        response_key=response_key,
+        data_key=data_key,
+        max_in_flight=max_in_flight,
+        max_enqueued_tokens=max_enqueued_tokens,
+        options=options
+    )
+
+def log_batch_request(batches: list, job_id: int=None, tokens: dict=None, step: str=None, db_path: str=DEFAULT_DB) -> None:
+    # Registers the batch files of a job. Each file then tracks its own state, so this only has to be called when files are added.
+    store = get_store(db_path)
+    if job_id is None:
+        job_id = store.get_job()["job_id"]
+    store.add_batch_files(job_id, batches, tokens, step)
+
+def log_response_history(action: str, batch_file: str, batch_id: str=None, file_id: str=None, status: str=None, job_id: int=None, api_key: str=None,
+                         db_path: str=DEFAULT_DB) -> None:
+    store = get_store(db_path)
+    #This is added as a safety check, but if this is called from send_batch_request, the job will be created before everything starts.
+    if job_id is None:
+        job = store.get_job()
+        if job is None:
+            raise ValueError("No job has been created, call create_log_files first.")
+        job_id = job["job_id"]
+    # api_key is the key that a batch was sent with, when a job spreads its batches over several keys.
+    store.log_event(job_id, action, batch_file, batch_id, file_id, status, api_key)
+
+def log_job_status(job_id: int, status: str, db_path: str=DEFAULT_DB) -> None:
+    get_store(db_path).set_job_status(job_id, status)
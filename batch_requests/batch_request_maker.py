@@ -1,15 +1,37 @@
 import argparse
 import json
+import multiprocessing
 import os
+import uuid
+from json.encoder import encode_basestring_ascii
 from string import Formatter
 from tqdm import tqdm
-from typing import List, Dict, Any
-import yaml
+from typing import List, Dict, Any, Iterator, Tuple
 
-from .batch_request_splitter import split_jsonl_list
+from .batch_request_config import load_config
+from .batch_request_dataset import load_dataset
+from .batch_request_cache import ResponseCache, filter_cached_requests, filter_cached_lines
+from .batch_request_estimator import (
+    CHARS_PER_TOKEN,
+    TOKENS_PER_MESSAGE,
+    count_text_tokens,
+    estimate_image_tokens,
+    estimate_request_tokens,
+    estimate_text_tokens,
+    get_request_body,
+    get_tokenizer,
+    set_tokenizer_dir
+)
+from .batch_request_images import get_image_settings, inline_images, prepare_images
+from .batch_request_metrics import span, timed_iter
+from .batch_request_preflight import get_preflight_settings, preflight_records
+from .batch_request_schema import get_response_format
+from .batch_request_splitter import split_jsonl_lines
 
-def make_requests(config_data: dict, step:str, input_data: list, input_key: str="image_path") -> list:
+RENDER_CHUNK = 20000 # Records handed to each worker process at a time.
+CACHE_SORT_WINDOW = 100000 # Requests sorted together when cache_layout is on.
 
+def get_step_prompt(config_data: dict, step: str) -> Tuple[Dict[str, str], str]:
     step_prompt = config_data.get(step, None)
 
     if not step_prompt:
@@ -18,14 +40,64 @@ def make_requests(config_data: dict, step:str, input_data: list, input_key: str=
     model = config_data.get('model')
     if not model:
         raise ValueError("Model not specified in config file.")
+
+    # These can be set for all steps at the top of the config, or under a single step.
+    for key in ("cache_layout", "image_size", "image_detail"):
+        if key not in step_prompt and key in config_data:
+            step_prompt = {**step_prompt, key: config_data[key]}
+    if step_prompt.get("response_schema") and "response_schema_name" not in step_prompt:
+        step_prompt = {**step_prompt, "response_schema_name": step}
+
+    return step_prompt, model
+
+def get_user_content(image: str, text: str, cache_layout: bool=False, detail: str=None) -> List[Dict[str, Any]]:
+    # With cache_layout the text comes before the image, so that the fixed start of the user prompt is part of the prefix
+    # that every request of the step shares with the system prompt, instead of coming after an image that is different every time.
+    image_part = {"type": "image_url", "image_url": {"url": image, "detail": detail} if detail else {"url": image}}
+    text_part = {"type": "text", "text": text}
+    return [text_part, image_part] if cache_layout else [image_part, text_part]
+
+def prepare_records(config_data: dict, step: str, step_prompt: dict, input_data: list) -> Iterator[Dict[str, Any]]:
+    # With image_preprocess the images of the records are encoded from their local paths and sent inline instead of by their image_url.
+    # With image_preflight the image urls that are left are checked first, and the records whose image cannot be fetched are left out.
+    if not step_prompt.get('is_multimodal', True):
+        return input_data
+    image_settings = get_image_settings(config_data, step)
+    preflight_settings = get_preflight_settings(config_data, step)
+    if image_settings is None and preflight_settings is None:
+        return input_data
+
+    images = {}
+    if image_settings is not None:
+        with span("images", step=step):
+            images = prepare_images(input_data, image_settings)
+    if preflight_settings is not None:
+        inlined = (lambda data: data.get(image_settings["path_key"]) in images) if images else None
+        with span("preflight", step=step):
+            input_data = preflight_records(input_data, preflight_settings, step, inlined)
+    if image_settings is not None:
+        # Kept a list when it was given a list, like preflight_records, so that the requests can still be made on maker_processes.
+        inlined_records = inline_images(input_data, images, image_settings)
+        input_data = list(inlined_records) if isinstance(input_data, list) else inlined_records
+    return input_data
+
+def make_requests(config_data: dict, step:str, input_data: list, input_key: str="image_path", cache: ResponseCache=None, cached_outputs: dict=None) -> list:
+
+    step_prompt, model = get_step_prompt(config_data, step)
+    input_data = prepare_records(config_data, step, step_prompt, input_data)
     
-    if "question" in step:
-        # There is a separate check for question as there is a counter in the dynamic promptmaker to check if a field is missing.
-        # The first question generated will initialize 2 new fields (qna, dialog history) so it will be handled separately to ensure that empty batches of requests are not sent.
-        # The consequence of this is that the question prompt will be more fixed unless the user comes up with a different way to format the dialog history field.
-        output_data = generate_question(input_data, step_prompt, model, input_key)
-    else:
-        output_data = dynamic_promptmaker(input_data, step_prompt, model, input_key)
+    with span("make", step=step):
+        if "question" in step:
+            # There is a separate check for question as there is a counter in the dynamic promptmaker to check if a field is missing.
+            # The first question generated will initialize 2 new fields (qna, dialog history) so it will be handled separately to ensure that empty batches of requests are not sent.
+            # The consequence of this is that the question prompt will be more fixed unless the user comes up with a different way to format the dialog history field.
+            output_data = generate_question(input_data, step_prompt, model, input_key)
+        else:
+            output_data = dynamic_promptmaker(input_data, step_prompt, model, input_key)
+
+    if cache is not None:
+        # Requests that have been answered before are filled into cached_outputs instead of being sent again.
+        output_data = filter_cached_requests(output_data, cache, step, cached_outputs if cached_outputs is not None else {})
     
     return output_data
 
@@ -77,11 +149,10 @@ def dynamic_promptmaker(input_data: List[Dict[str, Any]], prompt: Dict[str, str]
                     "model": model,
                     "messages": [
                         {"role": "system", "content": sysprompt.strip()},
-                        {"role": "user", "content": [
-                            {"type": "image_url", "image_url": {"url": image}},
-                            {"type": "text", "text": formatted_userprompt}
-                        ]}
-                    ]
+                        {"role": "user", "content": get_user_content(image, formatted_userprompt, prompt.get('cache_layout', False),
+                                                                                       prompt.get('image_detail'))}
+                    ],
+                    **get_response_format(prompt)
                 }
             }
             requests.append(batch_request)
@@ -95,7 +166,8 @@ def dynamic_promptmaker(input_data: List[Dict[str, Any]], prompt: Dict[str, str]
                     "messages": [
                         {"role": "system", "content": sysprompt.strip()},
                         {"role": "user", "content": formatted_userprompt}
-                    ]
+                    ],
+                    **get_response_format(prompt)
                 }
             }
             requests.append(batch_request)
@@ -126,11 +198,10 @@ def generate_question(input_data: List[Dict[str, Any]], prompt: Dict[str, str],
                 "model": model,
                 "messages": [
                     {"role": "system", "content": sysprompt.strip()},
-                    {"role": "user", "content": [
-                        {"type": "image_url", "image_url": {"url": image}},
-                        {"type": "text", "text": userprompt.format(dialogue_history=dialogue_history, context=context).strip()}
-                    ]}
-                ]
+                    {"role": "user", "content": get_user_content(image, userprompt.format(dialogue_history=dialogue_history, context=context).strip(),
+                                                                 prompt.get('cache_layout', False), prompt.get('image_detail'))}
+                ],
+                **get_response_format(prompt)
             }
         }
 
@@ -138,26 +209,223 @@ def generate_question(input_data: List[Dict[str, Any]], prompt: Dict[str, str],
 
     return requests
 
+def make_request_lines(config_data: dict, step: str, input_data: list, input_key: str="image_path", cache: ResponseCache=None, cached_outputs: dict=None,
+                       processes: int=1) -> Iterator[Tuple[str, int]]:
+    # Same requests as make_requests, but yielded as (serialized request, estimated tokens) pairs that can be written straight
+    # to the batch files, without building a dictionary for every request and serializing it again.
+    step_prompt, model = get_step_prompt(config_data, step)
+    set_tokenizer_dir(config_data.get("tokenizer_dir"))
+    input_data = prepare_records(config_data, step, step_prompt, input_data)
+
+    if "question" in step:
+        lines = ((json.dumps(request), estimate_request_tokens(request)) for request in generate_question(input_data, step_prompt, model, input_key))
+    else:
+        lines = render_requests(RequestTemplate(step_prompt, model, input_key), input_data, processes)
+
+    if cache is not None:
+        lines = filter_cached_lines(lines, cache, step, cached_outputs if cached_outputs is not None else {})
+
+    if step_prompt.get("cache_layout", False):
+        lines = sort_for_cache(lines, config_data.get("cache_sort_window", CACHE_SORT_WINDOW))
+
+    # The requests are made as the batch files are written, so they are timed as each one is pulled.
+    return timed_iter("make", lines, step=step)
+
+def sort_for_cache(lines: Iterator[Tuple[str, int]], window: int=CACHE_SORT_WINDOW) -> Iterator[Tuple[str, int]]:
+    # Sorting on the request body puts requests that start the same way next to each other, such as images from the same article,
+    # so each one shares the longest prefix it can with the request before it. Only window requests are held at once,
+    # and a window usually covers several batch files.
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= window:
+            buffer.sort(key=lambda pair: get_request_body(pair[0]))
+            yield from buffer
+            buffer = []
+    buffer.sort(key=lambda pair: get_request_body(pair[0]))
+    yield from buffer
+
+# A step prompt compiled once into the serialized request with gaps for the fields of each record.
+# The constant parts (model, system prompt and the rest of the envelope) are serialized once, and each record only costs escaping
+# its own fields and joining the pieces. The lines are the same as json.dumps of the requests built by dynamic_promptmaker.
+#
+# Tokens are counted with the tokenizer of the model when it can be loaded. The constant parts are counted once, and each field value
+# is counted through a cache so values that repeat, such as the body of an article shared by several images, are only counted once.
+class RequestTemplate:
+    def __init__(self, prompt: Dict[str, str], model: str, input_key: str):
+        self.userprompt = prompt['user']
+        self.model = model
+        self.tokenizer = get_tokenizer(model)
+        self.input_key = input_key
+        self.is_multimodal = prompt.get('is_multimodal', True)
+        self.cache_layout = prompt.get('cache_layout', False)
+        self.image_detail = prompt.get('image_detail')
+        sysprompt = prompt['system'].strip()
+
+        # The user prompt as escaped literal text followed by the field that comes after it.
+        self.parts = []
+        self.literal_length = 0
+        self.literal_tokens = 0
+        self.simple = True
+        for literal_text, field_name, format_spec, conversion in Formatter().parse(self.userprompt):
+            self.parts.append((encode_basestring_ascii(literal_text)[1:-1], field_name, conversion, format_spec or ""))
+            self.literal_length += len(literal_text)
+            if self.tokenizer is not None and literal_text:
+                self.literal_tokens += count_text_tokens(literal_text, model)
+            if field_name is not None and (not field_name.isidentifier() or "{" in (format_spec or "")):
+                # Attribute lookups, indexes and nested fields are left to str.format.
+                self.simple = False
+        self.fields = {field_name for _, field_name, _, _ in self.parts if field_name is not None}
+
+        # Placeholders that cannot come out of json.dumps of the prompts, replaced by each record's values.
+        marker = uuid.uuid4().hex
+        response_format = get_response_format(prompt)
+        slots = {name: f"@{name}_{marker}@" for name in ("custom_id", "image_url", "text")}
+        if self.is_multimodal:
+            user_content = get_user_content(slots["image_url"], slots["text"], self.cache_layout, self.image_detail)
+        else:
+            user_content = slots["text"]
+        envelope = json.dumps({
+            "custom_id": slots["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": sysprompt},
+                    {"role": "user", "content": user_content}
+                ],
+                **response_format
+            }
+        })
+        self.prefix, rest = envelope.split(f'"{slots["custom_id"]}"')
+        if not self.is_multimodal:
+            self.before_text, self.suffix = rest.split(f'"{slots["text"]}"')
+        elif self.cache_layout:
+            self.before_text, rest = rest.split(f'"{slots["text"]}"')
+            self.before_image, self.suffix = rest.split(f'"{slots["image_url"]}"')
+        else:
+            self.before_image, rest = rest.split(f'"{slots["image_url"]}"')
+            self.before_text, self.suffix = rest.split(f'"{slots["text"]}"')
+
+        # Images are counted at the image_size of the step, or at the size of each record's image when it has image_width and image_height,
+        # and at the flat cost of a low detail image whatever their size when image_detail is low.
+        self.image_tokens = estimate_image_tokens(prompt.get('image_size'), self.image_detail or "auto") if self.is_multimodal else 0
+        self.constant_tokens = 2 * TOKENS_PER_MESSAGE + estimate_text_tokens(sysprompt, model) + self.image_tokens
+        if response_format:
+            self.constant_tokens += estimate_text_tokens(json.dumps(prompt["response_schema"]), model)
+
+    def render(self, data: Dict[str, Any]) -> Tuple[str, int]:
+        # Raises KeyError when the record is missing a field of the prompt, like str.format does.
+        if self.simple:
+            pieces = ['"']
+            length = self.literal_length
+            text_tokens = self.literal_tokens
+            for literal, field_name, conversion, format_spec in self.parts:
+                pieces.append(literal)
+                if field_name is None:
+                    continue
+                value = data[field_name]
+                if conversion:
+                    value = CONVERSIONS[conversion](value)
+                text = format(value, format_spec)
+                pieces.append(encode_basestring_ascii(text)[1:-1])
+                length += len(text)
+                if self.tokenizer is not None:
+                    text_tokens += count_text_tokens(text, self.model)
+            pieces.append('"')
+            text_json = "".join(pieces)
+        else:
+            text = self.userprompt.format(**data)
+            text_json = encode_basestring_ascii(text)
+            length = len(text)
+            if self.tokenizer is not None:
+                text_tokens = len(self.tokenizer.encode_ordinary(text))
+
+        tokens = self.constant_tokens + (text_tokens if self.tokenizer is not None else length // CHARS_PER_TOKEN + 1)
+        if self.is_multimodal and data.get("image_width") and data.get("image_height"):
+            tokens += estimate_image_tokens((data["image_width"], data["image_height"]), self.image_detail or "auto") - self.image_tokens
+
+        line = self.prefix + dump_value(data[self.input_key])
+        if not self.is_multimodal:
+            line += self.before_text + text_json + self.suffix
+        elif self.cache_layout:
+            line += self.before_text + text_json + self.before_image + dump_value(data["image_url"]) + self.suffix
+        else:
+            line += self.before_image + dump_value(data["image_url"]) + self.before_text + text_json + self.suffix
+        return line, tokens
+
+CONVERSIONS = {"r": repr, "s": str, "a": ascii}
+
+def dump_value(value: Any) -> str:
+    return encode_basestring_ascii(value) if isinstance(value, str) else json.dumps(value)
+
+def render_records(template: RequestTemplate, records: Iterator[Dict[str, Any]]) -> Iterator[Tuple[str, int]]:
+    # Applies the same skips and missing field checks as dynamic_promptmaker.
+    failed_tries = 0
+    for data in records:
+        file_key = data[template.input_key]
+        if 'mp4' in file_key or 'gif' in file_key:
+            continue
+        if 'REMOVE_IMAGE' in data.get('generated_caption', ''):
+            continue
+        try:
+            rendered = template.render(data)
+        except KeyError as e:
+            print("Missing field: ", e)
+            failed_tries += 1
+            if failed_tries == 5:
+                raise ValueError("Input data is missing required fields for the prompt. Please check the input data and prompt.")
+            continue
+        failed_tries = 0
+        yield rendered
+
+_worker_state = {}
+
+def _init_render_worker(template: RequestTemplate, input_data: list) -> None:
+    # Forked workers inherit the template and the dataset, so only the bounds of each chunk are sent to them.
+    _worker_state["template"] = template
+    _worker_state["input_data"] = input_data
+
+def _render_chunk(bounds: Tuple[int, int]) -> Tuple[str, List[int]]:
+    # Sent back as a single string, which is much cheaper to pass between processes than one string for every request.
+    start, end = bounds
+    rendered = list(render_records(_worker_state["template"], _worker_state["input_data"][start:end]))
+    return "\n".join(line for line, _ in rendered), [tokens for _, tokens in rendered]
+
+def render_requests(template: RequestTemplate, input_data: list, processes: int=1) -> Iterator[Tuple[str, int]]:
+    processes = min(processes, os.cpu_count() or 1)
+    # Only lists are split between processes, a JsonlDataset is streamed from disk by a single process.
+    if processes <= 1 or not isinstance(input_data, list) or len(input_data) <= RENDER_CHUNK or "fork" not in multiprocessing.get_all_start_methods():
+        yield from render_records(template, tqdm(input_data, desc="Making prompts"))
+        return
+
+    # Chunks come back in order, so the batch files are the same as with a single process.
+    # Serialized requests never contain a raw newline, so the lines of a chunk can be split apart again on it.
+    bounds = [(start, min(start + RENDER_CHUNK, len(input_data))) for start in range(0, len(input_data), RENDER_CHUNK)]
+    with multiprocessing.get_context("fork").Pool(processes, initializer=_init_render_worker, initargs=(template, input_data)) as pool:
+        for text, tokens in tqdm(pool.imap(_render_chunk, bounds), total=len(bounds), desc=f"Making prompts on {processes} processes"):
+            if tokens:
+                yield from zip(text.split("\n"), tokens)
+
 def main(config: str, step: str, input_file: str=None, output_file: str=None):
-    with open(config, 'r') as file:
-        config_data = yaml.safe_load(file)
+    config_data = load_config(config)
 
     if input_file:
-        with open(input_file, 'r') as f:
-            input_data = json.load(f)
+        input_data = load_dataset(input_file)
     else:
         raise ValueError("Input file is required.")
 
-    output_data = make_requests(config_data, step, input_data)
+    output_lines = [line for line, _ in make_request_lines(config_data, step, input_data, processes=config_data.get("maker_processes", 1))]
 
     if output_file:
         with open(output_file, 'w') as f:
-            for item in output_data:
-                f.write(json.dumps(item) + '\n')
+            for line in output_lines:
+                f.write(line + '\n')
 
     input_path = os.path.dirname(input_file)
-    if len(output_data) > 1000:
-        split_jsonl_list(input_list=output_data, input_path=input_path, step=step)
+    if len(output_lines) > 1000:
+        split_jsonl_lines(lines=output_lines, input_path=input_path, step=step)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate data using OpenAI API.")
@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+from .batch_request_dataset import JsonlDataset
+from .batch_request_metrics import count, span
+from .batch_request_retriever import get_response_handler
+
+FLUSH_EVERY = 1000 # Records merged into a JsonlDataset between saves to its overlay.
+
+def build_index(input_data: List[Dict[str, Any]], data_key: str) -> Dict[str, List[Dict[str, Any]]]:
+    index = {}
+    for item in input_data:
+        index.setdefault(item.get(data_key), []).append(item)
+    return index
+
+# Merges the results of each batch into the dataset as the batch finishes.
+# Records are looked up through an index on data_key so each merge only costs as much as the batch, and results are appended to a
+# partial file next to the output instead of rewriting the whole dataset. compact writes the full output once at the end.
+#
+# Each batch is written to the partial file as its records followed by a marker line, and only batches with a marker are replayed,
+# so a crash in the middle of a write never applies half a batch, and a batch is never applied twice.
+#
+# A JsonlDataset is its own index. The records that a batch touches are saved to its overlay instead of being kept in memory,
+# and compact streams the dataset out with the updates applied.
+class ResultMerger:
+    def __init__(self, input_data: Union[List[Dict[str, Any]], JsonlDataset], data_key: str, output_file: str):
+        self.input_data = input_data
+        self.data_key = data_key
+        self.output_file = output_file
+        self.partial_file = f"{output_file}.partial.jsonl"
+        if isinstance(input_data, JsonlDataset):
+            input_data.open_overlay(f"{output_file}.overlay.db")
+            self.index = input_data
+        else:
+            self.index = build_index(input_data, data_key)
+        self.merged_batches: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def apply(self, parsed_outputs: Union[Dict[str, Any], Iterable[Tuple[str, Any]]], response_key: str, batch_file: str=None,
+              merged_keys: Set[str]=None) -> int:
+        if batch_file and batch_file in self.merged_batches:
+            print(f"batch {batch_file} has already been merged, skipping")
+            return 0
+
+        outputs = parsed_outputs.items() if isinstance(parsed_outputs, dict) else parsed_outputs
+        with self.lock, span("merge"):
+            with open(self.partial_file, 'a', encoding='utf-8') as f:
+                merged = self.merge(outputs, response_key, f, merged_keys)
+                self.flush()
+                f.write(json.dumps({"batch_file": batch_file, "records": merged}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if batch_file:
+                self.merged_batches.add(batch_file)
+        count("rows", merged, kind="merged")
+        return merged
+
+    def merge(self, outputs: Iterable[Tuple[str, Any]], response_key: str, f=None, merged_keys: Set[str]=None) -> int:
+        handler = get_response_handler(response_key)
+        merged = 0
+        for custom_id, response in outputs:
+            items = self.index.get(custom_id)
+            if not items:
+                continue
+            for item in items:
+                handler(item, response, response_key)
+            if f is not None:
+                f.write(json.dumps({"key": custom_id, "response_key": response_key, "value": response}) + '\n')
+            if merged_keys is not None:
+                merged_keys.add(custom_id)
+            merged += 1
+            if merged % FLUSH_EVERY == 0:
+                self.flush()
+        return merged
+
+    def flush(self) -> None:
+        # Only a JsonlDataset holds on to the records that were merged, until they are saved to its overlay.
+        if isinstance(self.index, JsonlDataset):
+            self.index.flush()
+
+    def replay(self, merged_keys: Dict[str, Set[str]]=None) -> int:
+        # Re-applies the batches that were merged before a crash, since the dataset is only written out in compact.
+        # merged_keys, when given, is filled with the keys that were replayed under each response_key.
+        if not os.path.exists(self.partial_file):
+            return 0
+
+        # The first pass only reads the markers to find where the last complete batch ends, so that the records of a batch
+        # never have to be held until its marker is found.
+        committed = 0
+        offset = 0
+        with open(self.partial_file, 'rb') as f:
+            for line in f:
+                offset += len(line)
+                if line.startswith(b'{"key"'):
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break # A line that was cut off by a crash, nothing after it was committed.
+                committed = offset
+                if record.get("batch_file"):
+                    self.merged_batches.add(record["batch_file"])
+
+        replayed = 0
+        offset = 0
+        with open(self.partial_file, 'rb') as f:
+            for line in f:
+                offset += len(line)
+                if offset > committed:
+                    break
+                if not line.startswith(b'{"key"'):
+                    continue
+                entry = json.loads(line)
+                handler = get_response_handler(entry["response_key"])
+                for item in self.index.get(entry["key"], []):
+                    handler(item, entry["value"], entry["response_key"])
+                if merged_keys is not None:
+                    merged_keys.setdefault(entry["response_key"], set()).add(entry["key"])
+                replayed += 1
+                if replayed % FLUSH_EVERY == 0:
+                    self.flush()
+        self.flush()
+
+        # Drop anything after the last complete batch so that new batches are not appended after a half written one.
+        os.truncate(self.partial_file, committed)
+        print(f"replayed {replayed} merged records from {self.partial_file}")
+        return replayed
+
+    def discard(self) -> None:
+        # A partial file left behind by an earlier run that was never recovered does not belong to this run.
+        if os.path.exists(self.partial_file):
+            print(f"removing stale partial results in {self.partial_file}")
+            os.remove(self.partial_file)
+
+    def compact(self) -> None:
+        # Written to a temporary file first so that a crash never leaves a half written output file.
+        with self.lock, span("write"):
+            tmp_file = f"{self.output_file}.tmp"
+            if isinstance(self.input_data, JsonlDataset):
+                self.input_data.write(tmp_file, as_json=not self.output_file.endswith(".jsonl"))
+            else:
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.input_data, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_file, self.output_file)
+            count("bytes", os.path.getsize(self.output_file), kind="written")
+            if os.path.exists(self.partial_file):
+                os.remove(self.partial_file)
+            self.merged_batches.clear()
@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+PREFIX = "batch_requests"
+
+# Spans time the stages of a run (making requests, splitting, uploading, polling, downloading, parsing, merging, writing) and counters
+# add up its rows, bytes, tokens and api calls. They are written out at the end of the run as an OpenMetrics textfile, which a
+# node_exporter textfile collector can pick up, and as a json report.
+#
+# Nothing is recorded until enable_metrics is called. Until then span returns one shared context manager that does nothing, count
+# returns straight away and timed_iter hands back the iterator it was given, so the calls can stay in the hot paths.
+#
+# Each span keeps its own time as well as its total time, without the spans that ran inside it. The requests are made lazily as
+# they are written to the batch files, for example, so the split span only keeps the time spent writing once the make span inside
+# it is taken out, and the own times of the stages that run on the same thread add up to its time without counting anything twice.
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        self.spans: Dict[Tuple[str, tuple], dict] = {} # (stage, labels) -> calls, seconds, self_seconds, max_seconds
+        self.counters: Dict[Tuple[str, tuple], float] = {} # (name, labels) -> value
+        self.info: Dict[str, Any] = {}
+        self.started_at = time.time()
+
+    def stack(self) -> list:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def record(self, stage: str, seconds: float, self_seconds: float, labels: tuple, calls: int=1) -> None:
+        with self.lock:
+            entry = self.spans.get((stage, labels))
+            if entry is None:
+                entry = self.spans[(stage, labels)] = {"calls": 0, "seconds": 0.0, "self_seconds": 0.0, "max_seconds": 0.0}
+            entry["calls"] += calls
+            entry["seconds"] += seconds
+            entry["self_seconds"] += self_seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def add(self, name: str, value: float, labels: tuple) -> None:
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+METRICS = Metrics()
+
+class Span:
+    __slots__ = ("stage", "labels", "started", "children")
+
+    def __init__(self, stage: str, labels: tuple):
+        self.stage = stage
+        self.labels = labels
+        self.children = 0.0
+
+    def __enter__(self) -> "Span":
+        METRICS.stack().append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def stop(self) -> float:
+        # Takes the span off the stack and returns how long it ran, which is also taken out of the own time of the span around it.
+        elapsed = time.perf_counter() - self.started
+        stack = METRICS.stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        return elapsed
+
+    def __exit__(self, *exc) -> bool:
+        elapsed = self.stop()
+        METRICS.record(self.stage, elapsed, elapsed - self.children, self.labels)
+        return False
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+NULL_SPAN = NullSpan()
+
+def metrics_enabled() -> bool:
+    # For the counts that take work to add up, which is skipped when nothing is recorded.
+    return METRICS.enabled
+
+def get_labels(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+def span(stage: str, **labels) -> Span:
+    if not METRICS.enabled:
+        return NULL_SPAN
+    return Span(stage, get_labels(labels))
+
+def count(name: str, value: float=1, **labels) -> None:
+    if METRICS.enabled and value:
+        METRICS.add(name, value, get_labels(labels))
+
+def record_span(stage: str, seconds: float, **labels) -> None:
+    # For durations that were measured somewhere else, such as the time a batch spent in the queue of the api.
+    if METRICS.enabled and seconds is not None and seconds >= 0:
+        METRICS.record(stage, seconds, seconds, get_labels(labels))
+
+def timed_iter(stage: str, iterable: Iterable, **labels) -> Iterator:
+    # Times a lazy stage as each of its items is pulled, and records it as a single call once it runs out.
+    if not METRICS.enabled:
+        return iterable
+    return _timed_iter(stage, iter(iterable), get_labels(labels))
+
+def _timed_iter(stage: str, iterator: Iterator, labels: tuple) -> Iterator:
+    seconds = 0.0
+    self_seconds = 0.0
+    try:
+        while True:
+            item_span = Span(stage, labels).__enter__()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed = item_span.stop()
+                seconds += elapsed
+                self_seconds += elapsed - item_span.children
+            yield item
+    finally:
+        METRICS.record(stage, seconds, self_seconds, labels)
+
+def get_metrics_settings(config_data: dict) -> dict:
+    # metrics: {textfile: <path>, report: <path>} in the config, where either path can be left out. Returns None when it is not set.
+    settings = config_data.get("metrics")
+    if not settings:
+        return None
+    if not isinstance(settings, dict):
+        settings = {}
+    return {"textfile": settings.get("textfile", "batch_metrics.prom"), "report": settings.get("report", "batch_report.json")}
+
+def enable_metrics(config_data: dict, **info) -> dict:
+    # Starts recording for a run when the config asks for metrics, and returns the settings to pass to write_metrics at the end.
+    settings = get_metrics_settings(config_data)
+    if settings is None:
+        return None
+    with METRICS.lock:
+        METRICS.reset()
+        METRICS.info.update({key: value for key, value in info.items() if value is not None})
+        METRICS.enabled = True
+    return settings
+
+def get_report() -> dict:
+    with METRICS.lock:
+        finished_at = time.time()
+        return {
+            "info": dict(METRICS.info),
+            "started_at": METRICS.started_at,
+            "finished_at": finished_at,
+            "wall_seconds": finished_at - METRICS.started_at,
+            "stages": sorted(({"stage": stage, "labels": dict(labels), **entry} for (stage, labels), entry in METRICS.spans.items()),
+                             key=lambda entry: -entry["self_seconds"]),
+            "counters": sorted(({"name": name, "labels": dict(labels), "value": value} for (name, labels), value in METRICS.counters.items()),
+                               key=lambda entry: (entry["name"], sorted(entry["labels"].items())))
+        }
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+def format_openmetrics(report: dict) -> str:
+    lines = []
+    families = (
+        ("stage_seconds", "seconds", "Time spent in each stage, including the stages that ran inside it", "seconds"),
+        ("stage_self_seconds", "seconds", "Time spent in each stage, without the stages that ran inside it", "self_seconds"),
+        ("stage_calls", None, "Number of times each stage ran", "calls"),
+    )
+    for name, unit, help_text, field in families:
+        lines.append(f"# TYPE {PREFIX}_{name} counter")
+        if unit:
+            lines.append(f"# UNIT {PREFIX}_{name} {unit}")
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}.")
+        for entry in report["stages"]:
+            lines.append(f"{PREFIX}_{name}_total{format_labels({'stage': entry['stage'], **entry['labels']})} {entry[field]}")
+
+    names = sorted({entry["name"] for entry in report["counters"]})
+    for name in names:
+        lines.append(f"# TYPE {PREFIX}_{name} counter")
+        lines.append(f"# HELP {PREFIX}_{name} Number of {name.replace('_', ' ')} in the run.")
+        for entry in report["counters"]:
+            if entry["name"] == name:
+                lines.append(f"{PREFIX}_{name}_total{format_labels(entry['labels'])} {entry['value']}")
+
+    lines.append(f"# TYPE {PREFIX}_run_seconds gauge")
+    lines.append(f"# UNIT {PREFIX}_run_seconds seconds")
+    lines.append(f"# HELP {PREFIX}_run_seconds Wall time of the last run.")
+    lines.append(f"{PREFIX}_run_seconds {report['wall_seconds']}")
+    lines.append(f"# TYPE {PREFIX}_run_finished_timestamp_seconds gauge")
+    lines.append(f"# UNIT {PREFIX}_run_finished_timestamp_seconds seconds")
+    lines.append(f"# HELP {PREFIX}_run_finished_timestamp_seconds When the last run finished.")
+    lines.append(f"{PREFIX}_run_finished_timestamp_seconds {report['finished_at']}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+def write_file(path: str, text: str) -> None:
+    # Written to a temporary file first, since a textfile collector may read it at any time.
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(f"{path}.tmp", path)
+
+def print_report(report: dict) -> None:
+    print(f"run took {report['wall_seconds']:.1f}s")
+    for entry in report["stages"]:
+        labels = " ".join(f"{key}={value}" for key, value in entry["labels"].items())
+        print(f"  {entry['stage']:>16} {entry['self_seconds']:>9.2f}s own {entry['seconds']:>9.2f}s total {entry['calls']:>7} calls  {labels}")
+
+def write_metrics(settings: dict) -> dict:
+    # Writes out everything recorded since enable_metrics and stops recording. Does nothing when metrics were never enabled.
+    if settings is None or not METRICS.enabled:
+        return None
+    report = get_report()
+    METRICS.enabled = False
+    print_report(report)
+    if settings.get("textfile"):
+        write_file(settings["textfile"], format_openmetrics(report))
+    if settings.get("report"):
+        write_file(settings["report"], json.dumps(report, indent=4))
+    return report
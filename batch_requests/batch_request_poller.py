@@ -0,0 +1,151 @@
+import random
+import time
+from typing import Dict, List, Tuple
+
+from .batch_request_client import get_client
+from .batch_request_metrics import count, record_span, span
+
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+MIN_DELAY = 5
+MAX_DELAY = 600
+JITTER = 0.2
+LIST_THRESHOLD = 20 # Past this many batches due at once, a single paged list call is cheaper than one call per batch.
+LIST_PAGE_SIZE = 100
+
+def get_done_count(batch) -> Tuple[int, int]:
+    counts = getattr(batch, "request_counts", None)
+    if counts is None:
+        return 0, 0
+    return (counts.completed or 0) + (counts.failed or 0), counts.total or 0
+
+def record_batch_times(batch) -> None:
+    # How long a finished batch waited to be validated, ran in the queue of the api and took to finalize, from the times the api keeps.
+    created_at = getattr(batch, "created_at", None)
+    in_progress_at = getattr(batch, "in_progress_at", None)
+    finalizing_at = getattr(batch, "finalizing_at", None)
+    finished_at = getattr(batch, f"{batch.status}_at", None)
+    if created_at and in_progress_at:
+        record_span("validation_wait", in_progress_at - created_at)
+    if in_progress_at and (finalizing_at or finished_at):
+        record_span("queue_wait", (finalizing_at or finished_at) - in_progress_at)
+    if finalizing_at and finished_at:
+        record_span("finalize_wait", finished_at - finalizing_at)
+
+def next_poll_delay(batch, state: dict, now: float, min_delay: float=MIN_DELAY, max_delay: float=MAX_DELAY) -> float:
+    previous = state.get("delay", min_delay)
+    if batch.status == "validating":
+        # Validation is usually quick, so start short and back off.
+        delay = min(previous * 2, 60) if state.get("status") == "validating" else min_delay
+    elif batch.status in ("finalizing", "cancelling"):
+        delay = min_delay * 2
+    elif batch.status == "in_progress":
+        done, total = get_done_count(batch)
+        last_done = state.get("done", 0)
+        last_time = state.get("checked_at")
+        if last_time and done > last_done and total:
+            # Estimate the time left from the rate since the last poll, and check back at half of it.
+            rate = (done - last_done) / (now - last_time)
+            delay = (total - done) / rate / 2
+        else:
+            # No progress since the last poll, back off exponentially.
+            delay = previous * 2
+    else:
+        delay = min_delay
+    delay = max(min_delay, min(delay, max_delay))
+    return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+# Polls every in-flight batch from a single loop with one pooled client. Each batch is checked again after a delay that adapts
+# to its status and progress, so finished batches are noticed quickly while long in_progress stretches cost few api calls.
+class BatchPoller:
+    def __init__(self, api_key: str, min_delay: float=MIN_DELAY, max_delay: float=MAX_DELAY, list_threshold: int=LIST_THRESHOLD):
+        self.api_key = api_key
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.list_threshold = list_threshold
+        self.watched: Dict[str, dict] = {} # batch_id -> polling state
+        self.api_calls = 0
+
+    def watch(self, batch_id: str, delay: float=None) -> None:
+        self.watched[batch_id] = {"next_poll": time.time() + (delay if delay is not None else self.min_delay)}
+
+    def unwatch(self, batch_id: str) -> None:
+        self.watched.pop(batch_id, None)
+
+    def next_poll_in(self) -> float:
+        if not self.watched:
+            return None
+        return max(0.0, min(state["next_poll"] for state in self.watched.values()) - time.time())
+
+    def fetch(self, batch_ids: List[str]) -> Dict[str, object]:
+        client = get_client(self.api_key)
+        batches = {}
+        if len(batch_ids) > self.list_threshold:
+            wanted = set(batch_ids)
+            pages = len(batch_ids) // LIST_PAGE_SIZE + 2
+            page = client.batches.list(limit=LIST_PAGE_SIZE)
+            self.api_calls += 1
+            count("api_calls", call="batches.list")
+            while page is not None and pages > 0:
+                for batch in page.data:
+                    if batch.id in wanted:
+                        batches[batch.id] = batch
+                if wanted.issubset(batches) or not page.has_next_page():
+                    break
+                page = page.get_next_page()
+                self.api_calls += 1
+                count("api_calls", call="batches.list")
+                pages -= 1
+        for batch_id in batch_ids:
+            # Anything that was not in the recent pages of the list is checked on its own.
+            if batch_id not in batches:
+                batches[batch_id] = client.batches.retrieve(batch_id)
+                self.api_calls += 1
+                count("api_calls", call="batches.retrieve")
+        return batches
+
+    def poll(self, ahead: float=0) -> List[object]:
+        # Batches that are due within ahead seconds are checked along with the ones that are due, so they can share a list call.
+        now = time.time()
+        due = [batch_id for batch_id, state in self.watched.items() if state["next_poll"] <= now + ahead]
+        if not due:
+            return []
+
+        updates = []
+        with span("poll"):
+            fetched = self.fetch(due)
+        for batch_id, batch in fetched.items():
+            state = self.watched.get(batch_id)
+            if state is None:
+                continue
+            now = time.time()
+            if batch.status in TERMINAL_STATUSES:
+                self.unwatch(batch_id)
+            else:
+                delay = next_poll_delay(batch, state, now, self.min_delay, self.max_delay)
+                done, _ = get_done_count(batch)
+                state.update({"status": batch.status, "delay": delay, "done": done, "checked_at": now, "next_poll": now + delay})
+            updates.append(batch)
+        return updates
+
+    def wait(self) -> List[object]:
+        delay = self.next_poll_in()
+        if delay is None:
+            return []
+        if delay > 0:
+            time.sleep(delay)
+        return self.poll()
+
+def wait_for_batch(api_key: str, batch_id: str, statuses: Tuple[str, ...]=TERMINAL_STATUSES, timeout: float=None):
+    # Blocks until the batch reaches one of the given statuses, or any terminal status, and returns it.
+    poller = BatchPoller(api_key)
+    poller.watch(batch_id, delay=0)
+    started = time.time()
+    while True:
+        for batch in poller.wait():
+            print(f"current status: {batch.status}")
+            if batch.status in statuses or batch.status in TERMINAL_STATUSES:
+                return batch
+        if timeout and time.time() - started > timeout:
+            raise TimeoutError(f"batch {batch_id} did not reach {statuses} within {timeout} seconds")
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+from urllib.parse import urlparse
+
+from tqdm import tqdm
+
+from .batch_request_metrics import count
+
+DEFAULT_CACHE = "image_preflight.db"
+LOOKUP_CHUNK = 500 # Keeps each lookup under sqlite's limit on the number of query parameters.
+MAX_REPORTED = 1000 # Failed urls listed in the report, the counts cover all of them.
+STARTED_AT = time.time() # Tells the reports of this run apart from the ones an earlier run left in the report file.
+PREFLIGHT_DEFAULTS = {
+    "concurrency": 64, # urls checked at once
+    "per_host": 8, # urls checked at once on the same host
+    "timeout": 10,
+    "attempts": 2, # for timeouts, connection errors, 429s and 5xxs
+    "ttl_hours": 24, # how long a url that worked is trusted
+    "failed_ttl_hours": 1, # how long a url that failed is not checked again
+    "require_image": True, # fail urls that answer with a content type that is not an image, such as a login page
+    "on_failure": "quarantine", # quarantine, drop or keep
+    "cache": DEFAULT_CACHE,
+    "quarantine_file": "image_preflight_quarantine.jsonl",
+    "report_file": "image_preflight_report.json",
+}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+_report_lock = threading.Lock() # Steps of jobs run side by side by the job server can write their reports at the same time.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checks (
+    url TEXT PRIMARY KEY,
+    ok INTEGER NOT NULL,
+    status INTEGER,
+    content_type TEXT,
+    error TEXT,
+    checked_at REAL NOT NULL
+);
+"""
+
+# The api only fetches the image of a request once the batch runs, so a url that is dead or private fails its row hours after it
+# was sent. Before the batch files are written, every unique image url of a step is checked from here instead, many at once with
+# a limit on each host, and the records whose image cannot be fetched are left out of the step and written to a quarantine file.
+# Results are kept in a local database for a while, so the later steps over the same images do not check them again.
+
+def get_preflight_settings(config_data: dict, step: str) -> dict:
+    # image_preflight can be set for all steps at the top of the config and changed under a single step, where false turns it off.
+    # Returns None when the step does not check its images.
+    top = config_data.get("image_preflight")
+    step_settings = config_data.get(step, {}).get("image_preflight", top)
+    if not step_settings:
+        return None
+    settings = dict(PREFLIGHT_DEFAULTS)
+    for layer in (top, step_settings):
+        if isinstance(layer, dict):
+            settings.update(layer)
+    if settings["on_failure"] not in ("quarantine", "drop", "keep"):
+        raise ValueError("image_preflight on_failure has to be quarantine, drop or keep")
+    if config_data.get("job_dir"):
+        # Set by the job server, so that every job keeps its quarantine and report in its own directory.
+        for key in ("quarantine_file", "report_file"):
+            if settings[key] and not os.path.isabs(settings[key]):
+                settings[key] = os.path.join(config_data["job_dir"], settings[key])
+    return settings
+
+class PreflightCache:
+    def __init__(self, db_path: str=DEFAULT_CACHE):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get_many(self, urls: List[str], ttl: float, failed_ttl: float) -> Dict[str, dict]:
+        # Results that worked are kept for ttl seconds, and results that failed for failed_ttl seconds.
+        now = time.time()
+        found = {}
+        with self.connection() as conn:
+            for i in range(0, len(urls), LOOKUP_CHUNK):
+                chunk = urls[i:i + LOOKUP_CHUNK]
+                placeholders = ', '.join('?' for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT url, ok, status, content_type, error, checked_at FROM checks WHERE url IN ({placeholders})", chunk
+                ).fetchall()
+                for url, ok, status, content_type, error, checked_at in rows:
+                    if checked_at >= now - (ttl if ok else failed_ttl):
+                        found[url] = {"ok": bool(ok), "status": status, "content_type": content_type, "error": error}
+        return found
+
+    def put_many(self, results: Dict[str, dict]) -> None:
+        now = time.time()
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO checks (url, ok, status, content_type, error, checked_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(url, int(result["ok"]), result["status"], result["content_type"], result["error"], now) for url, result in results.items()]
+            )
+
+def get_image_url(data: Dict[str, Any], skip: Callable[[Dict[str, Any]], bool]=None) -> str:
+    # The url of a record that is fetched by the api, None for records that are never made into requests and for images that are
+    # sent inline. skip picks out the records whose image is going to be sent inline from a local file.
+    url = data.get("image_url")
+    if not isinstance(url, str) or not url.startswith(("http://", "https://")) or (skip is not None and skip(data)):
+        return None
+    path = data.get("image_path") or ""
+    if 'mp4' in path or 'gif' in path or 'REMOVE_IMAGE' in data.get('generated_caption', ''):
+        return None
+    return url
+
+def import_httpx():
+    # httpx is installed with the openai client, which ships it as httpx2 in its newer releases.
+    try:
+        import httpx
+    except ImportError:
+        try:
+            import httpx2 as httpx
+        except ImportError:
+            raise ValueError("image_preflight needs httpx, which is installed with the openai client")
+    return httpx
+
+def make_result(status: int=None, content_type: str=None, error: str=None, require_image: bool=True) -> dict:
+    if error is None and status is not None and status >= 400:
+        error = f"http {status}"
+    if error is None and require_image and content_type and not content_type.startswith("image/"):
+        error = f"not an image ({content_type})"
+    return {"ok": error is None, "status": status, "content_type": content_type, "error": error}
+
+async def fetch_status(client, url: str):
+    # HEAD is enough for most hosts. Some answer HEAD with an error while serving GET, like signed urls that only allow GET,
+    # so any error but a missing file is asked again as a GET for the first byte, without reading the body.
+    response = await client.head(url)
+    if response.status_code < 400 or response.status_code in (404, 410):
+        return response.status_code, response.headers.get("content-type")
+    async with client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+        return response.status_code, response.headers.get("content-type")
+
+async def check_url(client, url: str, host_limit: asyncio.Semaphore, settings: dict) -> dict:
+    httpx = import_httpx()
+    result = None
+    async with host_limit:
+        for attempt in range(settings["attempts"]):
+            try:
+                status, content_type = await fetch_status(client, url)
+                content_type = content_type.split(";")[0].strip().lower() if content_type else None
+                result = make_result(status, content_type, require_image=settings["require_image"])
+                if status not in RETRY_STATUSES:
+                    return result
+            except httpx.TimeoutException:
+                result = make_result(error="timeout")
+            except httpx.HTTPError as e:
+                result = make_result(error=f"{type(e).__name__}: {e}"[:200])
+            await asyncio.sleep(min(10.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+    return result
+
+async def check_urls(urls: List[str], settings: dict) -> Dict[str, dict]:
+    # One pooled client for every check, with concurrency workers taking urls off a queue and each host held to per_host at once.
+    httpx = import_httpx()
+    concurrency = max(1, settings["concurrency"])
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    host_limits: Dict[str, asyncio.Semaphore] = {}
+    results = {}
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    progress = tqdm(total=len(urls), desc="Checking image urls")
+
+    async with httpx.AsyncClient(limits=limits, timeout=settings["timeout"], follow_redirects=True) as client:
+        async def worker():
+            while True:
+                url = await queue.get()
+                if url is None:
+                    return
+                host = urlparse(url).netloc
+                if host not in host_limits:
+                    host_limits[host] = asyncio.Semaphore(max(1, settings["per_host"]))
+                results[url] = await check_url(client, url, host_limits[host], settings)
+                progress.update(1)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(urls)))]
+        for url in urls:
+            await queue.put(url)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    progress.close()
+    return results
+
+def check_image_urls(records: Iterable[Dict[str, Any]], settings: dict, skip: Callable[[Dict[str, Any]], bool]=None) -> Dict[str, dict]:
+    # Returns url -> result for the image url of every record, checking only the urls that are not in the cache.
+    urls = list(dict.fromkeys(url for url in (get_image_url(data, skip) for data in records) if url))
+    cache = PreflightCache(settings["cache"])
+    results = cache.get_many(urls, settings["ttl_hours"] * 3600, settings["failed_ttl_hours"] * 3600)
+    unchecked = [url for url in urls if url not in results]
+    if unchecked:
+        checked = asyncio.run(check_urls(unchecked, settings))
+        cache.put_many(checked)
+        results.update(checked)
+    count("image_checks", len(urls) - len(unchecked), result="cached")
+    count("image_checks", sum(results[url]["ok"] for url in unchecked), result="ok")
+    count("image_checks", sum(not results[url]["ok"] for url in unchecked), result="failed")
+    print(f"checked {len(unchecked)} image urls, {len(urls) - len(unchecked)} from the cache, "
+          f"{sum(not result['ok'] for result in results.values())} of {len(urls)} cannot be fetched")
+    return results
+
+def filter_records(records: Iterable[Dict[str, Any]], results: Dict[str, dict], settings: dict, step: str,
+                   skip: Callable[[Dict[str, Any]], bool]=None) -> Iterator[Dict[str, Any]]:
+    # Yields the records whose image can be fetched, or every record with on_failure: keep. The records that are left out are
+    # written to the quarantine file with the reason under preflight_error, so they can be fixed and sent again.
+    # The report is written once the records run out.
+    report = new_report(step, results, settings)
+    quarantine = None
+    try:
+        for data in records:
+            url = get_image_url(data, skip)
+            result = results.get(url) if url else None
+            if result is None or result["ok"]:
+                yield data
+                continue
+            add_to_report(report, url, result)
+            if settings["on_failure"] == "keep":
+                yield data
+                continue
+            if settings["on_failure"] == "quarantine":
+                if quarantine is None:
+                    quarantine = open(settings["quarantine_file"], 'a', encoding='utf-8')
+                quarantine.write(json.dumps({**data, "preflight_error": result["error"]}) + '\n')
+            count("rows", kind="quarantined" if settings["on_failure"] == "quarantine" else "dropped")
+    finally:
+        if quarantine is not None:
+            quarantine.close()
+        if settings.get("report_file"):
+            write_report(report, settings["report_file"])
+
+def preflight_records(records: Iterable[Dict[str, Any]], settings: dict, step: str,
+                      skip: Callable[[Dict[str, Any]], bool]=None) -> Iterable[Dict[str, Any]]:
+    # Checks the image urls of the records and returns the records to make requests for, as a list when it was given a list so that
+    # they can still be rendered in parallel. records have to be read twice, so they cannot be a generator.
+    results = check_image_urls(records, settings, skip)
+    kept = filter_records(records, results, settings, step, skip)
+    return list(kept) if isinstance(records, list) else kept
+
+def new_report(step: str, results: Dict[str, dict], settings: dict) -> dict:
+    return {"step": step, "started_at": STARTED_AT, "urls": len(results), "failed_urls": sum(not result["ok"] for result in results.values()),
+            "records_left_out": 0, "on_failure": settings["on_failure"], "errors": Counter(), "hosts": Counter(), "failures": {}}
+
+def add_to_report(report: dict, url: str, result: dict) -> None:
+    if report["on_failure"] != "keep":
+        report["records_left_out"] += 1
+    if url in report["failures"]:
+        report["failures"][url]["records"] += 1
+        return
+    report["errors"][result["error"]] += 1
+    report["hosts"][urlparse(url).netloc] += 1
+    if len(report["failures"]) < MAX_REPORTED:
+        report["failures"][url] = {"error": result["error"], "status": result["status"], "records": 1}
+
+def write_report(report: dict, report_file: str) -> None:
+    # The reports of every check of a run are kept in the same file, one for each step, and a step that is checked several times,
+    # like a step of a pipeline that is sent in parts, adds up its counts.
+    with _report_lock:
+        merge_report(report, report_file)
+
+def merge_report(report: dict, report_file: str) -> None:
+    reports = {}
+    if os.path.exists(report_file):
+        try:
+            with open(report_file, 'r', encoding='utf-8') as f:
+                reports = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            reports = {}
+    previous = reports.get(report["step"])
+    if previous and previous.get("started_at") == report.get("started_at"):
+        report["urls"] += previous["urls"]
+        report["failed_urls"] += previous["failed_urls"]
+        report["records_left_out"] += previous["records_left_out"]
+        report["errors"] = Counter(previous["errors"]) + report["errors"]
+        report["hosts"] = Counter(previous["hosts"]) + report["hosts"]
+        report["failures"] = {**previous["failures"], **report["failures"]}
+    reports[report["step"]] = {**report, "errors": dict(report["errors"].most_common()), "hosts": dict(report["hosts"].most_common())}
+    tmp_file = f"{report_file}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(reports, f, indent=4)
+    os.replace(tmp_file, report_file)
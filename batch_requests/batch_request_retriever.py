@@ -1,25 +1,95 @@
-from openai import OpenAI
-import yaml
+from .batch_request_client import get_client
+from .batch_request_config import load_config
+from .batch_request_metrics import count, span
 import argparse
 import json
 import os
+from typing import Any, Iterable, Iterator, Set, Tuple, Union
+
+CHUNK_SIZE = 1024 * 1024
 
 def retrieve_requests(api_key: str, file_id: str=None):
-    client = OpenAI(api_key=api_key)
+    client = get_client(api_key)
 
     if not file_id:
         raise ValueError("Batch ID is required to retrieve the batch request.")
 
-    file_response = client.files.content(file_id)
-    
-    return file_response.text
+    with span("download"):
+        file_response = client.files.content(file_id)
+        text = file_response.text
+    count("api_calls", call="files.content")
+    count("bytes", len(file_response.content), kind="downloaded")
+
+    return text
+
+def get_spool_file(batch_file: str, file_id: str=None) -> str:
+    # Named after the output file it holds, so a spool file left behind by another run of the same batch file is never read in its place.
+    return batch_file.replace(".jsonl", f"_{file_id}_output.jsonl" if file_id else "_output.jsonl")
+
+def stream_requests(api_key: str, file_id: str=None, spool_file: str=None, chunk_size: int=CHUNK_SIZE) -> Iterator[bytes]:
+    # Yields the output file one line at a time as it is downloaded, so only a single chunk is held in memory.
+    # If a spool file is given, the download is also written to disk, and a finished spool file is read instead of downloading again.
+    if spool_file and os.path.exists(spool_file):
+        print(f"reading batch output from {spool_file}")
+        count("bytes", os.path.getsize(spool_file), kind="spooled")
+        with open(spool_file, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield line
+        return
 
-def parse_response(response_text: str):
-    parsed_outputs = {}
-    for line in response_text.splitlines():
+    if not file_id:
+        raise ValueError("Batch ID is required to retrieve the batch request.")
+
+    client = get_client(api_key)
+    spool = open(f"{spool_file}.tmp", 'wb') if spool_file else None
+    count("api_calls", call="files.content")
+    downloaded = 0
+    try:
+        with client.files.with_streaming_response.content(file_id) as response:
+            buffer = b""
+            for chunk in response.iter_bytes(chunk_size):
+                downloaded += len(chunk)
+                if spool:
+                    spool.write(chunk)
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield line
+            if buffer.strip():
+                yield buffer
+    finally:
+        count("bytes", downloaded, kind="downloaded")
+        if spool:
+            spool.close()
+
+    if spool:
+        # Only a complete download is kept, so a partial spool file is never mistaken for the whole output.
+        os.replace(f"{spool_file}.tmp", spool_file)
+
+def parse_message(message: str) -> Any:
+    # Most responses that are json come back as bare json, which is decoded as it is without copying the message first.
+    try:
+        return json.loads(message)
+    except json.JSONDecodeError:
+        pass
+    try:
+        clean_text = message.replace("```json", "").replace("```", "").replace("\n", "").strip()
+        return json.loads(clean_text)
+    except json.JSONDecodeError:
+        return message
+
+def iter_response_messages(lines: Iterable[Union[str, bytes]], failed: Set[str]=None) -> Iterator[Tuple[str, str]]:
+    # The custom_id of every row that failed or came back empty is added to failed, so that those rows can be sent again.
+    for line in lines:
         try:
             record = json.loads(line)
             custom_id = record.get("custom_id")
+            if record.get("error") or (record.get("response") or {}).get("status_code", 200) != 200:
+                if failed is not None:
+                    failed.add(custom_id)
+                continue
             message = (
                 record.get("response", {})
                     .get("body", {})
@@ -29,49 +99,75 @@ def parse_response(response_text: str):
             )
 
             if message is None:
+                if failed is not None:
+                    failed.add(custom_id)
                 continue
-            try:
-                clean_text = message.replace("```json", "").replace("```", "").replace("\n", "").strip()
-                parsed_outputs[custom_id] = json.loads(clean_text)
-            except json.JSONDecodeError:
-                parsed_outputs[custom_id] = message
+            yield custom_id, message
         except json.JSONDecodeError:
             print(f"Error decoding JSON for line: {line}")
-    
-    return parsed_outputs
 
-def handle_captions(input_data: dict, response_data: dict, response_key: str, data_key: str) -> dict:
-    for item in input_data:
-        image_path = item.get(data_key)
-        if image_path in response_data:
-            item[response_key] = response_data[image_path]
-    return input_data
+def iter_error_ids(lines: Iterable[Union[str, bytes]]) -> Iterator[str]:
+    # Rows in the error file of a batch have the same layout as the output file, with the reason under error or response.
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            print(f"Error decoding JSON for line: {line}")
+            continue
+        if record.get("custom_id"):
+            yield record["custom_id"]
 
-def handle_qna(input_data: dict, response_data: dict, response_key: str, data_key: str) -> dict:
+def iter_parse_response(lines: Iterable[Union[str, bytes]]) -> Iterator[Tuple[str, Any]]:
+    for custom_id, message in iter_response_messages(lines):
+        yield custom_id, parse_message(message)
+
+def parse_response(response_text: str):
+    with span("parse"):
+        return dict(iter_parse_response(response_text.splitlines()))
+
+def apply_caption(item: dict, response, response_key: str) -> None:
+    item[response_key] = response
 
+def apply_qna(item: dict, response, response_key: str) -> None:
     if 'question' in response_key:
         step_type = 'question'
     elif 'answer' in response_key:
         step_type = 'answer'
 
-    for item in input_data:
-        image_path = item.get(data_key)
-        if image_path in response_data:
-            current_qna = len(item.get('question_and_answers', []))  // 2
-            if 'dialogue_history' not in item:
-                item['dialogue_history'] = f"{step_type}_{current_qna}: {response_data[image_path]}\n"
-            else:
-                item['dialogue_history'] += f"{step_type}_{current_qna}: {response_data[image_path]}\n"
-            if 'question_and_answers' not in item:
-                item['question_and_answers'] = {f'{step_type}_{current_qna}': response_data[image_path]}
-            else:
-                item['question_and_answers'][f'{step_type}_{current_qna}'] = response_data[image_path]
+    current_qna = len(item.get('question_and_answers', []))  // 2
+    if 'dialogue_history' not in item:
+        item['dialogue_history'] = f"{step_type}_{current_qna}: {response}\n"
+    else:
+        item['dialogue_history'] += f"{step_type}_{current_qna}: {response}\n"
+    if 'question_and_answers' not in item:
+        item['question_and_answers'] = {f'{step_type}_{current_qna}': response}
+    else:
+        item['question_and_answers'][f'{step_type}_{current_qna}'] = response
+
+def get_response_handler(response_key: str):
+    if 'question' in response_key or 'answer' in response_key:
+        return apply_qna
+    return apply_caption
+
+def handle_captions(input_data: dict, response_data: dict, response_key: str, data_key: str) -> dict:
+    with span("merge"):
+        for item in input_data:
+            image_path = item.get(data_key)
+            if image_path in response_data:
+                apply_caption(item, response_data[image_path], response_key)
+    return input_data
+
+def handle_qna(input_data: dict, response_data: dict, response_key: str, data_key: str) -> dict:
+    with span("merge"):
+        for item in input_data:
+            image_path = item.get(data_key)
+            if image_path in response_data:
+                apply_qna(item, response_data[image_path], response_key)
     
     return input_data
             
 def main(config_path: str, file_id: str=None, input_file: str=None, output_file: str=None, response_key: str=None, data_key: str="image_path"):
-    with open(config_path, 'r') as config_file:
-        config = yaml.safe_load(config_file)
+    config = load_config(config_path)
 
     api_key = config.get('api_key')
     if not api_key:
@@ -95,7 +191,7 @@ def main(config_path: str, file_id: str=None, input_file: str=None, output_file:
     if output_file == None:
         output_file = input_file
 
-    with open(output_file, 'w') as f:
+    with span("write"), open(output_file, 'w') as f:
         json.dump(input_data, f, indent=4)
 
 if __name__ == "__main__":
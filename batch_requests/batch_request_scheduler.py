@@ -0,0 +1,455 @@
+import threading
+import time
+from concurrent import futures
+from typing import Callable, Dict, List, Set, Union
+
+from openai import APIStatusError, RateLimitError
+
+from .batch_request_client import get_client
+from .batch_request_estimator import estimate_batch_tokens
+from .batch_request_metrics import count, span
+from .batch_request_poller import ACTIVE_STATUSES, BatchPoller, get_done_count, record_batch_times
+from .batch_request_sender import BatchUploader, UploadIndex, send_requests
+from .batch_request_splitter import get_retry_attempt, split_batch_file
+from .batch_request_sync import SyncBatch, count_requests, send_sync_requests
+
+SHARED_WAIT = 10.0 # longest a scheduler with batches held back by SharedLimits sleeps before asking again
+STALE_WAIT = 3 * SHARED_WAIT # a scheduler that has not asked for a slot in this long is no longer waiting for one
+
+def get_api_keys(config_data: dict) -> Union[str, List[Dict]]:
+    # api_keys takes the place of api_key when there are several keys or projects to spread the batches over. Each entry is a key,
+    # or a key with its own weight, max_in_flight and max_enqueued_tokens.
+    api_keys = config_data.get("api_keys")
+    if not api_keys:
+        return config_data.get("api_key")
+    pool = []
+    for entry in api_keys:
+        entry = {"key": entry} if isinstance(entry, str) else dict(entry)
+        if not entry.get("key"):
+            raise ValueError("Every entry in api_keys needs a key")
+        pool.append(entry)
+    return pool
+
+# In-flight and enqueued token limits for each key shared by every scheduler in the process, so that the jobs run by the job server
+# are held to the quota of the key together rather than each on its own. Keys that are not in api_keys get max_in_flight and
+# max_enqueued_tokens. Free slots are shared out fairly: a scheduler only gets one when no other scheduler that is waiting for a slot
+# on the same key has fewer batches running on it, and out of the ones with as many running, the one that has waited longest goes first.
+class SharedLimits:
+    def __init__(self, max_in_flight: int=4, max_enqueued_tokens: int=None, api_keys: Union[str, List[Dict]]=None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_enqueued_tokens = max_enqueued_tokens
+        self.condition = threading.Condition()
+        self.keys: Dict[str, dict] = {} # api key -> its limits and the batches each scheduler has running on it
+        self.waiting: Dict[str, Dict[object, list]] = {} # api key -> scheduler -> [waiting since, last asked]
+        for entry in api_keys if isinstance(api_keys, list) else []:
+            self.add_key(entry)
+
+    def add_key(self, entry: Dict) -> dict:
+        max_in_flight = entry.get("max_in_flight")
+        self.keys[entry["key"]] = {
+            "name": entry.get("name") or f"key {len(self.keys) + 1}",
+            "max_in_flight": max(1, max_in_flight) if max_in_flight else self.max_in_flight,
+            "max_enqueued_tokens": entry.get("max_enqueued_tokens", self.max_enqueued_tokens),
+            "running": {} # scheduler -> {batch_file: estimated tokens}
+        }
+        return self.keys[entry["key"]]
+
+    def get_key(self, api_key: str) -> dict:
+        return self.keys.get(api_key) or self.add_key({"key": api_key})
+
+    def limits_tokens(self) -> bool:
+        return bool(self.max_enqueued_tokens) or any(state["max_enqueued_tokens"] for state in self.keys.values())
+
+    def fits(self, owner, api_key: str, tokens: int) -> bool:
+        # Called with the condition held. Asking for a slot is what marks owner as waiting for one.
+        state = self.get_key(api_key)
+        now = time.time()
+        waiting = self.waiting.setdefault(api_key, {})
+        since = waiting.setdefault(owner, [now, now])
+        since[1] = now
+
+        running = [batch_tokens for batches in state["running"].values() for batch_tokens in batches.values()]
+        if len(running) >= state["max_in_flight"]:
+            return False
+        if state["max_enqueued_tokens"] and running and sum(running) + tokens > state["max_enqueued_tokens"]:
+            return False
+        mine = (len(state["running"].get(owner, {})), since[0])
+        for other, (other_since, asked) in waiting.items():
+            if other is not owner and now - asked < STALE_WAIT and (len(state["running"].get(other, {})), other_since) < mine:
+                return False
+        return True
+
+    def allows(self, owner, api_key: str, tokens: int) -> bool:
+        with self.condition:
+            return self.fits(owner, api_key, tokens)
+
+    def reserve(self, owner, api_key: str, batch_file: str, tokens: int, force: bool=False) -> bool:
+        # Takes a slot for batch_file if it is still free. force is for batches that are already running, which count either way.
+        with self.condition:
+            if not force and not self.fits(owner, api_key, tokens):
+                return False
+            self.get_key(api_key)["running"].setdefault(owner, {})[batch_file] = tokens
+            self.stop_waiting(owner)
+            return True
+
+    def release(self, owner, api_key: str, batch_file: str) -> None:
+        with self.condition:
+            self.get_key(api_key)["running"].get(owner, {}).pop(batch_file, None)
+            self.condition.notify_all()
+
+    def stop_waiting(self, owner) -> None:
+        # The next time owner asks for a slot it waits at the back of the line again.
+        for waiting in self.waiting.values():
+            waiting.pop(owner, None)
+
+    def unregister(self, owner) -> None:
+        with self.condition:
+            for state in self.keys.values():
+                state["running"].pop(owner, None)
+            self.stop_waiting(owner)
+            self.condition.notify_all()
+
+    def wait(self, timeout: float) -> None:
+        # Sleeps until timeout or until any scheduler frees a slot, whichever comes first.
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def usage(self) -> List[Dict]:
+        with self.condition:
+            return [{"name": state["name"], "max_in_flight": state["max_in_flight"], "max_enqueued_tokens": state["max_enqueued_tokens"],
+                     "in_flight": sum(len(batches) for batches in state["running"].values()),
+                     "enqueued_tokens": sum(sum(batches.values()) for batches in state["running"].values()),
+                     "schedulers": sum(bool(batches) for batches in state["running"].values())}
+                    for state in self.keys.values()]
+
+# Keeps up to max_in_flight batches running at once. The next pending batch file is sent as soon as a slot frees up
+# and the enqueued token budget allows it, and on_completed is called as each batch finishes so results are merged straight away.
+# Batch files with fewer than sync_threshold requests skip the batch queue and are sent directly to the chat completions endpoint.
+#
+# api_key can also be a list of keys from get_api_keys, each with its own slots and token budget, which default to max_in_flight
+# and max_enqueued_tokens. Pending batch files are shared between the keys, and each one goes to the key with a free slot that has
+# the fewest batches running for its weight, so a key that is full or cooling down after a failure simply stops taking batches.
+#
+# uploads, from get_upload_settings, uploads the next few pending batch files in the background while the batches before them run,
+# each with the key it is expected to go out with, and that key is preferred when the batch is sent as long as it has room.
+#
+# Batches that expire or are cancelled still have an output file with every request that finished, so they are handed to
+# on_completed like a completed batch, which merges what is there and sends the rest again. With stall_timeout, a batch whose
+# request_counts have not moved for that many seconds is cancelled, and the requests it did not get to are split over stall_split
+# smaller batches by add_retry so that they can run side by side instead of waiting out the 24h window. A batch that has used up
+# max_retries is left to run, since the requests it did not get to could not be sent again.
+#
+# limits is a SharedLimits that the scheduler is held to on top of its own limits, when it is one of several jobs in the job server.
+class BatchScheduler:
+    def __init__(self, api_key: Union[str, List[Dict]], on_submitted: Callable=None, on_completed: Callable=None, on_failed: Callable=None,
+                 max_in_flight: int=4, max_enqueued_tokens: int=None, retry_delay: int=60, max_attempts: int=3, poller: BatchPoller=None,
+                 sync_threshold: int=0, sync_workers: int=16, uploads: dict=None, stall_timeout: float=None, stall_split: int=2,
+                 limits: SharedLimits=None, max_retries: int=None):
+        self.on_submitted = on_submitted
+        self.on_completed = on_completed
+        self.on_failed = on_failed
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_enqueued_tokens = max_enqueued_tokens
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.sync_threshold = sync_threshold
+        self.sync_workers = sync_workers
+        self.sync_executor = None
+        self.stall_timeout = stall_timeout
+        self.stall_split = stall_split
+        self.max_retries = max_retries
+        self.limits = limits
+        self.index = UploadIndex(uploads["index"]) if uploads and uploads.get("index") else None
+        self.upload_ahead = uploads.get("ahead", 0) if uploads else 0
+        self.uploader = BatchUploader(uploads.get("workers", 2), self.index) if self.upload_ahead else None
+
+        self.keys: Dict[str, dict] = {} # api key -> its limits, poller and cool down
+        for entry in api_key if isinstance(api_key, list) else [{"key": api_key}]:
+            self.add_key(entry)
+        self.api_key = next(iter(self.keys))
+        if poller is not None:
+            self.keys[self.api_key]["poller"] = poller
+        self.poller = self.keys[self.api_key]["poller"]
+
+        self.pending: List[str] = []
+        self.in_flight: Dict[str, str] = {} # batch_file -> batch_id
+        self.batch_files: Dict[str, str] = {} # batch_id -> batch_file
+        self.owners: Dict[str, str] = {} # batch_file -> api key it was sent with
+        self.tokens: Dict[str, int] = {} # batch_file -> estimated tokens
+        self.attempts: Dict[str, int] = {}
+        self.sync_in_flight: Dict[str, futures.Future] = {}
+        self.no_sync = set() # Batch files that failed to send directly and go through the batch queue instead.
+        self.progress: Dict[str, tuple] = {} # batch_file -> (requests done, when that number was first seen)
+        self.stalled: Set[str] = set() # Batch files that were cancelled for not making progress.
+
+    def add_key(self, entry: Dict) -> None:
+        max_in_flight = entry.get("max_in_flight")
+        self.keys[entry["key"]] = {
+            "name": entry.get("name") or f"key {len(self.keys) + 1}", # Printed instead of the key itself.
+            "weight": entry.get("weight") or 1,
+            "max_in_flight": max(1, max_in_flight) if max_in_flight else self.max_in_flight,
+            "max_enqueued_tokens": entry.get("max_enqueued_tokens", self.max_enqueued_tokens),
+            "poller": BatchPoller(entry["key"]),
+            "retry_after": 0.0
+        }
+
+    def add(self, batch_file: str, batch_id: str=None, tokens: int=None, api_key: str=None) -> None:
+        if tokens is not None:
+            self.tokens[batch_file] = tokens
+        if batch_id:
+            # Used when recovering, the batch has already been sent and only needs to be awaited with the key that sent it.
+            api_key = api_key or self.api_key
+            if api_key not in self.keys:
+                # A key that has since been taken out of the config still has to finish the batches it owns.
+                self.add_key({"key": api_key})
+            self.in_flight[batch_file] = batch_id
+            self.batch_files[batch_id] = batch_file
+            self.owners[batch_file] = api_key
+            self.keys[api_key]["poller"].watch(batch_id, delay=0)
+            self.tokens[batch_file] = self.estimate_tokens(batch_file)
+            if self.limits is not None:
+                self.limits.reserve(self, api_key, batch_file, self.tokens[batch_file], force=True)
+        else:
+            self.pending.append(batch_file)
+
+    def estimate_tokens(self, batch_file: str) -> int:
+        if batch_file not in self.tokens:
+            limited = any(state["max_enqueued_tokens"] for state in self.keys.values()) or (self.limits is not None and self.limits.limits_tokens())
+            self.tokens[batch_file] = estimate_batch_tokens(batch_file) if limited else 0
+        return self.tokens[batch_file]
+
+    def running(self, api_key: str) -> List[str]:
+        return [batch_file for batch_file in self.in_flight if self.owners.get(batch_file) == api_key]
+
+    def enqueued_tokens(self, api_key: str=None) -> int:
+        return sum(self.tokens.get(batch_file, 0) for batch_file in (self.running(api_key) if api_key else self.in_flight))
+
+    def has_capacity(self, batch_file: str, api_key: str=None) -> bool:
+        api_key = api_key or self.api_key
+        state = self.keys[api_key]
+        if time.time() < state["retry_after"]:
+            return False
+        running = self.running(api_key)
+        if len(running) >= state["max_in_flight"]:
+            return False
+        if self.limits is not None and not self.limits.allows(self, api_key, self.estimate_tokens(batch_file)):
+            return False
+        if not state["max_enqueued_tokens"] or not running:
+            # A batch that is over the budget by itself is still sent when nothing else is running, otherwise it would never be sent.
+            return True
+        return self.enqueued_tokens(api_key) + self.estimate_tokens(batch_file) <= state["max_enqueued_tokens"]
+
+    def pick_key(self, batch_file: str, preferred: str=None) -> str:
+        # The least loaded key for its weight out of the ones that can take the batch, or None if every key is full.
+        # preferred is the key that the batch file has already been uploaded with, which saves uploading it again.
+        if preferred in self.keys and self.has_capacity(batch_file, preferred):
+            return preferred
+        available = [api_key for api_key in self.keys if self.has_capacity(batch_file, api_key)]
+        if not available:
+            return None
+        return min(available, key=lambda api_key: len(self.running(api_key)) / self.keys[api_key]["weight"])
+
+    def prefetch_uploads(self) -> None:
+        # Each upload goes to the key with the fewest batches running or about to be sent for its weight.
+        if self.uploader is None:
+            return
+        ahead = [batch_file for batch_file in self.pending if not self.is_sync(batch_file)][:self.upload_ahead]
+        for batch_file in ahead:
+            if self.uploader.uploaded_with(batch_file) is None:
+                queued = [self.uploader.uploaded_with(f) for f in ahead]
+                api_key = min(self.keys, key=lambda api_key: (len(self.running(api_key)) + queued.count(api_key)) / self.keys[api_key]["weight"])
+                self.uploader.prefetch(api_key, batch_file)
+
+    def cool_down(self, api_key: str) -> None:
+        self.keys[api_key]["retry_after"] = time.time() + self.retry_delay
+
+    def is_sync(self, batch_file: str) -> bool:
+        return bool(self.sync_threshold) and batch_file not in self.no_sync and count_requests(batch_file) < self.sync_threshold
+
+    def send_sync(self, batch_file: str) -> None:
+        if self.sync_executor is None:
+            self.sync_executor = futures.ThreadPoolExecutor(max_workers=1)
+        # Direct requests are not held to the batch limits, so they only have to be spread over the keys by weight.
+        api_key = min(self.keys, key=lambda api_key: sum(self.owners.get(f) == api_key for f in self.sync_in_flight) / self.keys[api_key]["weight"])
+        print(f"sending {batch_file} directly...")
+        self.owners[batch_file] = api_key
+        self.sync_in_flight[batch_file] = self.sync_executor.submit(send_sync_requests, api_key, batch_file, self.sync_workers)
+        if self.on_submitted:
+            self.on_submitted(batch_file, SyncBatch(batch_file).id, api_key)
+
+    def finish_sync(self, batch_file: str, future: futures.Future) -> None:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"sending {batch_file} directly failed ({e}), sending it as a batch instead")
+            self.no_sync.add(batch_file)
+            self.pending.insert(0, batch_file)
+            return
+        if self.on_completed:
+            self.on_completed(batch_file, SyncBatch(batch_file), self.owners[batch_file])
+
+    def fill_slots(self) -> None:
+        if self.sync_threshold:
+            # Small batch files do not take up a batch slot, so they are sent straight away even if the queue is full.
+            for batch_file in [batch_file for batch_file in self.pending if self.is_sync(batch_file)]:
+                self.pending.remove(batch_file)
+                self.send_sync(batch_file)
+
+        while self.pending:
+            api_key = self.pick_key(self.pending[0], self.uploader.uploaded_with(self.pending[0]) if self.uploader else None)
+            if api_key is None:
+                break
+            if self.limits is not None and not self.limits.reserve(self, api_key, self.pending[0], self.estimate_tokens(self.pending[0])):
+                # Another job took the slot since it was checked.
+                break
+            batch_file = self.pending.pop(0)
+            print(f"sending batch request {batch_file} with {self.keys[api_key]['name']}...")
+            try:
+                if self.uploader is not None:
+                    batch = send_requests(api_key, batch_file, file_id=self.uploader.take(api_key, batch_file))
+                else:
+                    batch = send_requests(api_key, batch_file, index=self.index)
+            except RateLimitError as e:
+                # The key is over its quota of batches or tokens, so the batch waits for whichever key frees up first.
+                print(f"{self.keys[api_key]['name']} is over its quota ({e}), requeueing {batch_file}")
+                self.pending.insert(0, batch_file)
+                self.cool_down(api_key)
+                if self.limits is not None:
+                    self.limits.release(self, api_key, batch_file)
+                continue
+            self.in_flight[batch_file] = batch.id
+            self.batch_files[batch.id] = batch_file
+            self.owners[batch_file] = api_key
+            self.keys[api_key]["poller"].watch(batch.id)
+            if self.on_submitted:
+                self.on_submitted(batch_file, batch.id, api_key)
+        if self.limits is not None and not self.pending:
+            self.limits.stop_waiting(self)
+        self.prefetch_uploads()
+
+    def handle(self, batch) -> None:
+        batch_file = self.batch_files.get(batch.id)
+        if batch_file is None:
+            return
+        print(f"{batch_file} ({batch.id}) current status: {batch.status}")
+        if batch.status in ACTIVE_STATUSES:
+            self.check_stall(batch_file, batch)
+            return
+
+        api_key = self.owners[batch_file]
+        del self.in_flight[batch_file]
+        del self.batch_files[batch.id]
+        self.progress.pop(batch_file, None)
+        if self.limits is not None:
+            self.limits.release(self, api_key, batch_file)
+        record_batch_times(batch)
+        if batch.status == "completed":
+            if self.on_completed:
+                self.on_completed(batch_file, batch, api_key)
+        elif batch.status in ("expired", "cancelled") and self.on_completed:
+            counts = getattr(batch, "request_counts", None)
+            print(f"batch {batch_file} {batch.status} with {counts.completed if counts else 0} of {counts.total if counts else 0} requests completed, "
+                  "salvaging them")
+            count("batches", kind=batch.status)
+            self.on_completed(batch_file, batch, api_key)
+        elif batch.status == "failed" and self.attempts.get(batch_file, 0) + 1 < self.max_attempts:
+            # Batches generally fail at validation when the enqueued token limit is hit, so they are put back at the front of the queue
+            # and the key that sent them cools down. Any other key with room picks them up straight away.
+            self.attempts[batch_file] = self.attempts.get(batch_file, 0) + 1
+            print(f"batch {batch_file} failed, requeueing")
+            self.pending.insert(0, batch_file)
+            self.cool_down(api_key)
+        elif batch.status in ("failed", "expired", "cancelled"):
+            if self.on_failed:
+                self.on_failed(batch_file, batch, api_key)
+            else:
+                print(f"batch {batch_file} ended with status {batch.status}, skipping")
+        if self.uploader is not None and batch_file not in self.pending:
+            # A batch that is sent again keeps its upload.
+            self.uploader.done(batch_file)
+
+    def check_stall(self, batch_file: str, batch) -> None:
+        if not self.stall_timeout or batch.status != "in_progress" or batch_file in self.stalled:
+            return
+        if self.max_retries is not None and get_retry_attempt(batch_file) >= self.max_retries:
+            # The requests it has not got to could not be sent again, so cancelling it would only throw them away.
+            return
+        done, total = get_done_count(batch)
+        now = time.time()
+        last_done, since = self.progress.get(batch_file, (None, now))
+        if done != last_done:
+            self.progress[batch_file] = (done, now)
+            return
+        if now - since < self.stall_timeout:
+            return
+        print(f"batch {batch_file} has been stuck at {done} of {total} requests for {now - since:.0f}s, cancelling it")
+        try:
+            get_client(self.owners[batch_file]).batches.cancel(batch.id)
+        except APIStatusError as e:
+            # Generally a batch that finished in the meantime, it is given another stall_timeout before trying again.
+            print(f"could not cancel {batch_file} ({e})")
+            self.progress[batch_file] = (done, now)
+            return
+        finally:
+            count("api_calls", call="batches.cancel")
+        self.stalled.add(batch_file)
+
+    def add_retry(self, batch_file: str, retry_file: str) -> List[str]:
+        # Adds the batch file of the requests that batch_file did not answer, split up if batch_file was cancelled for stalling.
+        # Returns the batch files that were added.
+        if batch_file in self.stalled:
+            self.stalled.discard(batch_file)
+            retry_files = split_batch_file(retry_file, self.stall_split)
+        else:
+            retry_files = [retry_file]
+        for retry in retry_files:
+            self.add(retry)
+        return retry_files
+
+    def wait(self) -> None:
+        delays = [state["poller"].next_poll_in() for state in self.keys.values()]
+        delays = [delay for delay in delays if delay is not None]
+        if self.pending:
+            # Pending batches can go out as soon as a key is done cooling down after a failed batch.
+            now = time.time()
+            delays.extend(state["retry_after"] - now for state in self.keys.values() if state["retry_after"] > now)
+        delay = min(delays) if delays else None
+        if delay is None and self.pending:
+            delay = 0.0 if self.limits is None else SHARED_WAIT
+        if self.limits is not None and self.pending and delay is not None:
+            # Held back by the shared limits, so it asks again at least this often, and as soon as any job frees a slot.
+            delay = min(delay, SHARED_WAIT)
+
+        if self.sync_in_flight:
+            # Wakes up as soon as a direct send finishes instead of sleeping until the next batch is due.
+            with span("idle"):
+                done, _ = futures.wait(list(self.sync_in_flight.values()), timeout=delay, return_when=futures.FIRST_COMPLETED)
+            for batch_file, future in list(self.sync_in_flight.items()):
+                if future in done:
+                    del self.sync_in_flight[batch_file]
+                    self.finish_sync(batch_file, future)
+        elif delay:
+            with span("idle"):
+                if self.limits is not None:
+                    self.limits.wait(delay)
+                else:
+                    time.sleep(delay)
+
+        for state in list(self.keys.values()):
+            for batch in state["poller"].poll():
+                self.handle(batch)
+
+    def run(self) -> None:
+        try:
+            while self.pending or self.in_flight or self.sync_in_flight:
+                self.fill_slots()
+                self.wait()
+        finally:
+            # A job that stops partway gives its slots back to the other jobs, and is held to the limits again when it is recovered.
+            if self.limits is not None:
+                self.limits.unregister(self)
+        if self.sync_executor is not None:
+            self.sync_executor.shutdown()
+            self.sync_executor = None
+        if self.uploader is not None:
+            self.uploader.shutdown()
@@ -0,0 +1,158 @@
+import json
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+
+# A step can declare the json schema of its responses under response_schema. It is sent with every request of the step as a
+# strict response_format, so the model answers with bare json that fits it, and each response is decoded and checked against it
+# as it is retrieved instead of being cleaned up as text first. Only the responses that do not fit are repaired, and the ones
+# that cannot be repaired are sent again like rows that failed.
+
+def get_response_schema(config_data: dict, step: str) -> dict:
+    return config_data.get(step, {}).get("response_schema")
+
+def get_response_format(prompt: dict) -> Dict[str, Any]:
+    # The fields to add to the request body for a step prompt, nothing for steps without a response_schema.
+    schema = prompt.get("response_schema")
+    if not schema:
+        return {}
+    return {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": prompt.get("response_schema_name", "response"),
+                "strict": prompt.get("response_schema_strict", True),
+                "schema": schema
+            }
+        }
+    }
+
+def is_type(value: Any, name: str) -> bool:
+    if name == "object":
+        return isinstance(value, dict)
+    if name == "array":
+        return isinstance(value, list)
+    if name == "string":
+        return isinstance(value, str)
+    if name == "boolean":
+        return isinstance(value, bool)
+    if name == "null":
+        return value is None
+    if isinstance(value, bool):
+        return False
+    if name == "integer":
+        return isinstance(value, int) or (isinstance(value, float) and value.is_integer())
+    if name == "number":
+        return isinstance(value, (int, float))
+    raise ValueError(f"Unsupported type in response schema: {name}")
+
+def resolve_ref(root: dict, ref: str) -> dict:
+    if not ref.startswith("#/"):
+        raise ValueError(f"Only local references are supported in response schemas, got {ref}")
+    schema = root
+    for part in ref[2:].split("/"):
+        schema = schema[part.replace("~1", "/").replace("~0", "~")]
+    return schema
+
+def validate(value: Any, schema: dict, root: dict=None, path: str="$") -> List[str]:
+    # Returns what is wrong with value, empty when it fits. Covers the keywords that structured outputs accepts in a schema.
+    root = root if root is not None else schema
+    if "$ref" in schema:
+        schema = resolve_ref(root, schema["$ref"])
+    if "anyOf" in schema and all(validate(value, option, root, path) for option in schema["anyOf"]):
+        return [f"{path} does not match any schema in anyOf"]
+
+    types = schema.get("type")
+    if types is not None:
+        types = types if isinstance(types, list) else [types]
+        if not any(is_type(value, name) for name in types):
+            return [f"{path} is not {' or '.join(types)}"]
+    if "enum" in schema and value not in schema["enum"]:
+        return [f"{path} is not one of {schema['enum']}"]
+    if "const" in schema and value != schema["const"]:
+        return [f"{path} is not {schema['const']!r}"]
+
+    errors = []
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        additional = schema.get("additionalProperties", True)
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key} is missing")
+        for key, item in value.items():
+            if key in properties:
+                errors.extend(validate(item, properties[key], root, f"{path}.{key}"))
+            elif additional is False:
+                errors.append(f"{path}.{key} is not allowed")
+            elif isinstance(additional, dict):
+                errors.extend(validate(item, additional, root, f"{path}.{key}"))
+    elif isinstance(value, list):
+        if "items" in schema:
+            for i, item in enumerate(value):
+                errors.extend(validate(item, schema["items"], root, f"{path}[{i}]"))
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path} has fewer than {schema['minItems']} items")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            errors.append(f"{path} has more than {schema['maxItems']} items")
+    elif isinstance(value, str):
+        if "pattern" in schema and not re.search(schema["pattern"], value):
+            errors.append(f"{path} does not match {schema['pattern']}")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        if "minimum" in schema and value < schema["minimum"]:
+            errors.append(f"{path} is under {schema['minimum']}")
+        if "maximum" in schema and value > schema["maximum"]:
+            errors.append(f"{path} is over {schema['maximum']}")
+        if "exclusiveMinimum" in schema and value <= schema["exclusiveMinimum"]:
+            errors.append(f"{path} is not over {schema['exclusiveMinimum']}")
+        if "exclusiveMaximum" in schema and value >= schema["exclusiveMaximum"]:
+            errors.append(f"{path} is not under {schema['exclusiveMaximum']}")
+    return errors
+
+def repair_message(message: str) -> Any:
+    # Undoes what a model does when it ignores the schema: wrapping the json in a markdown fence, or writing text around it.
+    # Raises json.JSONDecodeError when there is no json to be found.
+    text = message.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else text[3:]
+        text = text.rsplit("```", 1)[0]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end < start:
+            raise
+        return json.loads(text[start:end + 1])
+
+def iter_structured_outputs(messages: Iterable[Tuple[str, str]], schema: dict, failed: Set[str]=None,
+                            counts: Counter=None) -> Iterator[Tuple[str, str, Any]]:
+    # Yields (custom_id, message, decoded value) for the responses that fit the schema, and counts how many were valid as they came,
+    # repaired or invalid. A repaired response is yielded as the json of its value, so it is cached the way it should have come back.
+    # The custom_id of every invalid response is added to failed, so that it is sent again.
+    counts = counts if counts is not None else Counter()
+    for custom_id, message in messages:
+        try:
+            value = json.loads(message)
+            if not validate(value, schema):
+                counts["valid"] += 1
+                yield custom_id, message, value
+                continue
+        except json.JSONDecodeError:
+            pass
+
+        try:
+            value = repair_message(message)
+            errors = validate(value, schema)
+        except json.JSONDecodeError:
+            errors = ["$ is not json"]
+        if errors:
+            counts["invalid"] += 1
+            if counts["invalid"] == 1:
+                print(f"response {custom_id} does not fit the response schema: {errors[0]}")
+            if failed is not None:
+                failed.add(custom_id)
+            continue
+        counts["repaired"] += 1
+        yield custom_id, json.dumps(value), value
+
+def format_validation_counts(counts: Counter) -> str:
+    return f"{counts['valid']} valid, {counts['repaired']} repaired, {counts['invalid']} invalid"
@@ -1,31 +1,178 @@
-from openai import OpenAI
-import yaml
+from .batch_request_client import get_client
+from .batch_request_config import load_config
+from .batch_request_metrics import count, span
+from concurrent import futures
+from typing import Dict, Tuple
 import argparse
+import hashlib
 import json
-from rich import print_json
+import os
+import sqlite3
+import threading
+import time
 
-def send_requests(api_key: str, input_file: str):
-    client = OpenAI(api_key=api_key)
+DEFAULT_INDEX = "upload_index.db"
+HASH_CHUNK = 1 << 20
+UPLOAD_DEFAULTS = {
+    "ahead": 4, # batch files uploaded ahead of their turn, 0 uploads each one when it is sent
+    "workers": 2,
+    "index": DEFAULT_INDEX, # false uploads every file again
+}
 
-    batch_input_file = client.files.create(
-        file = open(input_file, 'rb'),
-        purpose = 'batch'
-    )
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    key_id TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    uploaded_at REAL NOT NULL,
+    PRIMARY KEY (key_id, sha256)
+);
+"""
 
-    batch_input_file_id = batch_input_file.id
+def get_upload_settings(config_data: dict) -> dict:
+    # uploads: {ahead, workers, index} in the config, where false sends every batch file the way it used to, one upload at a time.
+    settings = config_data.get("uploads", True)
+    if not settings:
+        return None
+    return {**UPLOAD_DEFAULTS, **(settings if isinstance(settings, dict) else {})}
 
-    batch = client.batches.create(
-        input_file_id=batch_input_file_id,
-        endpoint="/v1/chat/completions",
-        completion_window="24h",
-    )
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
+def get_key_id(api_key: str) -> str:
+    # Files belong to the project of the key that uploaded them. The index keeps a hash of the key rather than the key itself.
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+# Local index of the batch files that have been uploaded, by the sha256 of their content and the key they were uploaded with.
+# A batch file that is sent again, after a crash or because its batch failed, reuses the file that is already on the api
+# as long as the api still has it, instead of uploading the same bytes again.
+class UploadIndex:
+    def __init__(self, db_path: str=DEFAULT_INDEX):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key_id: str, digest: str) -> str:
+        with self.connection() as conn:
+            row = conn.execute("SELECT file_id FROM uploads WHERE key_id = ? AND sha256 = ?", (key_id, digest)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key_id: str, digest: str, size: int, file_id: str) -> None:
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO uploads (key_id, sha256, bytes, file_id, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                         (key_id, digest, size, file_id, time.time()))
+
+    def forget(self, key_id: str, digest: str) -> None:
+        with self.connection() as conn:
+            conn.execute("DELETE FROM uploads WHERE key_id = ? AND sha256 = ?", (key_id, digest))
+
+def file_exists(client, file_id: str) -> bool:
+    from openai import NotFoundError
+    try:
+        file = client.files.retrieve(file_id)
+    except NotFoundError:
+        return False
+    finally:
+        count("api_calls", call="files.retrieve")
+    return getattr(file, "status", None) not in ("error", "deleted")
+
+def upload_requests(api_key: str, input_file: str, index: UploadIndex=None) -> str:
+    # Returns the id of the uploaded batch file. The file is streamed from disk rather than read into memory.
+    client = get_client(api_key)
+    if index is not None:
+        key_id = get_key_id(api_key)
+        digest = hash_file(input_file)
+        file_id = index.get(key_id, digest)
+        if file_id and file_exists(client, file_id):
+            print(f"{input_file} was already uploaded as {file_id}, reusing it")
+            count("uploads", kind="reused")
+            return file_id
+        if file_id:
+            index.forget(key_id, digest)
+
+    with span("upload"), open(input_file, 'rb') as f:
+        batch_input_file = client.files.create(
+            file = f,
+            purpose = 'batch'
+        )
+    size = os.path.getsize(input_file)
+    count("api_calls", call="files.create")
+    count("uploads", kind="uploaded")
+    count("bytes", size, kind="uploaded")
+
+    if index is not None:
+        index.put(key_id, digest, size, batch_input_file.id)
+    return batch_input_file.id
+
+def create_batch(api_key: str, file_id: str):
+    client = get_client(api_key)
+    with span("create"):
+        batch = client.batches.create(
+            input_file_id=file_id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+    count("api_calls", call="batches.create")
     return batch
 
+def send_requests(api_key: str, input_file: str, file_id: str=None, index: UploadIndex=None):
+    # file_id is the batch file when it has already been uploaded.
+    return create_batch(api_key, file_id or upload_requests(api_key, input_file, index))
+
+# Uploads batch files in a pool of background threads ahead of their turn, so that the next few files are already on the api
+# by the time a slot frees up for them and only the batch itself has to be created.
+# An upload belongs to the key it was made with, and is kept until done is called so that a batch that is sent again after
+# a rate limit or a failed validation does not upload its file again.
+class BatchUploader:
+    def __init__(self, workers: int=2, index: UploadIndex=None):
+        self.index = index
+        self.executor = futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="upload")
+        self.uploads: Dict[Tuple[str, str], futures.Future] = {} # (api key, batch file) -> future of its file id
+
+    def prefetch(self, api_key: str, batch_file: str) -> None:
+        if (api_key, batch_file) not in self.uploads:
+            self.uploads[(api_key, batch_file)] = self.executor.submit(upload_requests, api_key, batch_file, self.index)
+
+    def uploaded_with(self, batch_file: str) -> str:
+        # The key that batch_file has been or is being uploaded with, if any.
+        return next((api_key for api_key, uploaded in self.uploads if uploaded == batch_file), None)
+
+    def take(self, api_key: str, batch_file: str) -> str:
+        # Waits for the upload to finish if it is still running, and uploads the file now if it was never started.
+        self.prefetch(api_key, batch_file)
+        future = self.uploads[(api_key, batch_file)]
+        if future.exception() is not None:
+            # Failed uploads are started over the next time the file is sent.
+            del self.uploads[(api_key, batch_file)]
+        return future.result()
+
+    def done(self, batch_file: str) -> None:
+        for key in [key for key in self.uploads if key[1] == batch_file]:
+            del self.uploads[key]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.uploads.clear()
+
 def main(config: str, input_file: str):
-    with open(config, 'r') as file:
-        config_data = yaml.safe_load(file)
-    
+    from rich import print_json
+    config_data = load_config(config)
+
     api_key = config_data.get('api_key')
     if not api_key:
         raise ValueError("API key is required in the configuration file.")
@@ -2,11 +2,23 @@ import json
 import argparse
 import os
 import math
+import re
+from typing import Iterable, List, Set, Tuple
+
+from .batch_request_estimator import estimate_cached_tokens, estimate_request_tokens
+from .batch_request_metrics import count, metrics_enabled, span
+
+# Limits of a single batch input file for the openAI batched api, with some headroom on the file size.
+MAX_BATCH_BYTES = 190 * 1000 * 1000
+MAX_BATCH_REQUESTS = 50000
 
 def split_jsonl_file(input_file: str, step: str):
     with open(input_file, 'r', encoding='utf-8') as infile:
         lines = infile.readlines()
     
+    if not lines:
+        return []
+
     print(len(lines))
     print(math.ceil(len(lines) / 1000))
 
@@ -31,37 +43,229 @@ def split_jsonl_file(input_file: str, step: str):
     return batches
 
 def split_jsonl_list(input_list: list, input_path: str, step: str) -> list:
-    lines = input_list
+    return split_jsonl_lines([json.dumps(request) for request in input_list], input_path, step)
 
-    print(len(lines))
-    print(math.ceil(len(lines) / 1000))
+def get_split_ranges(num_lines: int) -> List[Tuple[int, int]]:
+    # The (start, end) of the lines that go in each batch file of split_jsonl_lines, so a split can be checked before it is written.
+    if not num_lines:
+        return []
+    num_batches = math.ceil(num_lines / 1000)
+    batch_size = num_lines // num_batches
+    return [(i * batch_size, (i + 1) * batch_size if i < num_batches - 1 else num_lines) for i in range(num_batches)]
 
-    num_batches = math.ceil(len(lines) / 1000)
-    batch_size = len(lines) // num_batches
+def split_jsonl_lines(lines: List[str], input_path: str, step: str, tokens: List[int]=None, stats: List[dict]=None) -> list:
+    # Same as split_jsonl_list for requests that are already serialized. With the estimated tokens of each request,
+    # the share of them that can come from the prompt cache is printed for each batch, and stats is filled with the same
+    # stats for each batch file as pack_jsonl_lines returns.
+    if not lines:
+        return []
 
-    batches = []
+    with span("split", step=step):
+        ranges = get_split_ranges(len(lines))
+        print(len(lines))
+        print(len(ranges))
+
+        batches = []
+
+        if not input_path:
+            input_path = "."
+
+        for i, (start, end) in enumerate(ranges):
+            request_batch = lines[start:end]
+            batch_file = f"{input_path}/batch_{step}_{i + 1}.jsonl"
+            with open(batch_file, 'w') as f:
+                for request in request_batch:
+                    f.write(request + '\n')
+            if tokens is not None:
+                batch_tokens = sum(tokens[start:end])
+                cached_tokens = sum(min(tokens[j], estimate_cached_tokens(lines[j - 1] if j > start else None, lines[j])) for j in range(start, end))
+                print(f"Batch {i + 1} written to {batch_file} (~{batch_tokens} tokens, {format_cached_share(cached_tokens, batch_tokens)})")
+                if stats is not None:
+                    stats.append({"batch_file": batch_file, "requests": end - start, "bytes": sum(len(line.encode('utf-8')) + 1 for line in request_batch),
+                                  "tokens": batch_tokens, "cached_tokens": cached_tokens})
+            else:
+                print(f"Batch {i + 1} written to {batch_file}")
+            batches.append(batch_file)
+        count("rows", len(lines), kind="requests", step=step)
+        if tokens is not None and metrics_enabled():
+            count("tokens", sum(tokens), kind="estimated", step=step)
 
+    return batches
+
+def format_cached_share(cached_tokens: int, tokens: int) -> str:
+    return f"~{cached_tokens} cached and ~{tokens - cached_tokens} uncached, {cached_tokens / tokens if tokens else 0:.0%} from the prompt cache"
+
+def describe_batch(current: dict) -> str:
+    return (f"{current['batch_file']} ({current['requests']} requests, {current['bytes']} bytes, ~{current['tokens']} tokens, "
+            f"{format_cached_share(current['cached_tokens'], current['tokens'])})")
+
+def pack_jsonl_lines(lines: Iterable[Tuple[str, int]], input_path: str, step: str, max_bytes: int=MAX_BATCH_BYTES,
+                     max_requests: int=MAX_BATCH_REQUESTS, max_tokens: int=None, start: int=1) -> Tuple[List[str], List[dict]]:
+    # Fills each batch file until the next request would go over any of the limits, writing every request as it comes in
+    # so that only the current line is held in memory. Takes (serialized request, estimated tokens) pairs.
+    # The tokens that each request shares with the one before it are counted as cached, since the provider caches the prompt prefix.
     if not input_path:
         input_path = "."
 
-    for i in range(num_batches):
-        start = i * batch_size
-        end = (i + 1) * batch_size if i < num_batches - 1 else len(lines)
-        request_batch = lines[start:end]
-        batch_file = f"{input_path}/batch_{step}_{i + 1}.jsonl"
-        with open(batch_file, 'w') as f:
-            for request in request_batch:
-                f.write(json.dumps(request) + '\n')
-        print(f"Batch {i + 1} written to {batch_file}")
-        batches.append(batch_file)
+    with span("split", step=step):
+        batches = []
+        stats = []
+        f = None
+        current = None
+        previous_line = None
 
-    return batches
+        for line, tokens in lines:
+            line_bytes = len(line.encode('utf-8')) + 1
+            if current is not None and (
+                current["requests"] + 1 > max_requests
+                or current["bytes"] + line_bytes > max_bytes
+                or (max_tokens and current["tokens"] + tokens > max_tokens)
+            ):
+                f.close()
+                print(f"Batch {start + len(batches) - 1} written to {describe_batch(current)}")
+                current = None
+                previous_line = None
+
+            if current is None:
+                batch_file = f"{input_path}/batch_{step}_{start + len(batches)}.jsonl"
+                f = open(batch_file, 'w', encoding='utf-8')
+                current = {"batch_file": batch_file, "requests": 0, "bytes": 0, "tokens": 0, "cached_tokens": 0}
+                batches.append(batch_file)
+                stats.append(current)
+
+            f.write(line + '\n')
+            current["requests"] += 1
+            current["bytes"] += line_bytes
+            current["tokens"] += tokens
+            current["cached_tokens"] += min(tokens, estimate_cached_tokens(previous_line, line))
+            previous_line = line
+
+        if f is not None:
+            f.close()
+            print(f"Batch {start + len(batches) - 1} written to {describe_batch(current)}")
+        count("rows", sum(current["requests"] for current in stats), kind="requests", step=step)
+        count("bytes", sum(current["bytes"] for current in stats), kind="batch_files", step=step)
+        count("tokens", sum(current["tokens"] for current in stats), kind="estimated", step=step)
+
+    return batches, stats
+
+def pack_jsonl_list(input_list: Iterable[dict], input_path: str, step: str, max_bytes: int=MAX_BATCH_BYTES,
+                    max_requests: int=MAX_BATCH_REQUESTS, max_tokens: int=None, start: int=1) -> Tuple[List[str], List[dict]]:
+    lines = ((json.dumps(request), estimate_request_tokens(request)) for request in input_list)
+    return pack_jsonl_lines(lines, input_path, step, max_bytes, max_requests, max_tokens, start)
+
+def pack_jsonl_file(input_file: str, step: str, max_bytes: int=MAX_BATCH_BYTES,
+                    max_requests: int=MAX_BATCH_REQUESTS, max_tokens: int=None) -> Tuple[List[str], List[dict]]:
+    with open(input_file, 'r', encoding='utf-8') as infile:
+        lines = (
+            (line.strip(), estimate_request_tokens(json.loads(line)))
+            for line in infile if line.strip()
+        )
+        return pack_jsonl_lines(lines, os.path.dirname(input_file), step, max_bytes, max_requests, max_tokens)
+
+def extract_jsonl_requests(input_file: str, custom_ids: Set[str], output_file: str) -> int:
+    # Copies the requests with the given custom_ids from a batch file into a new one without loading the whole file.
+    written = 0
+    with open(input_file, 'r', encoding='utf-8') as infile, open(output_file, 'w', encoding='utf-8') as outfile:
+        for line in infile:
+            if not line.strip():
+                continue
+            if json.loads(line).get("custom_id") in custom_ids:
+                outfile.write(line.strip() + '\n')
+                written += 1
+    return written
+
+def read_custom_ids(batch_file: str) -> Set[str]:
+    custom_ids = set()
+    if os.path.exists(batch_file):
+        with open(batch_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    custom_ids.add(json.loads(line)["custom_id"])
+    return custom_ids
+
+def split_batch_file(batch_file: str, parts: int) -> List[str]:
+    # Splits a batch file into parts with about the same number of requests each, and removes it. The parts are named so that
+    # the retry attempt of the file carries over, batch_1_retry1.jsonl becomes batch_1_part1_retry1.jsonl and so on.
+    with open(batch_file, 'rb') as f:
+        total = sum(1 for line in f if line.strip())
+    parts = min(parts, total)
+    if parts <= 1:
+        return [batch_file]
+
+    match = re.search(r"(_retry\d+)?\.jsonl$", batch_file)
+    stem, suffix = batch_file[:match.start()], batch_file[match.start():]
+    size = math.ceil(total / parts)
+    part_files = []
+    outfile = None
+    with open(batch_file, 'r', encoding='utf-8') as infile:
+        written = 0
+        for line in infile:
+            if not line.strip():
+                continue
+            if written % size == 0:
+                if outfile is not None:
+                    outfile.close()
+                part_files.append(f"{stem}_part{len(part_files) + 1}{suffix}")
+                outfile = open(part_files[-1], 'w', encoding='utf-8')
+            outfile.write(line.strip() + '\n')
+            written += 1
+    outfile.close()
+    os.remove(batch_file)
+    return part_files
+
+def get_batch_number(batch_file: str, step: str) -> int:
+    # The N of batch_{step}_N.jsonl, along with its parts and retries, or 0 for any other file.
+    match = re.search(rf"batch_{re.escape(step)}_(\d+)(_part\d+)?(_retry\d+)?\.jsonl$", os.path.basename(batch_file))
+    return int(match.group(1)) if match else 0
+
+def get_last_batch_number(input_path: str, step: str, batch_files: Iterable[str]=()) -> int:
+    # The highest batch file number of step that is taken, by the batch files given or by a file on disk, so that new batch files
+    # are numbered after it instead of writing over one of them.
+    names = list(batch_files)
+    if os.path.isdir(input_path or "."):
+        names.extend(os.listdir(input_path or "."))
+    return max((get_batch_number(name, step) for name in names), default=0)
+
+def get_retry_attempt(batch_file: str) -> int:
+    match = re.search(r"_retry(\d+)\.jsonl$", batch_file)
+    return int(match.group(1)) if match else 0
+
+def make_retry_batch(batch_file: str, custom_ids: Set[str], max_retries: int) -> str:
+    # Builds a batch file of only the failed requests, named after the original with the attempt number so that the count survives a recovery.
+    attempt = get_retry_attempt(batch_file) + 1
+    if not custom_ids or attempt > max_retries:
+        if custom_ids:
+            print(f"{len(custom_ids)} requests in {batch_file} failed after {max_retries} retries, giving up on them")
+        return None
+
+    original_file = re.sub(r"_retry\d+\.jsonl$", ".jsonl", batch_file)
+    retry_file = original_file.replace(".jsonl", f"_retry{attempt}.jsonl")
+    written = extract_jsonl_requests(batch_file, custom_ids, retry_file)
+    print(f"{written} failed requests from {batch_file} written to {retry_file}")
+    return retry_file if written else None
+
+def get_packing_limits(config_data: dict, step: str) -> dict:
+    # Limits can be set for all steps at the top of the config, or overridden under a single step.
+    step_config = config_data.get(step, {})
+    return {
+        "max_bytes": step_config.get("max_batch_bytes", config_data.get("max_batch_bytes", MAX_BATCH_BYTES)),
+        "max_requests": step_config.get("max_batch_requests", config_data.get("max_batch_requests", MAX_BATCH_REQUESTS)),
+        "max_tokens": step_config.get("max_batch_tokens", config_data.get("max_batch_tokens")),
+    }
 
 # Example usage
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Split a JSONL file into two parts.")
     parser.add_argument('--input_file', '-i', type=str, help='Path to the input JSONL file.')
     parser.add_argument('--step', '-s', type=str, help='Step name for the batch files.')
+    parser.add_argument('--pack', '-p', action='store_true', help='Fill each batch file up to the size, request and token limits instead of splitting every 1000 lines.')
+    parser.add_argument('--max_bytes', type=int, default=MAX_BATCH_BYTES, help='Maximum size of each batch file in bytes when packing.')
+    parser.add_argument('--max_requests', type=int, default=MAX_BATCH_REQUESTS, help='Maximum number of requests in each batch file when packing.')
+    parser.add_argument('--max_tokens', type=int, required=False, help='Maximum estimated tokens in each batch file when packing.')
 
     args = parser.parse_args()
-    split_jsonl_file(args.input_file, args.step)
+    if args.pack:
+        pack_jsonl_file(args.input_file, args.step, args.max_bytes, args.max_requests, args.max_tokens)
+    else:
+        split_jsonl_file(args.input_file, args.step)
@@ -0,0 +1,208 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+DEFAULT_DB = "batch_state.db"
+FIND_CHUNK = 500 # Batch ids looked up in one query, under the limit sqlite puts on the number of parameters.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    api_key TEXT,
+    input_file TEXT,
+    output_file TEXT,
+    step TEXT,
+    response_key TEXT,
+    data_key TEXT,
+    max_in_flight INTEGER,
+    max_enqueued_tokens INTEGER,
+    status TEXT NOT NULL DEFAULT 'running',
+    created_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS batch_files (
+    job_id INTEGER NOT NULL REFERENCES jobs (job_id),
+    batch_file TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    tokens INTEGER,
+    batch_id TEXT,
+    file_id TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, batch_file)
+);
+CREATE INDEX IF NOT EXISTS batch_files_by_status ON batch_files (job_id, status, position);
+CREATE INDEX IF NOT EXISTS batch_files_by_batch_id ON batch_files (batch_id);
+
+CREATE TABLE IF NOT EXISTS batch_events (
+    lsn INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL,
+    batch_file TEXT NOT NULL,
+    action TEXT NOT NULL,
+    batch_id TEXT,
+    file_id TEXT,
+    status TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS batch_events_by_file ON batch_events (job_id, batch_file, lsn);
+"""
+
+# The state of a batch file after each logged (action, status) pair. Anything that is not listed keeps its previous state.
+BATCH_STATES = {
+    ("send_batch_request", "starting"): "sending",
+    ("send_batch_request", "in_progress"): "in_progress",
+    ("send_batch_request", "failed"): "failed",
+    ("retrieving_batch_request", "starting"): "retrieving",
+    ("retrieving_batch_request", "completed"): "completed",
+}
+
+# Columns added after the first version of the schema, added to existing databases when they are opened.
+MIGRATIONS = [
+    ("jobs", "options", "TEXT"),
+    ("batch_files", "step", "TEXT"),
+    ("batch_files", "api_key", "TEXT"),
+]
+
+JOB_FIELDS = ("api_key", "input_file", "output_file", "step", "response_key", "data_key", "max_in_flight", "max_enqueued_tokens")
+
+# Job state that is shared between every batch of a job, stored in SQLite so that each log entry is a small transactional write
+# instead of a rewrite of the whole log. WAL mode lets batches that are running in parallel log from different threads and processes.
+class BatchStore:
+    def __init__(self, db_path: str=DEFAULT_DB):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+            for table, column, column_type in MIGRATIONS:
+                columns = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads, so each thread gets its own.
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def create_job(self, options: Dict=None, **fields) -> int:
+        # Anything that is not a column, such as flags that recovery needs to reuse, is kept as json under options.
+        values = {field: fields.get(field) for field in JOB_FIELDS}
+        values["options"] = json.dumps(options or {})
+        with self.connection() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO jobs ({', '.join(values)}, created_at) VALUES ({', '.join('?' for _ in values)}, ?)",
+                (*values.values(), time.time())
+            )
+        return cursor.lastrowid
+
+    def get_job(self, job_id: int=None) -> Dict:
+        conn = self.connection()
+        if job_id is None:
+            row = conn.execute("SELECT * FROM jobs ORDER BY job_id DESC LIMIT 1").fetchone()
+        else:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"] or "{}")
+        return job
+
+    def list_jobs(self, limit: int=10) -> List[Dict]:
+        # The most recent jobs first, each with the number of its batch files in every state.
+        conn = self.connection()
+        jobs = []
+        for row in conn.execute("SELECT * FROM jobs ORDER BY job_id DESC LIMIT ?", (limit,)).fetchall():
+            job = dict(row)
+            job["options"] = json.loads(job["options"] or "{}")
+            job["batch_counts"] = self.count_batch_files(job["job_id"])
+            jobs.append(job)
+        return jobs
+
+    def find_job(self, options: Dict) -> Dict:
+        # The most recent job whose options have all of the given values, however many jobs came after it.
+        conditions = " AND ".join("json_extract(options, ?) = ?" for _ in options)
+        params = [value for key, value in options.items() for value in (f"$.{key}", value)]
+        row = self.connection().execute(f"SELECT job_id FROM jobs WHERE {conditions} ORDER BY job_id DESC LIMIT 1", params).fetchone()
+        return self.get_job(row["job_id"]) if row else None
+
+    def count_batch_files(self, job_id: int) -> Dict[str, int]:
+        rows = self.connection().execute("SELECT status, COUNT(*) FROM batch_files WHERE job_id = ? GROUP BY status", (job_id,)).fetchall()
+        return {status: count for status, count in rows}
+
+    def set_job_status(self, job_id: int, status: str) -> None:
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET status = ? WHERE job_id = ?", (status, job_id))
+
+    def add_batch_files(self, job_id: int, batches: List[str], tokens: Dict[str, int]=None, step: str=None) -> None:
+        tokens = tokens or {}
+        now = time.time()
+        with self.connection() as conn:
+            start = conn.execute("SELECT COALESCE(MAX(position), 0) FROM batch_files WHERE job_id = ?", (job_id,)).fetchone()[0]
+            conn.executemany(
+                "INSERT OR IGNORE INTO batch_files (job_id, batch_file, position, tokens, step, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, batch_file, start + i + 1, tokens.get(batch_file), step, now) for i, batch_file in enumerate(batches)]
+            )
+
+    def log_event(self, job_id: int, action: str, batch_file: str, batch_id: str=None, file_id: str=None, status: str=None, api_key: str=None) -> int:
+        now = time.time()
+        state = BATCH_STATES.get((action, status))
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO batch_events (job_id, batch_file, action, batch_id, file_id, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, batch_file, action, batch_id, file_id, status, now)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO batch_files (job_id, batch_file, position, updated_at) "
+                "VALUES (?, ?, (SELECT COALESCE(MAX(position), 0) + 1 FROM batch_files WHERE job_id = ?), ?)",
+                (job_id, batch_file, job_id, now)
+            )
+            conn.execute(
+                "UPDATE batch_files SET batch_id = COALESCE(?, batch_id), file_id = COALESCE(?, file_id), "
+                "status = COALESCE(?, status), api_key = COALESCE(?, api_key), updated_at = ? WHERE job_id = ? AND batch_file = ?",
+                (batch_id, file_id, state, api_key, now, job_id, batch_file)
+            )
+        return cursor.lastrowid
+
+    def get_batch_files(self, job_id: int, statuses: List[str]=None) -> List[Dict]:
+        query = "SELECT * FROM batch_files WHERE job_id = ?"
+        params = [job_id]
+        if statuses:
+            query += f" AND status IN ({', '.join('?' for _ in statuses)})"
+            params.extend(statuses)
+        rows = self.connection().execute(query + " ORDER BY position", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def find_batch_files(self, batch_ids: List[str]) -> Dict[str, Dict]:
+        # batch_id -> the batch file that was sent as it, for the batches that were sent by a job in this store.
+        found = {}
+        conn = self.connection()
+        for start in range(0, len(batch_ids), FIND_CHUNK):
+            chunk = batch_ids[start:start + FIND_CHUNK]
+            for row in conn.execute(f"SELECT * FROM batch_files WHERE batch_id IN ({', '.join('?' for _ in chunk)})", chunk):
+                found[row["batch_id"]] = dict(row)
+        return found
+
+    def get_events(self, job_id: int, batch_file: str=None) -> List[Dict]:
+        query = "SELECT * FROM batch_events WHERE job_id = ?"
+        params = [job_id]
+        if batch_file:
+            query += " AND batch_file = ?"
+            params.append(batch_file)
+        rows = self.connection().execute(query + " ORDER BY lsn", params).fetchall()
+        return [dict(row) for row in rows]
+
+_stores: Dict[str, BatchStore] = {}
+_stores_lock = threading.Lock()
+
+def get_store(db_path: str=DEFAULT_DB) -> BatchStore:
+    with _stores_lock:
+        if db_path not in _stores:
+            _stores[db_path] = BatchStore(db_path)
+        return _stores[db_path]
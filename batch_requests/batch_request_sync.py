@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict
+
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
+
+from .batch_request_metrics import count, span
+from .batch_request_retriever import get_spool_file
+from .batch_request_sender import hash_file
+
+SYNC_PREFIX = "sync_"
+MAX_WORKERS = 16
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+def count_requests(batch_file: str) -> int:
+    with open(batch_file, 'rb') as f:
+        return sum(1 for line in f if line.strip())
+
+def get_sync_file_id(batch_file: str) -> str:
+    # Stands in for the output file id of a batch that was sent directly. It comes from the content of the batch file, so the responses
+    # are only reused for the exact requests they answer, not for a batch file of the same name from another run.
+    return f"{SYNC_PREFIX}{hash_file(batch_file)[:16]}"
+
+def get_retry_delay(error: Exception, attempt: int) -> float:
+    # Rate limit responses say how long to wait, otherwise back off exponentially with jitter.
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(MAX_DELAY, BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+async def send_request(client: AsyncOpenAI, request: Dict, state: Dict, max_attempts: int) -> Dict:
+    # Returns a row in the same layout as a batch output file, so the same parse and merge path can be used.
+    custom_id = request["custom_id"]
+    for attempt in range(max_attempts):
+        # Every worker waits out a rate limit that any of them hit, instead of each of them running into it.
+        pause = state["paused_until"] - time.time()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        try:
+            count("api_calls", call="chat.completions")
+            completion = await client.chat.completions.create(**request["body"])
+            return {
+                "id": completion.id,
+                "custom_id": custom_id,
+                "response": {"status_code": 200, "body": completion.model_dump()},
+                "error": None
+            }
+        except RateLimitError as e:
+            state["paused_until"] = max(state["paused_until"], time.time() + get_retry_delay(e, attempt))
+            error = e
+        except (APIConnectionError, APIStatusError) as e:
+            if isinstance(e, APIStatusError) and e.status_code < 500:
+                return {"custom_id": custom_id, "response": {"status_code": e.status_code, "body": None}, "error": {"message": str(e)}}
+            await asyncio.sleep(get_retry_delay(e, attempt))
+            error = e
+    return {"custom_id": custom_id, "response": None, "error": {"message": str(error)}}
+
+async def send_sync_batch(api_key: str, batch_file: str, output_file: str, max_workers: int, max_attempts: int) -> None:
+    client = AsyncOpenAI(api_key=api_key)
+    state = {"paused_until": 0.0}
+    queue = asyncio.Queue(maxsize=max_workers * 2)
+
+    try:
+        with open(f"{output_file}.tmp", 'w', encoding='utf-8') as out:
+            async def worker():
+                while True:
+                    request = await queue.get()
+                    if request is None:
+                        return
+                    # Anything send_request does not expect, such as a request the client refuses or a response it cannot dump, fails
+                    # only that request, which is then retried like any other failed one, so the rest of the queue is still drained.
+                    try:
+                        row = await send_request(client, request, state, max_attempts)
+                    except Exception as e:
+                        row = {"custom_id": request["custom_id"], "response": None, "error": {"message": f"{type(e).__name__}: {e}"}}
+                    out.write(json.dumps(row) + '\n')
+
+            async def produce():
+                with open(batch_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if line.strip():
+                            await queue.put(json.loads(line))
+                for _ in range(max_workers):
+                    await queue.put(None)
+
+            # Gathered together, so a worker that still fails, on a write for one, stops the send instead of leaving the producer
+            # waiting on a full queue.
+            tasks = [asyncio.create_task(produce())] + [asyncio.create_task(worker()) for _ in range(max_workers)]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+    finally:
+        await client.close()
+    os.replace(f"{output_file}.tmp", output_file)
+
+def send_sync_requests(api_key: str, batch_file: str, max_workers: int=MAX_WORKERS, max_attempts: int=MAX_ATTEMPTS) -> str:
+    # Sends the requests of a batch file straight to /v1/chat/completions, and writes the responses to the spool file of the batch
+    # so that they are read back the same way as a downloaded batch output.
+    output_file = get_spool_file(batch_file, get_sync_file_id(batch_file))
+    if os.path.exists(output_file):
+        print(f"{batch_file} was already sent directly, reusing {output_file}")
+        return output_file
+    started = time.time()
+    with span("sync_send"):
+        asyncio.run(send_sync_batch(api_key, batch_file, output_file, max_workers, max_attempts))
+    print(f"{batch_file} sent directly in {time.time() - started:.1f}s")
+    return output_file
+
+# Stands in for the openAI batch object of a batch that was sent directly, with its output already on disk.
+class SyncBatch:
+    def __init__(self, batch_file: str):
+        self.id = f"{SYNC_PREFIX}{os.path.basename(batch_file)}"
+        self.status = "completed"
+        self.output_file_id = get_sync_file_id(batch_file)
+        self.error_file_id = None
+        self.is_local = True
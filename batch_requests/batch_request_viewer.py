@@ -1,22 +1,174 @@
-from openai import OpenAI
-import yaml
+from .batch_request_client import get_client
+from .batch_request_config import load_config
+from .batch_request_poller import LIST_PAGE_SIZE, TERMINAL_STATUSES, BatchPoller, get_done_count
+from .batch_request_scheduler import get_api_keys
+from .batch_request_store import DEFAULT_DB, get_store
+from .batch_request_sync import SYNC_PREFIX
 import argparse
+import sys
+import time
+from typing import Dict, Iterator, List, Tuple
 
-def main(config_file: str, limit: int = 10):
-    with open(config_file, 'r') as file:
-        config_data = yaml.safe_load(file)
-    
-    api_key = config_data.get('api_key')
-    if not api_key:
+WATCH_INTERVAL = 30
+
+# A dashboard of the batches on the api, joined against the jobs in the local store so each batch shows the job and batch file it
+# was sent for. Batches are read a full page at a time, and the batches of a job are looked up in bulk through the poller.
+# --watch keeps one poller per api key and only fetches the batches that are still running, at the delay the poller picks for each,
+# so a refresh costs a page of the list for every 100 running batches instead of a call for every batch.
+
+def list_batches(api_key: str, limit: int=None, stats: dict=None) -> Iterator[object]:
+    # Yields the batches of a key newest first, up to limit, or all of them when there is no limit.
+    client = get_client(api_key)
+    page = client.batches.list(limit=min(limit, LIST_PAGE_SIZE) if limit else LIST_PAGE_SIZE)
+    count_call(stats)
+    seen = 0
+    while True:
+        for batch in page.data:
+            yield batch
+            seen += 1
+            if limit and seen >= limit:
+                return
+        if not page.has_next_page():
+            return
+        page = page.get_next_page()
+        count_call(stats)
+
+def count_call(stats: dict, calls: int=1) -> None:
+    if stats is not None:
+        stats["api_calls"] = stats.get("api_calls", 0) + calls
+
+def format_duration(seconds: float) -> str:
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+def get_progress(batch, now: float, previous: Tuple[int, float]=None) -> dict:
+    # previous is the (done, time) of the last time the batch was seen, which gives the current rate instead of the average
+    # since the batch started when it has moved on since.
+    done, total = get_done_count(batch)
+    finished_at = getattr(batch, f"{batch.status}_at", None) if batch.status in TERMINAL_STATUSES else None
+    elapsed = (finished_at or now) - batch.created_at
+    eta = None
+    if batch.status == "in_progress" and total and done < total:
+        if previous and done > previous[0] and now > previous[1]:
+            rate = (done - previous[0]) / (now - previous[1])
+        elif done and batch.in_progress_at:
+            rate = done / max(now - batch.in_progress_at, 1)
+        else:
+            rate = None
+        eta = (total - done) / rate if rate else None
+    failed = batch.request_counts.failed if batch.request_counts else 0
+    return {"done": done, "total": total, "failed": failed or 0, "elapsed": elapsed, "eta": eta}
+
+def format_row(batch, progress: dict, local: dict=None) -> str:
+    share = f"{progress['done'] / progress['total']:.0%}" if progress["total"] else "-"
+    where = f"job {local['job_id']} {local['batch_file']}" if local else "-"
+    return (f"{batch.id:>40} {batch.status:>11} {progress['done']:>7}/{progress['total']:<7} {share:>5} {progress['failed']:>6} "
+            f"{format_duration(progress['elapsed']):>8} {format_duration(progress['eta']):>8}  {where}")
+
+def render(batches: Dict[str, object], progress: Dict[str, dict], local: Dict[str, dict], statuses: List[str]=None, stats: dict=None) -> str:
+    lines = [f"{'batch':>40} {'status':>11} {'requests':>15} {'':>5} {'failed':>6} {'elapsed':>8} {'eta':>8}  local"]
+    counts = {}
+    for batch_id, batch in batches.items():
+        counts[batch.status] = counts.get(batch.status, 0) + 1
+        if not statuses or batch.status in statuses:
+            lines.append(format_row(batch, progress[batch_id], local.get(batch_id)))
+    done = sum(item["done"] for item in progress.values())
+    total = sum(item["total"] for item in progress.values())
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "no batches"
+    lines.append(f"{len(batches)} batches ({summary}), {done}/{total} requests done, {(stats or {}).get('api_calls', 0)} api calls")
+    return "\n".join(lines)
+
+def load_batches(api_keys: List[str], limit: int=None, job_id: int=None, db_path: str=DEFAULT_DB, stats: dict=None) -> Tuple[Dict[str, object], Dict[str, str]]:
+    # Returns batch_id -> batch, and batch_id -> the key it was read with. The batches of a job are fetched in bulk by their ids,
+    # with the key each one was sent with, and anything else is read from the list of every key.
+    batches = {}
+    owners = {}
+    if job_id is not None:
+        by_key: Dict[str, List[str]] = {}
+        for row in get_store(db_path).get_batch_files(job_id):
+            # Batch files that were sent directly never were batches on the api.
+            if row["batch_id"] and not row["batch_id"].startswith(SYNC_PREFIX):
+                by_key.setdefault(row["api_key"] or api_keys[0], []).append(row["batch_id"])
+        for api_key, batch_ids in by_key.items():
+            poller = BatchPoller(api_key)
+            batches.update(poller.fetch(batch_ids))
+            count_call(stats, poller.api_calls)
+            owners.update((batch_id, api_key) for batch_id in batch_ids)
+        return batches, owners
+
+    for api_key in api_keys:
+        for batch in list_batches(api_key, limit, stats):
+            batches[batch.id] = batch
+            owners[batch.id] = api_key
+    return batches, owners
+
+def watch(batches: Dict[str, object], owners: Dict[str, str], local: Dict[str, dict], interval: float=WATCH_INTERVAL, statuses: List[str]=None,
+          stats: dict=None) -> None:
+    # Refreshes until every batch is done. Only the batches that are still running are watched, by one poller for each key.
+    pollers = {api_key: BatchPoller(api_key, min_delay=interval) for api_key in set(owners.values())}
+    for batch_id, batch in batches.items():
+        if batch.status not in TERMINAL_STATUSES:
+            pollers[owners[batch_id]].watch(batch_id, delay=interval)
+    now = time.time()
+    seen = {batch_id: (get_done_count(batch)[0], now) for batch_id, batch in batches.items()}
+    progress = {batch_id: get_progress(batch, now) for batch_id, batch in batches.items()}
+    show(render(batches, progress, local, statuses, stats))
+
+    while any(poller.watched for poller in pollers.values()):
+        delays = [poller.next_poll_in() for poller in pollers.values() if poller.watched]
+        time.sleep(max(0.0, min(delays)))
+        updated = False
+        for poller in pollers.values():
+            calls = poller.api_calls
+            for batch in poller.poll(ahead=interval):
+                now = time.time()
+                progress[batch.id] = get_progress(batch, now, seen.get(batch.id))
+                seen[batch.id] = (progress[batch.id]["done"], now)
+                batches[batch.id] = batch
+                updated = True
+            count_call(stats, poller.api_calls - calls)
+        if updated:
+            show(render(batches, progress, local, statuses, stats))
+
+def show(text: str) -> None:
+    # Redraws in place on a terminal, and appends each refresh when the output goes to a file.
+    if sys.stdout.isatty():
+        sys.stdout.write("\033[2J\033[H")
+    print(text, flush=True)
+
+def main(config_file: str, limit: int = 10, job_id: int=None, statuses: List[str]=None, watch_batches: bool=False, interval: float=WATCH_INTERVAL,
+         db_path: str=DEFAULT_DB):
+    config_data = load_config(config_file)
+
+    api_keys = get_api_keys(config_data)
+    if not api_keys:
         raise ValueError("API key is required in the configuration file.")
-    
-    client = OpenAI(api_key=api_key)
+    api_keys = [entry["key"] for entry in api_keys] if isinstance(api_keys, list) else [api_keys]
 
-    client.batches.list(limit)
+    stats = {}
+    batches, owners = load_batches(api_keys, limit, job_id, db_path, stats)
+    local = get_store(db_path).find_batch_files(list(batches))
+    if watch_batches:
+        watch(batches, owners, local, interval, statuses, stats)
+    else:
+        now = time.time()
+        print(render(batches, {batch_id: get_progress(batch, now) for batch_id, batch in batches.items()}, local, statuses, stats))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="List batch requests for OpenAI API.")
     parser.add_argument('--config', '-c', type=str, required=True, help='Path to the configuration file.')
+    parser.add_argument('--limit', '-n', type=int, default=10, help='Number of the most recent batches to show for each key, 0 for all of them.')
+    parser.add_argument('--job_id', '-j', type=int, required=False, help='Only show the batches of this job from the local store.')
+    parser.add_argument('--status', '-s', type=str, nargs="+", required=False, help='Only show batches in these statuses.')
+    parser.add_argument('--watch', '-w', action='store_true', help='Keep refreshing the batches that are still running until they are all done.')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='Shortest time in seconds between checks on a running batch.')
+    parser.add_argument('--db', type=str, default=DEFAULT_DB, help='Path to the job store.')
 
     args = parser.parse_args()
-    main(args.config)
\ No newline at end of file
+    main(args.config, args.limit or None, args.job_id, args.status, args.watch, args.interval, args.db)
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Measures how long the cli takes to start for the quick subcommands, and which of the heavy dependencies each of them imports.
+# Every command is run in a fresh process --repeat times, against a job store with a few jobs in it. Run from the root of the repo with
+#   python -m benchmarks.import_times
+# Importing openai on its own and importing send_batch_request.py are timed as well, for the cost of what the quick commands skip.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("openai", "yaml", "rich", "tqdm", "tiktoken", "httpx")
+
+def make_store(db_path: str, jobs: int=5, batch_files: int=200) -> None:
+    sys.path.insert(0, REPO_ROOT)
+    from batch_requests.batch_request_store import BatchStore
+    store = BatchStore(db_path)
+    for i in range(jobs):
+        job_id = store.create_job(api_key="mock-key", input_file=f"data/input_{i}.json", output_file=f"data/input_{i}.json", step="clean_pii",
+                                  response_key="cleaned_caption", data_key="image_path")
+        store.add_batch_files(job_id, [f"data/batch_clean_pii_{n}.jsonl" for n in range(batch_files)])
+        for n in range(0, batch_files, 2):
+            store.log_event(job_id, "send_batch_request", f"data/batch_clean_pii_{n}.jsonl", batch_id=f"batch_{i}_{n}", status="in_progress")
+
+def get_commands(db_path: str) -> dict:
+    cli = [sys.executable, "-m", "batch_requests"]
+    return {
+        "cli --help": cli + ["--help"],
+        "cli status": cli + ["status", "--db", db_path],
+        "cli status -v": cli + ["status", "--db", db_path, "--verbose"],
+        "cli list": cli + ["list", "--db", db_path],
+        "import openai": [sys.executable, "-c", "import openai"],
+        "import send_batch_request": [sys.executable, "-c", "import send_batch_request"],
+    }
+
+def imported_modules(command: list) -> set:
+    # -X importtime writes every import to stderr as "import time: self | cumulative | name".
+    result = subprocess.run([command[0], "-X", "importtime"] + command[1:], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    names = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            names.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return names
+
+def time_command(command: list, repeat: int) -> list:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - started)
+    return times
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark how fast the batch_requests cli starts")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of times each command is run")
+    parser.add_argument("--output", "-o", type=str, required=False, help="Write the results to this json file")
+    parser.add_argument("--max_seconds", type=float, required=False, help="Exit with 1 if the median of a cli command is slower than this")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_imports_")
+    db_path = os.path.join(workdir, "batch_state.db")
+    make_store(db_path)
+
+    results = []
+    for name, command in get_commands(db_path).items():
+        times = time_command(command, args.repeat)
+        heavy = sorted(imported_modules(command) & set(HEAVY_MODULES))
+        results.append({"command": name, "min": min(times), "median": statistics.median(times), "heavy_imports": heavy})
+    subprocess.run(["rm", "-rf", workdir])
+
+    print(f"{'command':>26} {'min':>8} {'median':>8}  heavy imports")
+    for result in results:
+        print(f"{result['command']:>26} {result['min']:>8.3f} {result['median']:>8.3f}  {', '.join(result['heavy_imports']) or '-'}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.max_seconds:
+        slow = [result for result in results if result["command"].startswith("cli") and result["median"] > args.max_seconds]
+        for result in slow:
+            print(f"{result['command']} took {result['median']:.3f}s, over {args.max_seconds}s")
+        if slow:
+            sys.exit(1)
@@ -0,0 +1,416 @@
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for the files, batches and chat completions endpoints of the openAI api, so the scripts can be run end to end
+# without spending anything. Point the openai client at it with OPENAI_BASE_URL=http://<host>:<port>/v1.
+#
+# A batch goes through validating, in_progress and finalizing based on how long ago it was created, and its output and error
+# files are written when it is first seen as done. Failures are drawn from a seeded random generator so runs can be repeated.
+# GET /mock/stats returns the number of calls made to each endpoint, and POST /mock/reset clears them.
+#
+# /mock/images/<kind>/<name> stands in for the hosts that serve the image urls of a dataset, for the image pre-flight checks.
+# ok answers with a small jpeg, forbidden with a 403, missing with a 404, html with a login page, nohead refuses HEAD but serves
+# GET, and flaky answers with a 503 the first time each url is asked for. ?delay=<seconds> holds the answer back.
+
+class MockSettings:
+    def __init__(self, validation_latency: float=1.0, completion_latency: float=2.0, request_latency: float=0.0, finalize_latency: float=0.5,
+                 row_failure_rate: float=0.0, batch_failure_rate: float=0.0, expire_rate: float=0.0, response_chars: int=200, seed: int=0,
+                 max_active_batches: int=0, malformed_rate: float=0.0, upload_latency: float=0.0,
+                 stall_rate: float=0.0):
+        self.validation_latency = validation_latency
+        self.completion_latency = completion_latency
+        self.request_latency = request_latency # added to the completion latency for every request in the batch
+        self.finalize_latency = finalize_latency
+        self.row_failure_rate = row_failure_rate
+        self.batch_failure_rate = batch_failure_rate
+        self.expire_rate = expire_rate # expired batches only finish part of their requests, the rest go to the error file
+        self.response_chars = response_chars
+        self.seed = seed
+        self.max_active_batches = max_active_batches # batches each api key can have running before new ones get a 429, 0 for no limit
+        # structured responses that come back in a markdown fence or with a required field missing, half of each
+        self.malformed_rate = malformed_rate
+        self.upload_latency = upload_latency # seconds every file upload takes
+        self.stall_rate = stall_rate # stalled batches stop at half of their requests and stay in progress until they are cancelled
+
+class MockBatchApi:
+    def __init__(self, settings: MockSettings, data_dir: str=None):
+        self.settings = settings
+        self.data_dir = data_dir or tempfile.mkdtemp(prefix="mock_batch_api_")
+        self.random = random.Random(settings.seed)
+        self.files: Dict[str, dict] = {}
+        self.batches: Dict[str, dict] = {}
+        self.order = [] # batch ids, newest last
+        self.calls = Counter()
+        self.image_hits = Counter() # image url -> requests, for the flaky images
+        self.lock = threading.Lock()
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.data_dir, file_id)
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(self.file_path(file_id), 'wb') as f:
+            f.write(content)
+        file = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+        self.files[file_id] = file
+        return file
+
+    def create_batch(self, body: dict, api_key: str=None) -> dict:
+        input_file_id = body["input_file_id"]
+        if input_file_id not in self.files:
+            raise KeyError(input_file_id)
+        with open(self.file_path(input_file_id), 'rb') as f:
+            total = sum(1 for line in f if line.strip())
+
+        settings = self.settings
+        now = time.time()
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint", "/v1/chat/completions"),
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(now),
+            "in_progress_at": None,
+            "expires_at": int(now + 24 * 60 * 60),
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "metadata": body.get("metadata"),
+            # Not part of the api, dropped before the batch is returned.
+            "_created": now,
+            "_key": api_key,
+            "_run_time": settings.completion_latency + settings.request_latency * total,
+            "_fails": self.random.random() < settings.batch_failure_rate,
+            "_expires": self.random.random() < settings.expire_rate,
+            "_stalls": self.random.random() < settings.stall_rate,
+        }
+        self.order.append(batch_id)
+        return self.view(self.batches[batch_id])
+
+    def advance(self, batch: dict) -> None:
+        # Moves the batch to the status it should have by now.
+        if batch["status"] in ("completed", "failed", "expired", "cancelled"):
+            return
+        settings = self.settings
+        elapsed = time.time() - batch["_created"]
+        total = batch["request_counts"]["total"]
+        validated = settings.validation_latency
+        ran = validated + batch["_run_time"]
+
+        if batch["status"] == "cancelling":
+            self.finish(batch, "cancelled", batch["request_counts"]["completed"])
+        elif elapsed < validated:
+            batch["status"] = "validating"
+        elif batch["_fails"] or total == 0:
+            batch["status"] = "failed"
+            batch["failed_at"] = int(batch["_created"] + validated)
+            batch["errors"] = {"object": "list", "data": [{"code": "mock_failure", "message": "batch failed validation", "line": None, "param": None}]}
+        elif elapsed < ran or batch["_stalls"]:
+            batch["status"] = "in_progress"
+            batch["in_progress_at"] = batch["in_progress_at"] or int(batch["_created"] + validated)
+            batch["request_counts"]["completed"] = int(total * min(1, (elapsed - validated) / batch["_run_time"])) if batch["_run_time"] else total
+            if batch["_stalls"]:
+                batch["request_counts"]["completed"] = min(batch["request_counts"]["completed"], total // 2)
+        elif batch["_expires"]:
+            batch["in_progress_at"] = batch["in_progress_at"] or int(batch["_created"] + validated)
+            self.finish(batch, "expired", total // 2)
+        elif elapsed < ran + settings.finalize_latency:
+            batch["status"] = "finalizing"
+            batch["in_progress_at"] = batch["in_progress_at"] or int(batch["_created"] + validated)
+            batch["finalizing_at"] = int(batch["_created"] + ran)
+            batch["request_counts"]["completed"] = total
+        else:
+            # Like the api, the times of the statuses that the batch went through are kept even if it was never seen in them.
+            batch["in_progress_at"] = batch["in_progress_at"] or int(batch["_created"] + validated)
+            batch["finalizing_at"] = batch["finalizing_at"] or int(batch["_created"] + ran)
+            self.finish(batch, "completed", total)
+
+    def finish(self, batch: dict, status: str, done: int) -> None:
+        # Writes the output file for the first done requests and the error file for the rest and for the rows that failed.
+        settings = self.settings
+        output = []
+        errors = []
+        with open(self.file_path(batch["input_file_id"]), 'rb') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        for i, request in enumerate(requests):
+            custom_id = request.get("custom_id")
+            if i >= done:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": None,
+                               "error": {"code": "batch_expired" if status == "expired" else "batch_cancelled", "message": f"this request was not run, the batch {status}"}})
+            elif self.random.random() < settings.row_failure_rate:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id,
+                               "response": {"status_code": 500, "request_id": uuid.uuid4().hex, "body": {"error": {"message": "mock row failure", "type": "server_error"}}},
+                               "error": None})
+            else:
+                output.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id,
+                               "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self.completion(request.get("body", {}), custom_id)},
+                               "error": None})
+
+        if output:
+            batch["output_file_id"] = self.add_file(b"".join(json.dumps(row).encode() + b"\n" for row in output), f"{batch['id']}_output.jsonl", "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = self.add_file(b"".join(json.dumps(row).encode() + b"\n" for row in errors), f"{batch['id']}_error.jsonl", "batch_output")["id"]
+        now = int(time.time())
+        batch["status"] = status
+        batch[f"{status}_at"] = now
+        batch["request_counts"]["completed"] = len(output)
+        batch["request_counts"]["failed"] = len(errors)
+
+    def completion(self, body: dict, custom_id: str) -> dict:
+        text = f"mock response for {custom_id} "
+        content = (text * (self.settings.response_chars // len(text) + 1))[:self.settings.response_chars]
+        schema = body.get("response_format", {}).get("json_schema", {}).get("schema")
+        if schema:
+            value = make_instance(schema, content)
+            content = json.dumps(value)
+            if self.random.random() < self.settings.malformed_rate:
+                if self.random.random() < 0.5:
+                    content = f"```json\n{json.dumps(value, indent=2)}\n```"
+                elif isinstance(value, dict) and value:
+                    content = json.dumps(dict(list(value.items())[1:]))
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content, "refusal": None}, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        }
+
+    def view(self, batch: dict) -> dict:
+        return {key: value for key, value in batch.items() if not key.startswith("_")}
+
+    def active_batches(self, api_key: str) -> int:
+        active = 0
+        for batch in self.batches.values():
+            if batch["_key"] == api_key:
+                self.advance(batch)
+                active += batch["status"] not in ("completed", "failed", "expired", "cancelled")
+        return active
+
+    def image(self, method: str, path: str, query: dict) -> Tuple[int, str, bytes]:
+        # Answers outside of the lock, so that slow images do not hold up the rest of the api.
+        kind = path.split("/")[3] if path.count("/") >= 4 else ""
+        with self.lock:
+            self.calls[f"{method} /mock/images/{kind}"] += 1
+            self.image_hits[path] += 1
+            hits = self.image_hits[path]
+        delay = float(query.get("delay", ["0"])[0])
+        if delay:
+            time.sleep(delay)
+        if kind == "ok" or (kind == "nohead" and method == "GET") or (kind == "flaky" and hits > 1):
+            return 200, "image/jpeg", MOCK_JPEG
+        if kind == "nohead":
+            return 405, "text/plain", b"method not allowed"
+        if kind == "flaky":
+            return 503, "text/plain", b"service unavailable"
+        if kind == "forbidden":
+            return 403, "application/xml", b"<Error><Code>AccessDenied</Code></Error>"
+        if kind == "html":
+            return 200, "text/html; charset=utf-8", b"<html><body>please log in</body></html>"
+        return 404, "text/plain", b"not found"
+
+    def handle(self, method: str, path: str, query: dict, body: bytes, content_type: str, api_key: str=None) -> Tuple[int, object]:
+        if method == "POST" and path == "/v1/files" and self.settings.upload_latency:
+            time.sleep(self.settings.upload_latency)
+        with self.lock:
+            route = re.sub(r"/(file|batch)[-_][0-9a-f]+", r"/{\1}", path)
+            self.calls[f"{method} {route}"] += 1
+
+            if path == "/mock/stats":
+                return 200, dict(self.calls)
+            if path == "/mock/reset":
+                self.calls.clear()
+                return 200, {}
+
+            if method == "POST" and path == "/v1/files":
+                fields = parse_multipart(body, content_type)
+                content, filename = fields["file"]
+                return 200, self.add_file(content, filename or "upload.jsonl", fields.get("purpose", (b"batch", None))[0].decode())
+
+            match = re.fullmatch(r"/v1/files/(file-[0-9a-f]+)(/content)?", path)
+            if match and method == "GET":
+                file_id = match.group(1)
+                if file_id not in self.files:
+                    return 404, {"error": {"message": f"No such File object: {file_id}", "type": "invalid_request_error"}}
+                if match.group(2):
+                    with open(self.file_path(file_id), 'rb') as f:
+                        return 200, f.read()
+                return 200, self.files[file_id]
+
+            if method == "POST" and path == "/v1/batches":
+                if self.settings.max_active_batches and self.active_batches(api_key) >= self.settings.max_active_batches:
+                    return 429, {"error": {"message": "Too many active batches for this key", "type": "rate_limit_error"}}
+                try:
+                    return 200, self.create_batch(json.loads(body), api_key)
+                except KeyError as e:
+                    return 400, {"error": {"message": f"No such File object: {e}", "type": "invalid_request_error"}}
+
+            if method == "GET" and path == "/v1/batches":
+                limit = int(query.get("limit", ["20"])[0])
+                after = query.get("after", [None])[0]
+                ids = self.order[::-1]
+                if after in ids:
+                    ids = ids[ids.index(after) + 1:]
+                page = []
+                for batch_id in ids[:limit]:
+                    self.advance(self.batches[batch_id])
+                    page.append(self.view(self.batches[batch_id]))
+                return 200, {"object": "list", "data": page, "first_id": page[0]["id"] if page else None,
+                             "last_id": page[-1]["id"] if page else None, "has_more": len(ids) > limit}
+
+            match = re.fullmatch(r"/v1/batches/(batch_[0-9a-f]+)(/cancel)?", path)
+            if match:
+                batch = self.batches.get(match.group(1))
+                if batch is None:
+                    return 404, {"error": {"message": f"No such Batch object: {match.group(1)}", "type": "invalid_request_error"}}
+                if match.group(2) and method == "POST" and batch["status"] in ("validating", "in_progress", "finalizing"):
+                    self.advance(batch)
+                    batch["status"] = "cancelling"
+                    batch["cancelling_at"] = int(time.time())
+                    return 200, self.view(batch)
+                self.advance(batch)
+                return 200, self.view(batch)
+
+            if method == "POST" and path == "/v1/chat/completions":
+                request = json.loads(body)
+                if self.random.random() < self.settings.row_failure_rate:
+                    return 500, {"error": {"message": "mock failure", "type": "server_error"}}
+                return 200, self.completion(request, "direct request")
+
+            return 404, {"error": {"message": f"{method} {path} is not mocked", "type": "invalid_request_error"}}
+
+# The header and end markers of a jpeg, which is all that the checks look at.
+MOCK_JPEG = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xd9"
+
+def make_instance(schema: dict, text: str):
+    # The smallest value that fits a response schema, with text in its strings.
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "const" in schema:
+        return schema["const"]
+    if "anyOf" in schema:
+        return make_instance(schema["anyOf"][0], text)
+    kind = schema.get("type", "object")
+    kind = kind[0] if isinstance(kind, list) else kind
+    if kind == "object":
+        return {key: make_instance(schema.get("properties", {}).get(key, {}), text) for key in schema.get("required", schema.get("properties", {}))}
+    if kind == "array":
+        return [make_instance(schema.get("items", {}), text) for _ in range(schema.get("minItems", 0))]
+    if kind in ("integer", "number"):
+        return schema.get("minimum", 0)
+    if kind == "boolean":
+        return False
+    if kind == "null":
+        return None
+    return text
+
+def parse_multipart(body: bytes, content_type: str) -> Dict[str, Tuple[bytes, str]]:
+    # Returns each field of a multipart/form-data body as (content, filename).
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        headers, content = part.split(b"\r\n\r\n", 1)
+        name = re.search(rb'name="([^"]*)"', headers)
+        if name is None:
+            continue
+        filename = re.search(rb'filename="([^"]*)"', headers)
+        fields[name.group(1).decode()] = (content[:-2] if content.endswith(b"\r\n") else content, filename.group(1).decode() if filename else None)
+    return fields
+
+def make_handler(api: MockBatchApi):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def respond(self, method: str) -> None:
+            url = urlparse(self.path)
+            if url.path.startswith("/mock/images/"):
+                status, content_type, data = api.image(method, url.path, parse_qs(url.query))
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if method != "HEAD":
+                    self.wfile.write(data)
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            api_key = self.headers.get("Authorization", "").replace("Bearer ", "", 1) or None
+            status, payload = api.handle(method, url.path, parse_qs(url.query), body, self.headers.get("Content-Type", ""), api_key)
+            data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream" if isinstance(payload, bytes) else "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.respond("GET")
+
+        def do_POST(self):
+            self.respond("POST")
+
+        def do_HEAD(self):
+            self.respond("HEAD")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def start_server(settings: MockSettings, host: str="127.0.0.1", port: int=0, data_dir: str=None) -> ThreadingHTTPServer:
+    # Serves from a background thread, the address is in server.server_address.
+    server = ThreadingHTTPServer((host, port), make_handler(MockBatchApi(settings, data_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the openAI files and batches api")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--data_dir", type=str, required=False, help="Directory to keep uploaded and generated files in, defaults to a temporary directory")
+    parser.add_argument("--validation_latency", type=float, default=1.0, help="Seconds each batch spends validating")
+    parser.add_argument("--completion_latency", type=float, default=2.0, help="Seconds each batch spends in progress")
+    parser.add_argument("--request_latency", type=float, default=0.0, help="Seconds added to the time in progress for every request in a batch")
+    parser.add_argument("--finalize_latency", type=float, default=0.5, help="Seconds each batch spends finalizing")
+    parser.add_argument("--row_failure_rate", type=float, default=0.0, help="Fraction of requests that end up in the error file")
+    parser.add_argument("--batch_failure_rate", type=float, default=0.0, help="Fraction of batches that fail validation")
+    parser.add_argument("--expire_rate", type=float, default=0.0, help="Fraction of batches that expire with half of their requests done")
+    parser.add_argument("--response_chars", type=int, default=200, help="Length of every mocked response")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the injected failures")
+    parser.add_argument("--max_active_batches", type=int, default=0, help="Batches each api key can have running before it is refused with a 429")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="Fraction of structured responses that come back in a fence or missing a field")
+    parser.add_argument("--upload_latency", type=float, default=0.0, help="Seconds every file upload takes")
+    parser.add_argument("--stall_rate", type=float, default=0.0, help="Fraction of batches that stop at half of their requests until they are cancelled")
+    args = parser.parse_args()
+
+    settings = MockSettings(args.validation_latency, args.completion_latency, args.request_latency, args.finalize_latency,
+                            args.row_failure_rate, args.batch_failure_rate, args.expire_rate, args.response_chars, args.seed,
+                            args.max_active_batches, args.malformed_rate, args.upload_latency, args.stall_rate)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockBatchApi(settings, args.data_dir)))
+    print(f"mock batch api listening on http://{args.host}:{server.server_address[1]}/v1")
+    server.serve_forever()
@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import resource
+import runpy
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict
+
+from benchmarks.mock_batch_server import MockSettings, start_server
+
+# Runs send_batch_request.py and recover_batch_requests.py end to end against the mock batch api on synthetic datasets,
+# and reports the wall time, peak memory, api calls and the time spent making requests, splitting them into batch files,
+# merging the results and writing the output. Run from the root of the repo with
+#   python -m benchmarks.run_benchmarks --sizes 1000 10000 100000
+# Every run is its own process so that its peak memory is measured on its own.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(REPO_ROOT, "config", "gpt_captioning_config.yaml")
+PHASES = ("make", "split", "merge", "write")
+
+def make_dataset(path: str, size: int) -> None:
+    records = ({
+        "image_path": f"images/{i}.jpg",
+        "image_url": f"https://example.com/images/{i}.jpg",
+        "caption": f"Caption number {i} of a photo taken along Orchard Road by John Tan, contact 9123 4567."
+    } for i in range(size))
+    with open(path, 'w') as f:
+        if path.endswith(".jsonl"):
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        else:
+            json.dump(list(records), f)
+
+def make_config(path: str, base_config: str, overrides: dict) -> None:
+    import yaml
+    with open(base_config, 'r') as f:
+        config_data = yaml.safe_load(f)
+    config_data["api_key"] = "mock-key"
+    config_data.update(overrides)
+    with open(path, 'w') as f:
+        yaml.safe_dump(config_data, f)
+
+def timed(name: str, fn, timings: dict):
+    # Time spent pulling requests out of the maker while the batch files are written is counted as make, not as split.
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        made = timings["make"]
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[name] += time.perf_counter() - started - (timings["make"] - made if name != "make" else 0)
+    return wrapper
+
+def timed_lines(fn, timings: dict):
+    # The maker yields its requests lazily, so the time is taken on each of them as it is pulled.
+    def wrapper(*args, **kwargs):
+        lines = fn(*args, **kwargs)
+        def timed_iterator():
+            while True:
+                started = time.perf_counter()
+                try:
+                    line = next(lines)
+                except StopIteration:
+                    return
+                finally:
+                    timings["make"] += time.perf_counter() - started
+                yield line
+        return timed_iterator()
+    return wrapper
+
+def peak_rss_mb() -> float:
+    # ru_maxrss carries over the peak of the parent at the time it forked, which here is the benchmark holding the mock api,
+    # so the peak of this process alone is read from /proc where it is available.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_worker(mode: str, workdir: str, step: str, input_name: str) -> None:
+    # Runs inside the benchmarked process, with the phases wrapped in timers.
+    import send_batch_request
+    from batch_requests.batch_request_merger import ResultMerger
+
+    timings = defaultdict(float)
+    send_batch_request.make_request_lines = timed_lines(send_batch_request.make_request_lines, timings)
+    send_batch_request.split_jsonl_lines = timed("split", send_batch_request.split_jsonl_lines, timings)
+    send_batch_request.pack_jsonl_lines = timed("split", send_batch_request.pack_jsonl_lines, timings)
+    # Results are parsed as they stream in, so merge includes reading the batch outputs.
+    ResultMerger.apply = timed("merge", ResultMerger.apply, timings)
+    ResultMerger.compact = timed("write", ResultMerger.compact, timings)
+
+    started = time.perf_counter()
+    if mode == "send":
+        send_batch_request.make_and_send_batch_request(os.path.join(workdir, input_name), step, config_path=os.path.join(workdir, "config.yaml"))
+    else:
+        sys.argv = ["recover_batch_requests.py"]
+        runpy.run_path(os.path.join(REPO_ROOT, "recover_batch_requests.py"), run_name="__main__")
+    wall = time.perf_counter() - started
+
+    with open(os.path.join(workdir, f"timings_{mode}.json"), 'w') as f:
+        json.dump({
+            "wall": wall,
+            "peak_rss_mb": peak_rss_mb(),
+            **{phase: timings[phase] for phase in PHASES}
+        }, f)
+
+def api_stats(base_url: str, path: str) -> dict:
+    request = urllib.request.Request(base_url.replace("/v1", path), method="POST" if path.endswith("reset") else "GET", data=b"" if path.endswith("reset") else None)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def completed_fraction(workdir: str) -> float:
+    db_path = os.path.join(workdir, "batch_state.db")
+    if not os.path.exists(db_path):
+        return 0.0
+    try:
+        with sqlite3.connect(db_path, timeout=5) as conn:
+            total, completed = conn.execute("SELECT COUNT(*), SUM(status = 'completed') FROM batch_files").fetchone()
+    except sqlite3.OperationalError:
+        return 0.0
+    return (completed or 0) / total if total else 0.0
+
+def run_benchmark(size: int, step: str, base_url: str, base_config: str, overrides: dict, recover: bool, keep: bool, verbose: bool,
+                  input_name: str="input.json") -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"bench_{size}_")
+    make_dataset(os.path.join(workdir, input_name), size)
+    make_config(os.path.join(workdir, "config.yaml"), base_config, overrides)
+
+    env = dict(os.environ, OPENAI_BASE_URL=base_url, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    output = None if verbose else subprocess.DEVNULL
+    worker = [sys.executable, "-m", "benchmarks.run_benchmarks", "--worker", "--workdir", workdir, "--step", step, "--input_name", input_name]
+    result = {"size": size}
+
+    api_stats(base_url, "/mock/reset")
+    if recover:
+        # Kill the run once half of its batches are written, then time how long recovery takes to finish the job.
+        process = subprocess.Popen(worker + ["--mode", "send"], cwd=workdir, env=env, stdout=output, stderr=output)
+        while process.poll() is None and completed_fraction(workdir) < 0.5:
+            time.sleep(0.5)
+        if process.poll() is None:
+            process.send_signal(signal.SIGKILL)
+        process.wait()
+        api_stats(base_url, "/mock/reset")
+        subprocess.run(worker + ["--mode", "recover"], cwd=workdir, env=env, stdout=output, stderr=output, check=True)
+        with open(os.path.join(workdir, "timings_recover.json")) as f:
+            result.update(json.load(f))
+    else:
+        subprocess.run(worker + ["--mode", "send"], cwd=workdir, env=env, stdout=output, stderr=output, check=True)
+        with open(os.path.join(workdir, "timings_send.json")) as f:
+            result.update(json.load(f))
+
+    calls = api_stats(base_url, "/mock/stats")
+    calls.pop("GET /mock/stats", None)
+    calls.pop("POST /mock/reset", None)
+    result["api_calls"] = sum(calls.values())
+    result["api_calls_by_endpoint"] = calls
+    result["workdir"] = workdir if keep else None
+    if not keep:
+        subprocess.run(["rm", "-rf", workdir])
+    return result
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    # Returns a line for every measurement that got slower or bigger than the baseline by more than the tolerance.
+    regressions = []
+    previous = {(run["scenario"], run["size"]): run for run in baseline}
+    for run in results:
+        before = previous.get((run["scenario"], run["size"]))
+        if before is None:
+            continue
+        for metric in ("wall", "peak_rss_mb", "api_calls") + PHASES:
+            # Phases under a second are mostly noise.
+            if before.get(metric, 0) >= 1 and run[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{run['scenario']} {run['size']}: {metric} went from {before[metric]:.2f} to {run[metric]:.2f}")
+    return regressions
+
+def print_results(results: list) -> None:
+    columns = ("scenario", "size", "wall", "peak_rss_mb", "api_calls") + PHASES
+    print(" ".join(f"{column:>12}" for column in columns))
+    for run in results:
+        print(" ".join(f"{run[column]:>12.2f}" if isinstance(run[column], float) else f"{run[column]:>12}" for column in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the batch request scripts against a local mock of the batch api")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Number of records in each synthetic dataset")
+    parser.add_argument("--step", type=str, default="clean_pii", help="Step to run from the config")
+    parser.add_argument("--config", "-c", type=str, default=DEFAULT_CONFIG, help="Config to take the prompts and settings from")
+    parser.add_argument("--pack", "-p", action="store_true", help="Pack batch files instead of splitting every 1000 requests")
+    parser.add_argument("--recover", action="store_true", help="Also benchmark recovering a run that was killed halfway")
+    parser.add_argument("--jsonl", action="store_true", help="Use jsonl datasets, which are read lazily instead of loaded as a whole")
+    parser.add_argument("--output", "-o", type=str, required=False, help="Write the results to this json file")
+    parser.add_argument("--baseline", "-b", type=str, required=False, help="Results of an earlier run to compare against, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline, as a fraction")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory of each run")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Show the output of the benchmarked scripts")
+    parser.add_argument("--validation_latency", type=float, default=0.5)
+    parser.add_argument("--completion_latency", type=float, default=2.0)
+    parser.add_argument("--request_latency", type=float, default=0.0)
+    parser.add_argument("--row_failure_rate", type=float, default=0.0)
+    parser.add_argument("--batch_failure_rate", type=float, default=0.0)
+    parser.add_argument("--expire_rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    # Used by the benchmark itself to run each measured process.
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", type=str, default="send", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--input_name", type=str, default="input.json", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.mode, args.workdir, args.step, args.input_name)
+        sys.exit(0)
+
+    settings = MockSettings(validation_latency=args.validation_latency, completion_latency=args.completion_latency, request_latency=args.request_latency,
+                            finalize_latency=0.1, row_failure_rate=args.row_failure_rate, batch_failure_rate=args.batch_failure_rate,
+                            expire_rate=args.expire_rate, seed=args.seed)
+    server = start_server(settings)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    results = []
+    scenarios = ["send", "recover"] if args.recover else ["send"]
+    for size in args.sizes:
+        for scenario in scenarios:
+            print(f"running {scenario} on {size} records...")
+            run = run_benchmark(size, args.step, base_url, args.config, {"pack_batches": args.pack}, scenario == "recover", args.keep, args.verbose,
+                                "input.jsonl" if args.jsonl else "input.json")
+            results.append({"scenario": scenario, **run})
+    server.shutdown()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
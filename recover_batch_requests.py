@@ -1,60 +1,93 @@
-import json
+import argparse
 
-from send_batch_request import (
-    send_batch_request,
-    await_batch_request,
-    retrieve_batch_request
-)
-from batch_requests.batch_request_logger import log_batch_request
+from send_batch_request import run_batch_requests
+from send_pipeline import recover_pipeline
+from batch_requests.batch_request_cache import get_response_cache
+from batch_requests.batch_request_dataset import load_dataset
+from batch_requests.batch_request_metrics import enable_metrics, span, write_metrics
+from batch_requests.batch_request_scheduler import SharedLimits
+from batch_requests.batch_request_store import DEFAULT_DB, get_store
+from batch_requests.batch_request_sync import SYNC_PREFIX
 
-if __name__ == "__main__":
-    with open("batch_log.json", 'r') as f:
-        batch_log = json.load(f)
-    
-    with open("batch_queue_log.json", 'r') as f:
-        batch_queue_log = json.load(f)
-
-    api_key = batch_queue_log.get("api_key")
-    input_file = batch_queue_log.get("input_file")
-    output_file = batch_queue_log.get("output_file")
-    response_key = batch_queue_log.get("response_key")
-    data_key = batch_queue_log.get("data_key")
-    batches = batch_queue_log.get("batches")
-
-    with open(input_file, "r") as f:
-        input_data = json.load(f)
-
-    if batch_log:
-        last_action = batch_log[-1].get("action")
-        last_action_status = batch_log[-1].get("status")
+def recover_job(job_id: int=None, db_path: str=DEFAULT_DB, limits: SharedLimits=None, record_metrics: bool=True) -> None:
+    # Recovers the most recent job when no job_id is given. limits and record_metrics are for the job server, which recovers the jobs
+    # it was running when it stopped.
+    store = get_store(db_path)
+    job = store.get_job(job_id)
+    if job is None:
+        raise ValueError("No job was found to recover.")
+
+    if job["options"].get("pipeline"):
+        # Pipeline jobs work out which records are ready for each step from the replayed results, so they recover on their own.
+        recover_pipeline(job, db_path, limits, record_metrics)
     else:
-        last_action = None
-        last_action_status = None
-
-    if last_action == "send_batch_request" and last_action_status == "starting":
-        pass # should probably remove this log status as it should not be needed since the end result is the same either ways
-    elif last_action == "send_batch_request" and last_action_status == "in_progress":
-        current_batch = batches.pop(0)
-        batch_id = batch_log[-1].get("batch_id")
-        await_batch_request(api_key, current_batch, input_data, response_key, data_key, output_file, batch_id=batch_id)
-    elif last_action == "retrieving_batch_request" and last_action_status == "starting":
-        current_batch = batches.pop(0)
-        batch_id = batch_log[-1].get("batch_id")
-        file_id = batch_log[-1].get("file_id")
-        retrieve_batch_request(api_key, current_batch, input_data, response_key, data_key, output_file, batch_id, file_id)
-    elif last_action_status == "retrieving_batch_request" and last_action_status == "completed":
-        pass # No need to do anything more for this batch, just proceed to the remaining ones
-
-    while batches:
-        log_batch_request(batches)
-        batch = batches.pop(0)
-        send_batch_request(api_key=api_key, 
-                                         batch_file=batch,
-                                         input_data=input_data,
-                                         response_key=response_key,
-                                         data_key=data_key,
-                                         output_file=output_file
-                                        )
-
-    
-    
\ No newline at end of file
+        job_id = job["job_id"]
+        # Jobs that spread their batches over several keys keep the list in their options, and each batch remembers its own key.
+        api_key = job["options"].get("api_keys") or job["api_key"]
+        input_file = job["input_file"]
+        output_file = job["output_file"]
+        response_key = job["response_key"]
+        data_key = job["data_key"]
+
+        # Results are only written to the output file at the end of a run, so the input file is still the untouched dataset
+        # and the results merged before the crash are replayed from the partial file next to the output.
+        metrics = enable_metrics(job["options"], step=job["step"], input_file=input_file, job_id=job_id) if record_metrics else None
+        with span("load"):
+            input_data = load_dataset(input_file, data_key)
+
+        # Every batch file tracks its own state, so only the ones that have not been written yet are looked up.
+        batches = []
+        batch_tokens = {}
+        in_flight = {}
+        to_retrieve = {}
+        batch_keys = {}
+        for batch in store.get_batch_files(job_id, statuses=["pending", "sending", "failed", "in_progress", "retrieving"]):
+            batch_file = batch["batch_file"]
+            if batch["api_key"]:
+                batch_keys[batch_file] = batch["api_key"]
+            if batch["status"] == "in_progress" and not batch["batch_id"].startswith(SYNC_PREFIX):
+                in_flight[batch_file] = batch["batch_id"]
+            elif batch["status"] == "retrieving" and not batch["batch_id"].startswith(SYNC_PREFIX):
+                to_retrieve[batch_file] = batch["batch_id"]
+            else:
+                # Batches that were never sent, or that failed, are sent again.
+                # Batches that were being sent directly are picked up from their spool file if they had finished.
+                batches.append(batch_file)
+                if batch["tokens"] is not None:
+                    batch_tokens[batch_file] = batch["tokens"]
+
+        try:
+            run_batch_requests(api_key=api_key,
+                               batches=batches,
+                               input_data=input_data,
+                               response_key=response_key,
+                               data_key=data_key,
+                               output_file=output_file,
+                               max_in_flight=job["max_in_flight"] or 4,
+                               max_enqueued_tokens=job["max_enqueued_tokens"],
+                               in_flight=in_flight,
+                               batch_tokens=batch_tokens,
+                               job_id=job_id,
+                               to_retrieve=to_retrieve,
+                               resume=True,
+                               spool=job["options"].get("spool", False),
+                               cache=get_response_cache(job["options"]),
+                               max_retries=job["options"].get("max_retries", 2),
+                               sync_threshold=job["options"].get("sync_threshold", 0),
+                               sync_workers=job["options"].get("sync_workers", 16),
+                               batch_keys=batch_keys,
+                               schema=job["options"].get("response_schema"),
+                               uploads=job["options"].get("uploads"),
+                               stall_timeout=job["options"].get("stall_timeout"),
+                               stall_split=job["options"].get("stall_split", 2),
+                               limits=limits
+                              )
+        finally:
+            write_metrics(metrics)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recover a crashed batch request job")
+    parser.add_argument("--job_id", "-j", type=int, required=False, help="Job to recover, defaults to the most recent job")
+    args = parser.parse_args()
+
+    recover_job(args.job_id)
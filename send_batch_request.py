@@ -1,123 +1,302 @@
-from urllib import response
-import yaml
 import json
 import argparse
-import time
 import os
+from collections import Counter
+from typing import Dict, List, Union
 
+from batch_requests.batch_request_budget import get_budget, get_batch_token_cap, make_budget_report, print_budget_report, check_budget
+from batch_requests.batch_request_cache import ResponseCache, get_response_cache, cache_batch_responses
 from batch_requests.batch_request_checker import check_request
+from batch_requests.batch_request_config import load_config
+from batch_requests.batch_request_dataset import load_dataset
 from batch_requests.batch_request_logger import (
     create_log_files, 
     log_batch_request, 
-    log_response_history
+    log_response_history,
+    log_job_status
 )
-from batch_requests.batch_request_maker import make_requests
+from batch_requests.batch_request_maker import make_request_lines
+from batch_requests.batch_request_merger import ResultMerger
+from batch_requests.batch_request_metrics import count, enable_metrics, span, timed_iter, write_metrics
+from batch_requests.batch_request_poller import wait_for_batch
+from batch_requests.batch_request_scheduler import BatchScheduler, SharedLimits, get_api_keys
+from batch_requests.batch_request_schema import get_response_schema, iter_structured_outputs, format_validation_counts
 from batch_requests.batch_request_retriever import (
-    retrieve_requests,
-    parse_response,
-    handle_captions,
-    handle_qna
+    stream_requests,
+    iter_response_messages,
+    iter_error_ids,
+    parse_message,
+    get_spool_file
 )
-from batch_requests.batch_request_sender import send_requests
-from batch_requests.batch_request_splitter import split_jsonl_list
+from batch_requests.batch_request_sender import get_upload_settings, send_requests, upload_requests
+from batch_requests.batch_request_splitter import split_jsonl_lines, pack_jsonl_lines, get_split_ranges, get_packing_limits, make_retry_batch, read_custom_ids
 
-def send_batch_request(api_key: str, batch_file: str, input_data: dict, response_key: str, data_key: str, output_file: str):
-    log_response_history(action="send_batch_request",batch_file=batch_file ,batch_id=None, file_id=None, status="starting")
+def send_batch_request(api_key: str, batch_file: str, input_data: dict, response_key: str, data_key: str, output_file: str, job_id: int=None, max_attempts: int=3):
+    log_response_history(action="send_batch_request",batch_file=batch_file ,batch_id=None, file_id=None, status="starting", job_id=job_id)
 
     batch_id = None
-    while True:
+    # Uploaded once, every attempt creates its batch from the same file.
+    file_id = upload_requests(api_key, batch_file)
+    for attempt in range(max_attempts):
         print("sending batch request...")
-        batch = send_requests(api_key, batch_file)
-        time.sleep(60)
-        current_status = check_request(api_key, batch.id)
-        status = current_status.status
-        print(f"current status: {status}")
-        if status == "in_progress" or status == "completed" or status == "finalizing":
+        batch = send_requests(api_key, batch_file, file_id=file_id)
+        # Waits out validation, which is where batches fail when the enqueued token limit is hit.
+        batch = wait_for_batch(api_key, batch.id, statuses=("in_progress", "finalizing", "completed"))
+        if batch.status in ("in_progress", "finalizing", "completed"):
             batch_id = batch.id
             break
-        elif status == "validating":
-            # nested loop to keep checking if it has been validated.
-            for i in range(1000):
-                time.sleep(30)
-                current_status = check_request(api_key, batch.id)
-                status = current_status.status
-                print(f"current status: {status}")
-                if status == "in_progress" or status == "completed" or status == "finalizing":
-                    batch_id = batch.id
-                    break
-                elif status == "failed":
-                    break
-                elif status != "validating":
-                    break
-            if batch_id == batch.id:
-                break
+        print(f"batch {batch_file} ended with status {batch.status} before it started, resending")
+
+    if batch_id is None:
+        log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch.id, file_id=None, status="failed", job_id=job_id)
+        return
     
-    await_batch_request(api_key, batch_file, input_data, response_key, data_key, output_file, batch_id)
+    await_batch_request(api_key, batch_file, input_data, response_key, data_key, output_file, batch_id, job_id=job_id)
 
-def await_batch_request(api_key: str, batch_file: str, input_data: dict, response_key: str, data_key: str, output_file: str, batch_id: str) -> None:
-    log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch_id, file_id=None, status="in_progress")
+def await_batch_request(api_key: str, batch_file: str, input_data: dict, response_key: str, data_key: str, output_file: str, batch_id: str, job_id: int=None,
+                        max_retries: int=2) -> None:
+    log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch_id, file_id=None, status="in_progress", job_id=job_id)
 
     print("request successfully sent, waiting for completion...")
-    file_id = None
-    while True:
-        batch = check_request(api_key, batch_id)
-        print(f"current status: {batch.status}")
-        if batch.status == "completed":
-            file_id = batch.output_file_id
-            break
-        time.sleep(60)
+    batch = wait_for_batch(api_key, batch_id)
+    if batch.status not in ("completed", "expired", "cancelled"):
+        print(f"batch {batch_file} ended with status {batch.status}")
+        log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch_id, file_id=None, status="failed", job_id=job_id)
+        return
+
+    if batch.status == "completed":
+        retrieve_batch_request(api_key, batch_file, input_data, response_key, data_key, output_file, batch_id, batch.output_file_id, job_id=job_id)
+        return
 
-    retrieve_batch_request(api_key, batch_file, input_data, response_key, data_key, output_file, batch_id, file_id)
+    # Expired and cancelled batches still have the output of the requests that finished, and the rest is sent again.
+    merged_keys = set()
+    failed_ids = retrieve_batch_request(api_key, batch_file, input_data, response_key, data_key, output_file, batch_id, batch.output_file_id, job_id=job_id,
+                                        error_file_id=batch.error_file_id, merged_keys=merged_keys)
+    retry_file = make_retry_batch(batch_file, failed_ids | get_missing_ids(batch_file, batch, merged_keys), max_retries)
+    if retry_file:
+        log_batch_request([retry_file], job_id=job_id)
+        send_batch_request(api_key, retry_file, input_data, response_key, data_key, output_file, job_id=job_id)
 
-def retrieve_batch_request(api_key: str, batch_file: str, input_data: dict, response_key: str, data_key: str, output_file: str, batch_id: str, file_id: str) -> None:
-    log_response_history(action="retrieving_batch_request",batch_file=batch_file, batch_id=batch_id, file_id=file_id, status="starting")
+def get_missing_ids(batch_file: str, batch, merged_keys: set) -> set:
+    # An expired or cancelled batch only has the requests that finished in its output, the rest of the batch file still has to be answered.
+    if batch.status == "completed":
+        return set()
+    return read_custom_ids(batch_file) - merged_keys
 
-    print(f"batch {batch_file} completed, writing to file")
-    response_text = retrieve_requests(api_key, file_id)
+def retrieve_batch_request(api_key: str, batch_file: str, input_data: dict, response_key: str, data_key: str, output_file: str, batch_id: str, file_id: str,
+                           job_id: int=None, merger: ResultMerger=None, spool: bool=False, cache: ResponseCache=None, error_file_id: str=None,
+                           merged_keys: set=None, schema: dict=None, validation: Counter=None) -> set:
+    log_response_history(action="retrieving_batch_request",batch_file=batch_file, batch_id=batch_id, file_id=file_id, status="starting", job_id=job_id)
 
-    parsed_outputs = parse_response(response_text)
+    print(f"batch {batch_file} finished, writing to file")
+    # The output is parsed line by line as it downloads and fed straight into the merge.
+    spool_file = get_spool_file(batch_file, file_id) if spool else None
+    failed_ids = set()
+    if file_id or (spool_file and os.path.exists(spool_file)):
+        messages = iter_response_messages(timed_iter("download", stream_requests(api_key, file_id, spool_file)), failed=failed_ids)
+    else:
+        messages = iter([])
+    batch_validation = Counter()
+    if schema is not None:
+        # Responses are checked against the schema of the step before they are cached, so a response that does not fit is never cached.
+        outputs = timed_iter("validate", iter_structured_outputs(timed_iter("parse", messages), schema, failed=failed_ids, counts=batch_validation))
+        if cache is not None:
+            outputs = timed_iter("cache", cache_batch_responses(cache, batch_file, outputs))
+        parsed_outputs = ((custom_id, value) for custom_id, _, value in outputs)
+    else:
+        if cache is not None:
+            messages = timed_iter("cache", cache_batch_responses(cache, batch_file, messages))
+        parsed_outputs = timed_iter("parse", ((custom_id, parse_message(message)) for custom_id, message in messages))
 
-    original_data = input_data
-    if 'question' in response_key or 'answer' in response_key:
-        output_data = handle_qna(original_data, parsed_outputs, response_key, data_key)
+    if merger is None:
+        # Called on its own, so the output is written straight away instead of at the end of the run.
+        merger = ResultMerger(input_data, data_key, output_file)
+        merger.apply(parsed_outputs, response_key, batch_file, merged_keys)
+        merger.compact()
     else:
-        output_data = handle_captions(original_data, parsed_outputs, response_key, data_key)
+        merger.apply(parsed_outputs, response_key, batch_file, merged_keys)
+
+    if schema is not None:
+        print(f"responses in {batch_file}: {format_validation_counts(batch_validation)}")
+        if validation is not None:
+            validation.update(batch_validation)
+    if error_file_id:
+        failed_ids.update(iter_error_ids(timed_iter("download", stream_requests(api_key, error_file_id))))
+    if failed_ids:
+        print(f"{len(failed_ids)} requests in {batch_file} failed or came back empty")
+        count("rows", len(failed_ids), kind="failed")
+    log_response_history(action="retrieving_batch_request",batch_file=batch_file, batch_id=batch_id, file_id=file_id, status="completed", job_id=job_id)
+    return failed_ids
+
+def run_batch_requests(api_key: Union[str, List[Dict]], batches: list, input_data: dict, response_key: str, data_key: str, output_file: str,
+                       max_in_flight: int=4, max_enqueued_tokens: int=None, in_flight: dict=None, batch_tokens: dict=None, job_id: int=None,
+                       to_retrieve: dict=None, resume: bool=False, spool: bool=False, cache: ResponseCache=None, cached_outputs: dict=None,
+                       max_retries: int=2, sync_threshold: int=0, sync_workers: int=16, batch_keys: dict=None, schema: dict=None,
+                       uploads: dict=None, stall_timeout: float=None, stall_split: int=2, limits: SharedLimits=None) -> None:
+    # api_key is a single key or a list of keys from get_api_keys. batch_keys holds the key that each batch in in_flight and to_retrieve
+    # was sent with, since a batch and its files can only be read with the key of the project that owns it.
+    # limits are the in-flight and token limits shared with the other jobs when the job is run by the job server.
+    merger = ResultMerger(input_data, data_key, output_file)
+    validation = Counter()
+    if resume:
+        merger.replay()
+    else:
+        merger.discard()
+    if cached_outputs:
+        merger.apply(((custom_id, parse_message(message)) for custom_id, message in cached_outputs.items()), response_key, "response_cache")
+
+    def on_submitted(batch_file: str, batch_id: str, owner: str) -> None:
+        log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch_id, file_id=None, status="in_progress", job_id=job_id,
+                             api_key=owner)
 
-    with open(output_file, 'w') as f:
-        json.dump(output_data, f, indent=4)
-    log_response_history(action="retrieving_batch_request",batch_file=batch_file, batch_id=batch_id, file_id=file_id, status="completed")
+    def on_completed(batch_file: str, batch, owner: str) -> None:
+        # Batches that were sent directly already have their output on disk in the spool file.
+        merged_keys = set()
+        failed_ids = retrieve_batch_request(owner, batch_file, input_data, response_key, data_key, output_file, batch.id, batch.output_file_id,
+                                            job_id=job_id, merger=merger, spool=spool or getattr(batch, "is_local", False), cache=cache,
+                                            error_file_id=batch.error_file_id, merged_keys=merged_keys, schema=schema, validation=validation)
+        failed_ids.update(get_missing_ids(batch_file, batch, merged_keys))
+        # Only the rows that failed are sent again, as a smaller batch of their own.
+        retry_file = make_retry_batch(batch_file, failed_ids, max_retries)
+        if retry_file:
+            log_batch_request(scheduler.add_retry(batch_file, retry_file), job_id=job_id)
 
-def make_and_send_batch_request(input_file: str, step: str, response_key: str=None, output_file: str=None, config_path: str='batch_requests/config/gpt_captioning_config.yaml', data_key: str="image_path"):
-    with open(config_path, 'r') as file:
-        config_data = yaml.safe_load(file)
+    def on_failed(batch_file: str, batch, owner: str) -> None:
+        print(f"batch {batch_file} ended with status {batch.status}, skipping")
+        log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch.id, file_id=None, status="failed", job_id=job_id)
 
-    with open(input_file, 'r') as f:
-        input_data = json.load(f)
+    scheduler = BatchScheduler(api_key,
+                               on_submitted=on_submitted,
+                               on_completed=on_completed,
+                               on_failed=on_failed,
+                               max_in_flight=max_in_flight,
+                               max_enqueued_tokens=max_enqueued_tokens,
+                               sync_threshold=sync_threshold,
+                               sync_workers=sync_workers,
+                               uploads=uploads,
+                               stall_timeout=stall_timeout,
+                               stall_split=stall_split,
+                               limits=limits,
+                               max_retries=max_retries
+                              )
+    batch_keys = batch_keys or {}
+    for batch_file, batch_id in (to_retrieve or {}).items():
+        owner = batch_keys.get(batch_file) or scheduler.api_key
+        on_completed(batch_file, check_request(owner, batch_id), owner)
+    for batch_file, batch_id in (in_flight or {}).items():
+        scheduler.add(batch_file, batch_id=batch_id, api_key=batch_keys.get(batch_file))
+    for batch_file in batches:
+        scheduler.add(batch_file, tokens=(batch_tokens or {}).get(batch_file))
+
+    log_batch_request(batches, job_id=job_id, tokens=batch_tokens)
+    scheduler.run()
+    merger.compact()
+    if schema is not None:
+        print(f"responses for {response_key}: {format_validation_counts(validation)}")
+    if job_id is not None:
+        log_job_status(job_id, "completed")
+
+def make_and_send_batch_request(input_file: str, step: str, response_key: str=None, output_file: str=None, config_path: str='batch_requests/config/gpt_captioning_config.yaml', data_key: str="image_path",
+                                max_in_flight: int=None, max_enqueued_tokens: int=None, pack: bool=False, limits: SharedLimits=None, batch_dir: str=None,
+                                options: dict=None, record_metrics: bool=True):
+    # The job server runs several jobs in one process, so it passes its shared limits and a directory of the job's own for the batch files,
+    # and records the metrics of all of them together instead of each job starting its own.
+    config_data = load_config(config_path)
+    if batch_dir:
+        config_data = {**config_data, "job_dir": batch_dir}
+    metrics = enable_metrics(config_data, step=step, input_file=input_file) if record_metrics else None
+    try:
+        send_step(config_data, input_file, step, response_key, output_file, data_key, max_in_flight, max_enqueued_tokens, pack, limits, batch_dir, options)
+    finally:
+        # Written even when the run stops partway, since that is when it matters most where the time went.
+        write_metrics(metrics)
+
+def send_step(config_data: dict, input_file: str, step: str, response_key: str=None, output_file: str=None, data_key: str="image_path",
+              max_in_flight: int=None, max_enqueued_tokens: int=None, pack: bool=False, limits: SharedLimits=None, batch_dir: str=None,
+              options: dict=None) -> None:
+    # batch_dir defaults to the directory of the input file. options are kept with the job on top of the ones it needs for recovery.
+    batch_dir = batch_dir or os.path.dirname(input_file)
+    with span("load"):
+        input_data = load_dataset(input_file, data_key)
 
     response_key = response_key or config_data.get(step, {}).get("response_key", "")
     if not response_key:
         raise ValueError("Response key has to be in either the config or passed as an input parameter")
 
-    requests_data = make_requests(config_data=config_data, step=step, input_data=input_data, input_key=data_key)
-    batches = split_jsonl_list(input_list=requests_data, input_path=os.path.dirname(input_file), step=step)
+    cache = get_response_cache(config_data)
+    cached_outputs = {}
+    request_lines = make_request_lines(config_data=config_data, step=step, input_data=input_data, input_key=data_key, cache=cache, cached_outputs=cached_outputs,
+                                       processes=config_data.get("maker_processes", 1))
+
+    # With several keys the job keeps the first one as its api_key, and the whole list under its options for recovery.
+    api_keys = get_api_keys(config_data)
+    api_key = api_keys[0]["key"] if isinstance(api_keys, list) else api_keys
+    max_in_flight = max_in_flight or config_data.get("max_in_flight", 4)
+    max_enqueued_tokens = max_enqueued_tokens or config_data.get("max_enqueued_tokens")
+
+    # Batch files are kept under the enqueued token limit, since a batch over it would fail validation every time.
+    packing_limits = dict(get_packing_limits(config_data, step), max_tokens=get_batch_token_cap(config_data, step, max_enqueued_tokens, api_keys))
+    if pack or config_data.get("pack_batches", False):
+        batches, stats = pack_jsonl_lines(lines=request_lines, input_path=batch_dir, step=step, **packing_limits)
+    else:
+        request_lines = list(request_lines)
+        tokens = [tokens for _, tokens in request_lines]
+        # Checked before anything is written, since packing into fewer files would leave the extra split files behind.
+        max_tokens = packing_limits["max_tokens"]
+        if max_tokens and any(sum(tokens[start:end]) > max_tokens for start, end in get_split_ranges(len(tokens))):
+            print(f"some batch files would be over {max_tokens} estimated tokens, packing them instead")
+            batches, stats = pack_jsonl_lines(lines=iter(request_lines), input_path=batch_dir, step=step, **packing_limits)
+        else:
+            stats = []
+            batches = split_jsonl_lines(lines=[line for line, _ in request_lines], input_path=batch_dir, step=step, tokens=tokens, stats=stats)
+    batch_tokens = {stat["batch_file"]: stat["tokens"] for stat in stats}
+
+    # Nothing has been uploaded yet, so a step that is over its budget stops here.
+    budget = get_budget(config_data, step)
+    report = make_budget_report(step, stats, budget)
+    print_budget_report(report, budget)
+    check_budget(report, budget)
 
     if output_file == None:
         output_file = input_file
 
-    api_key = config_data.get('api_key')
-    create_log_files(api_key, input_file, response_key, data_key, output_file)
-
-    while batches:
-        log_batch_request(batches)
-        batch = batches.pop(0)
-        send_batch_request(api_key=api_key, 
-                                         batch_file=batch,
-                                         input_data=input_data,
-                                         response_key=response_key,
-                                         data_key=data_key,
-                                         output_file=output_file
-                                        )
+    spool = config_data.get("spool_outputs", False)
+    max_retries = config_data.get("max_retries", 2)
+    sync_threshold = config_data.get("sync_threshold", 0)
+    sync_workers = config_data.get("sync_workers", 16)
+    schema = get_response_schema(config_data, step)
+    uploads = get_upload_settings(config_data)
+    stall_timeout = config_data.get("stall_timeout")
+    stall_split = config_data.get("stall_split", 2)
+    job_id = create_log_files(api_key, input_file, response_key, data_key, output_file, max_in_flight, max_enqueued_tokens, step=step,
+                              options={"spool": spool, "response_cache": config_data.get("response_cache"), "max_retries": max_retries,
+                                       "sync_threshold": sync_threshold, "sync_workers": sync_workers,
+                                       "api_keys": api_keys if isinstance(api_keys, list) else None, "response_schema": schema,
+                                       "metrics": config_data.get("metrics"), "uploads": uploads,
+                                       "stall_timeout": stall_timeout, "stall_split": stall_split, **(options or {})})
 
+    run_batch_requests(api_key=api_keys,
+                       batches=batches,
+                       input_data=input_data,
+                       response_key=response_key,
+                       data_key=data_key,
+                       output_file=output_file,
+                       max_in_flight=max_in_flight,
+                       max_enqueued_tokens=max_enqueued_tokens,
+                       batch_tokens=batch_tokens,
+                       job_id=job_id,
+                       spool=spool,
+                       cache=cache,
+                       cached_outputs=cached_outputs,
+                       max_retries=max_retries,
+                       sync_threshold=sync_threshold,
+                       sync_workers=sync_workers,
+                       schema=schema,
+                       uploads=uploads,
+                       stall_timeout=stall_timeout,
+                       stall_split=stall_split,
+                       limits=limits
+                      )
         
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process batch requests")
@@ -127,8 +306,12 @@ if __name__ == "__main__":
     parser.add_argument("--response_key", '-r', type=str, required=False, help="Response key to use")
     parser.add_argument("--config", '-c', type=str, required=True, help="Path to the config file")
     parser.add_argument("--data_key", "-d", type=str, required=False, help="The key used to identify each data point")
+    parser.add_argument("--max_in_flight", "-n", type=int, required=False, help="Maximum number of batches to have running at once")
+    parser.add_argument("--max_enqueued_tokens", "-t", type=int, required=False, help="Maximum number of estimated tokens to have enqueued at once")
+    parser.add_argument("--pack", "-p", action="store_true", help="Fill each batch file up to the size, request and token limits instead of splitting every 1000 requests")
     args = parser.parse_args()
 
     if not args.data_key:
         args.data_key = "image_path"
-    make_and_send_batch_request(args.input_file, args.step, args.response_key, args.output_file, args.config, args.data_key)
+    make_and_send_batch_request(args.input_file, args.step, args.response_key, args.output_file, args.config, args.data_key,
+                                args.max_in_flight, args.max_enqueued_tokens, args.pack)
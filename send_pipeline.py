@@ -0,0 +1,292 @@
+import json
+import argparse
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Union
+
+from batch_requests.batch_request_budget import check_budget, get_batch_token_cap, get_budget, make_budget_report, print_budget_report
+from batch_requests.batch_request_cache import get_response_cache
+from batch_requests.batch_request_checker import check_request
+from batch_requests.batch_request_config import load_config
+from batch_requests.batch_request_dataset import load_dataset
+from batch_requests.batch_request_logger import create_log_files, log_batch_request, log_response_history, log_job_status
+from batch_requests.batch_request_maker import make_request_lines
+from batch_requests.batch_request_merger import ResultMerger
+from batch_requests.batch_request_metrics import enable_metrics, span, write_metrics
+from batch_requests.batch_request_retriever import parse_message
+from batch_requests.batch_request_scheduler import BatchScheduler, SharedLimits, get_api_keys
+from batch_requests.batch_request_schema import get_response_schema, format_validation_counts
+from batch_requests.batch_request_sender import get_upload_settings
+from batch_requests.batch_request_splitter import pack_jsonl_lines, get_packing_limits, get_batch_number, get_last_batch_number, make_retry_batch, read_custom_ids
+from batch_requests.batch_request_store import DEFAULT_DB, get_store
+from batch_requests.batch_request_sync import SYNC_PREFIX
+from send_batch_request import get_missing_ids, retrieve_batch_request
+
+def load_pipeline(config_data: dict, pipeline_key: str="pipeline") -> Dict[str, List[str]]:
+    # Returns the steps of the pipeline in an order where every step comes after the steps it depends on, mapped to those steps.
+    pipeline = config_data.get(pipeline_key)
+    if not pipeline:
+        raise ValueError(f"{pipeline_key} is not in the config file")
+
+    graph = {}
+    for step, options in pipeline.items():
+        if step not in config_data:
+            raise ValueError(f"Step {step} in {pipeline_key} has no prompts in the config file")
+        if not config_data[step].get("response_key"):
+            raise ValueError(f"Step {step} in {pipeline_key} needs a response_key in the config file")
+        depends_on = (options or {}).get("depends_on", [])
+        if isinstance(depends_on, str):
+            depends_on = [depends_on]
+        for dependency in depends_on:
+            if dependency not in pipeline:
+                raise ValueError(f"Step {step} depends on {dependency}, which is not in {pipeline_key}")
+        graph[step] = list(depends_on)
+
+    # Results are told apart by their response key when they are replayed, so two steps cannot share one.
+    response_keys = [config_data[step]["response_key"] for step in graph]
+    if len(set(response_keys)) != len(response_keys):
+        raise ValueError(f"Every step in {pipeline_key} needs its own response_key")
+
+    order = []
+    while len(order) < len(graph):
+        ready = [step for step, dependencies in graph.items() if step not in order and all(d in order for d in dependencies)]
+        if not ready:
+            raise ValueError(f"The steps in {pipeline_key} depend on each other in a cycle")
+        order.extend(ready)
+    return {step: graph[step] for step in order}
+
+def run_pipeline(api_key: Union[str, List[Dict]], config_data: dict, pipeline: Dict[str, List[str]], input_data: list, data_key: str, output_file: str,
+                 input_path: str, job_id: int=None, max_in_flight: int=4, max_enqueued_tokens: int=None, batch_files: List[Dict]=None,
+                 limits: SharedLimits=None) -> None:
+    # Runs every step of the pipeline as one job. A record is made into a request for the next step as soon as the batch that
+    # answered it for every step it depends on is merged, so later steps start while earlier ones are still running.
+    # batch_files are the batch files of the job in the store, and are only passed in when the job is being recovered.
+    cache = get_response_cache(config_data)
+    spool = config_data.get("spool_outputs", False)
+    max_retries = config_data.get("max_retries", 2)
+    response_keys = {step: config_data[step]["response_key"] for step in pipeline}
+    schemas = {step: get_response_schema(config_data, step) for step in pipeline}
+    validation = {step: Counter() for step in pipeline}
+    children = {step: [child for child, dependencies in pipeline.items() if step in dependencies] for step in pipeline}
+
+    merger = ResultMerger(input_data, data_key, output_file)
+    done = {step: set() for step in pipeline} # keys that have a merged result for each step
+    sent = {step: set() for step in pipeline} # keys that have been made into requests for each step
+    batch_steps = {}
+    file_counts = {step: 0 for step in pipeline} # highest batch file number taken for each step
+    cache_counts = {step: 0 for step in pipeline} # response cache hits merged for each step, which are labelled apart from the batch files
+    budgets = {step: get_budget(config_data, step) for step in pipeline}
+    step_stats = {step: [] for step in pipeline} # stats of every batch file made for each step, which its budget is checked against
+
+    if batch_files is not None:
+        replayed = {}
+        merger.replay(replayed)
+        for step in pipeline:
+            done[step] = replayed.get(response_keys[step], set())
+        for batch in batch_files:
+            if batch["step"] in pipeline:
+                batch_steps[batch["batch_file"]] = batch["step"]
+                custom_ids = read_custom_ids(batch["batch_file"])
+                sent[batch["step"]].update(custom_ids)
+                # Parts and retries resend requests that are already counted in the batch file they came from.
+                if os.path.basename(batch["batch_file"]) == f"batch_{batch['step']}_{get_batch_number(batch['batch_file'], batch['step'])}.jsonl":
+                    step_stats[batch["step"]].append({"batch_file": batch["batch_file"], "requests": len(custom_ids), "tokens": batch["tokens"] or 0})
+        for step in pipeline:
+            # Numbered after every batch file the step already has, in the store or on disk, so that none of them is written over
+            # and then skipped by the merger as already merged.
+            file_counts[step] = get_last_batch_number(input_path, step, [batch["batch_file"] for batch in batch_files if batch["step"] == step])
+            cache_labels = [re.fullmatch(rf"response_cache_{re.escape(step)}_(\d+)", label) for label in merger.merged_batches]
+            cache_counts[step] = max((int(match.group(1)) for match in cache_labels if match), default=0)
+    else:
+        merger.discard()
+
+    def submit(step: str, keys: List) -> None:
+        keys = [key for key in keys if key not in sent[step] and key not in done[step]]
+        if not keys:
+            return
+        sent[step].update(keys)
+
+        cached_outputs = {}
+        records = [item for key in keys for item in merger.index.get(key, [])]
+        request_lines = make_request_lines(config_data=config_data, step=step, input_data=records, input_key=data_key, cache=cache, cached_outputs=cached_outputs)
+        batches, stats = pack_jsonl_lines(lines=request_lines, input_path=input_path, step=step, start=file_counts[step] + 1,
+                                          **dict(get_packing_limits(config_data, step),
+                                                 max_tokens=get_batch_token_cap(config_data, step, max_enqueued_tokens, api_key)))
+        file_counts[step] += len(batches)
+        batch_tokens = {stat["batch_file"]: stat["tokens"] for stat in stats}
+
+        # The budget covers every batch file of the step so far, and a step that goes over it stops the job before these are uploaded.
+        if batches:
+            step_stats[step].extend(stats)
+            report = make_budget_report(step, step_stats[step], budgets[step])
+            print_budget_report(report, budgets[step])
+            check_budget(report, budgets[step])
+        if batches:
+            log_batch_request(batches, job_id=job_id, tokens=batch_tokens, step=step)
+        for batch_file in batches:
+            batch_steps[batch_file] = step
+            scheduler.add(batch_file, tokens=batch_tokens[batch_file])
+
+        # The requests are only looked up in the cache as they are written, so the hits are merged after the batch files are made.
+        if cached_outputs:
+            merged_keys = set()
+            cache_counts[step] += 1
+            merger.apply(((custom_id, parse_message(message)) for custom_id, message in cached_outputs.items()), response_keys[step],
+                         f"response_cache_{step}_{cache_counts[step]}", merged_keys)
+            advance(step, merged_keys)
+
+    def advance(step: str, keys: set) -> None:
+        done[step].update(keys)
+        for child in children[step]:
+            submit(child, [key for key in keys if all(key in done[dependency] for dependency in pipeline[child])])
+
+    def on_submitted(batch_file: str, batch_id: str, owner: str) -> None:
+        log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch_id, file_id=None, status="in_progress", job_id=job_id,
+                             api_key=owner)
+
+    def on_completed(batch_file: str, batch, owner: str) -> None:
+        step = batch_steps[batch_file]
+        merged_keys = set()
+        failed_ids = retrieve_batch_request(owner, batch_file, input_data, response_keys[step], data_key, output_file, batch.id, batch.output_file_id,
+                                            job_id=job_id, merger=merger, spool=spool or getattr(batch, "is_local", False), cache=cache,
+                                            error_file_id=batch.error_file_id, merged_keys=merged_keys, schema=schemas[step],
+                                            validation=validation[step])
+        failed_ids.update(get_missing_ids(batch_file, batch, merged_keys))
+        retry_file = make_retry_batch(batch_file, failed_ids, max_retries)
+        if retry_file:
+            retry_files = scheduler.add_retry(batch_file, retry_file)
+            for retry in retry_files:
+                batch_steps[retry] = step
+            log_batch_request(retry_files, job_id=job_id, step=step)
+        advance(step, merged_keys)
+
+    def on_failed(batch_file: str, batch, owner: str) -> None:
+        print(f"batch {batch_file} ended with status {batch.status}, skipping")
+        log_response_history(action="send_batch_request", batch_file=batch_file, batch_id=batch.id, file_id=None, status="failed", job_id=job_id)
+
+    scheduler = BatchScheduler(api_key,
+                               on_submitted=on_submitted,
+                               on_completed=on_completed,
+                               on_failed=on_failed,
+                               max_in_flight=max_in_flight,
+                               max_enqueued_tokens=max_enqueued_tokens,
+                               sync_threshold=config_data.get("sync_threshold", 0),
+                               sync_workers=config_data.get("sync_workers", 16),
+                               uploads=get_upload_settings(config_data),
+                               stall_timeout=config_data.get("stall_timeout"),
+                               stall_split=config_data.get("stall_split", 2),
+                               limits=limits,
+                               max_retries=max_retries
+                              )
+
+    # Batch files that were left unfinished are picked up the same way as in recover_batch_requests.py.
+    for batch in batch_files or []:
+        batch_file = batch["batch_file"]
+        if batch_file not in batch_steps or batch["status"] == "completed":
+            continue
+        is_sync = (batch["batch_id"] or "").startswith(SYNC_PREFIX)
+        owner = batch["api_key"] or scheduler.api_key
+        if batch["status"] == "in_progress" and not is_sync:
+            scheduler.add(batch_file, batch_id=batch["batch_id"], api_key=owner)
+        elif batch["status"] == "retrieving" and not is_sync:
+            on_completed(batch_file, check_request(owner, batch["batch_id"]), owner)
+        else:
+            scheduler.add(batch_file, tokens=batch["tokens"])
+
+    # Every record that is ready for a step and has not been sent for it yet. On a fresh run this is every record for the first steps.
+    for step, dependencies in pipeline.items():
+        submit(step, [key for key in merger.index.keys() if key is not None and all(key in done[dependency] for dependency in dependencies)])
+
+    scheduler.run()
+    merger.compact()
+    for step in pipeline:
+        print(f"{step}: {len(done[step])} records answered")
+        if schemas[step] is not None:
+            print(f"{step} responses: {format_validation_counts(validation[step])}")
+    if job_id is not None:
+        log_job_status(job_id, "completed")
+
+def recover_pipeline(job: dict, db_path: str=DEFAULT_DB, limits: SharedLimits=None, record_metrics: bool=True) -> None:
+    config_data = load_config(job["options"]["config_path"])
+    if job["options"].get("batch_dir"):
+        config_data = {**config_data, "job_dir": job["options"]["batch_dir"]}
+    metrics = enable_metrics(config_data, pipeline=job["options"]["pipeline"], input_file=job["input_file"], job_id=job["job_id"]) if record_metrics else None
+
+    with span("load"):
+        input_data = load_dataset(job["input_file"], job["data_key"])
+
+    try:
+        run_pipeline(api_key=job["options"].get("api_keys") or job["api_key"],
+                     config_data=config_data,
+                     pipeline=load_pipeline(config_data, job["options"]["pipeline"]),
+                     input_data=input_data,
+                     data_key=job["data_key"],
+                     output_file=job["output_file"],
+                     input_path=job["options"].get("batch_dir") or os.path.dirname(job["input_file"]),
+                     job_id=job["job_id"],
+                     max_in_flight=job["max_in_flight"] or 4,
+                     max_enqueued_tokens=job["max_enqueued_tokens"],
+                     batch_files=get_store(db_path).get_batch_files(job["job_id"]),
+                     limits=limits
+                    )
+    finally:
+        write_metrics(metrics)
+
+def make_and_send_pipeline(input_file: str, output_file: str=None, config_path: str='batch_requests/config/gpt_captioning_config.yaml', data_key: str="image_path",
+                           pipeline_key: str="pipeline", max_in_flight: int=None, max_enqueued_tokens: int=None, limits: SharedLimits=None,
+                           batch_dir: str=None, options: dict=None, record_metrics: bool=True) -> None:
+    # limits, batch_dir, options and record_metrics are for the job server, the same as in make_and_send_batch_request.
+    config_data = load_config(config_path)
+    if batch_dir:
+        config_data = {**config_data, "job_dir": batch_dir}
+    metrics = enable_metrics(config_data, pipeline=pipeline_key, input_file=input_file) if record_metrics else None
+
+    with span("load"):
+        input_data = load_dataset(input_file, data_key)
+
+    pipeline = load_pipeline(config_data, pipeline_key)
+    print(f"running {' -> '.join(pipeline)}")
+
+    if output_file == None:
+        output_file = input_file
+
+    api_keys = get_api_keys(config_data)
+    api_key = api_keys[0]["key"] if isinstance(api_keys, list) else api_keys
+    max_in_flight = max_in_flight or config_data.get("max_in_flight", 4)
+    max_enqueued_tokens = max_enqueued_tokens or config_data.get("max_enqueued_tokens")
+    # The config is read again on recovery, since each step needs its prompts to make requests for the records that become ready.
+    job_id = create_log_files(api_key, input_file, None, data_key, output_file, max_in_flight, max_enqueued_tokens, step=pipeline_key,
+                              options={"pipeline": pipeline_key, "config_path": os.path.abspath(config_path),
+                                       "api_keys": api_keys if isinstance(api_keys, list) else None, "batch_dir": batch_dir, **(options or {})})
+
+    try:
+        run_pipeline(api_key=api_keys,
+                     config_data=config_data,
+                     pipeline=pipeline,
+                     input_data=input_data,
+                     data_key=data_key,
+                     output_file=output_file,
+                     input_path=batch_dir or os.path.dirname(input_file),
+                     job_id=job_id,
+                     max_in_flight=max_in_flight,
+                     max_enqueued_tokens=max_enqueued_tokens,
+                     limits=limits
+                    )
+    finally:
+        write_metrics(metrics)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several steps over a dataset as one pipeline")
+    parser.add_argument("--input_file", '-i', type=str, required=True, help="Path to the input file")
+    parser.add_argument("--output_file", '-o', type=str, required=False, help="Path to the output file")
+    parser.add_argument("--config", '-c', type=str, required=True, help="Path to the config file")
+    parser.add_argument("--data_key", "-d", type=str, required=False, help="The key used to identify each data point")
+    parser.add_argument("--pipeline", "-p", type=str, required=False, default="pipeline", help="Key of the step graph in the config file")
+    parser.add_argument("--max_in_flight", "-n", type=int, required=False, help="Maximum number of batches to have running at once")
+    parser.add_argument("--max_enqueued_tokens", "-t", type=int, required=False, help="Maximum number of estimated tokens to have enqueued at once")
+    args = parser.parse_args()
+
+    if not args.data_key:
+        args.data_key = "image_path"
+    make_and_send_pipeline(args.input_file, args.output_file, args.config, args.data_key, args.pipeline, args.max_in_flight, args.max_enqueued_tokens)
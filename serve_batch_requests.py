@@ -0,0 +1,296 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import traceback
+from typing import Dict, List
+
+from batch_requests.batch_request_config import load_config
+from batch_requests.batch_request_metrics import enable_metrics, write_metrics
+from batch_requests.batch_request_scheduler import SharedLimits, get_api_keys
+from batch_requests.batch_request_store import get_store
+
+# Runs jobs from a local queue in one process, so that several datasets can be sent at once without each job fighting the others
+# for the same quota. Every job keeps its own state in the job store and its own directory for its batch files, and all of their
+# batches are held together to the in-flight and token limits of the server config, which are shared out fairly between the jobs.
+#
+# Jobs are submitted over a unix socket with submit_job, or straight into the queue file when the server is not running, in which
+# case they start once it is. Jobs that were running when the server stopped are recovered the next time it starts.
+
+SERVER_DEFAULTS = {
+    "socket": "batch_server.sock",
+    "queue": "job_queue.db",
+    "work_dir": "server_jobs", # each job writes its batch files into a directory of its own under this one
+    "max_jobs": 4, # jobs that are made into requests and sent at once, the rest wait in the queue
+}
+QUEUE_POLL = 5.0 # how often the queue file is read for jobs that were added without going through the socket
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    job_id INTEGER,
+    error TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS queue_status ON queue (status);
+"""
+
+def get_server_settings(config_data: dict) -> dict:
+    # server: {socket, queue, work_dir, max_jobs} in the config. The limits of the server are the usual api_key or api_keys,
+    # max_in_flight and max_enqueued_tokens of the same config.
+    settings = config_data.get("server") or {}
+    if not isinstance(settings, dict):
+        raise ValueError("server in the config has to be a mapping of socket, queue, work_dir and max_jobs")
+    return {**SERVER_DEFAULTS, **settings}
+
+def make_job_request(input_file: str, config_path: str, step: str=None, pipeline: str=None, output_file: str=None, response_key: str=None,
+                     data_key: str="image_path", max_in_flight: int=None, max_enqueued_tokens: int=None, pack: bool=False) -> dict:
+    # Paths are made absolute, since the server does not have to run from the same directory as whoever submits the job.
+    if bool(step) == bool(pipeline):
+        raise ValueError("A job needs either a step or a pipeline")
+    if not os.path.exists(input_file):
+        raise ValueError(f"{input_file} does not exist")
+    return {
+        "input_file": os.path.abspath(input_file),
+        "output_file": os.path.abspath(output_file or input_file),
+        "config_path": os.path.abspath(config_path),
+        "step": step,
+        "pipeline": pipeline,
+        "response_key": response_key,
+        "data_key": data_key or "image_path",
+        "max_in_flight": max_in_flight,
+        "max_enqueued_tokens": max_enqueued_tokens,
+        "pack": pack
+    }
+
+class JobQueue:
+    def __init__(self, db_path: str=SERVER_DEFAULTS["queue"]):
+        self.db_path = os.path.abspath(db_path)
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def add(self, request: dict) -> int:
+        # Two jobs that write the same output file would overwrite each other's results, so the second one is turned away
+        # until the first is done.
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for job in self.list(["queued", "running"]):
+                if job["request"]["output_file"] == request["output_file"]:
+                    raise ValueError(f"Job {job['queue_id']} is already {job['status']} for {request['output_file']}")
+            queue_id = conn.execute("INSERT INTO queue (request, submitted_at) VALUES (?, ?)", (json.dumps(request), time.time())).lastrowid
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return queue_id
+
+    def list(self, statuses: List[str]=None, limit: int=None) -> List[Dict]:
+        query = "SELECT * FROM queue"
+        params = []
+        if statuses:
+            query += f" WHERE status IN ({', '.join('?' * len(statuses))})"
+            params.extend(statuses)
+        if limit:
+            # The most recent ones, still listed oldest first.
+            query = f"SELECT * FROM ({query} ORDER BY queue_id DESC LIMIT ?)"
+            params.append(limit)
+        jobs = [dict(row) for row in self.connection().execute(query + " ORDER BY queue_id", params)]
+        for job in jobs:
+            job["request"] = json.loads(job["request"])
+        return jobs
+
+    def set_status(self, queue_id: int, status: str, job_id: int=None, error: str=None) -> None:
+        now = time.time()
+        self.connection().execute("""UPDATE queue SET status = ?, job_id = COALESCE(?, job_id), error = ?,
+                                     started_at = CASE WHEN ? = 'running' THEN COALESCE(started_at, ?) ELSE started_at END,
+                                     finished_at = CASE WHEN ? IN ('completed', 'failed') THEN ? ELSE NULL END
+                                     WHERE queue_id = ?""", (status, job_id, error, status, now, status, now, queue_id))
+
+def find_stored_job(queue: JobQueue, queue_id: int) -> Dict:
+    # The job in the store that the server started for queue_id, which it tags with the queue it came from.
+    return get_store().find_job({"queue": queue.db_path, "queue_id": queue_id})
+
+class JobServer:
+    def __init__(self, config_data: dict):
+        self.config_data = config_data
+        self.settings = get_server_settings(config_data)
+        self.queue = JobQueue(self.settings["queue"])
+        self.work_dir = os.path.abspath(self.settings["work_dir"])
+        self.limits = SharedLimits(config_data.get("max_in_flight", 4), config_data.get("max_enqueued_tokens"), get_api_keys(config_data))
+        self.threads: Dict[int, threading.Thread] = {} # queue_id -> thread running the job
+        self.wakeup = threading.Event()
+
+    def submit(self, request: dict) -> int:
+        queue_id = self.queue.add(request)
+        print(f"job {queue_id} queued: {request['step'] or 'pipeline ' + request['pipeline']} on {request['input_file']}")
+        self.wakeup.set()
+        return queue_id
+
+    def start(self, job: dict, job_id: int=None) -> None:
+        self.queue.set_status(job["queue_id"], "running", job_id=job_id)
+        thread = threading.Thread(target=self.run_job, args=(job["queue_id"], job["request"], job_id), name=f"job {job['queue_id']}", daemon=True)
+        self.threads[job["queue_id"]] = thread
+        thread.start()
+
+    def start_jobs(self) -> None:
+        for queue_id, thread in list(self.threads.items()):
+            if not thread.is_alive():
+                del self.threads[queue_id]
+        free = self.settings["max_jobs"] - len(self.threads)
+        for job in self.queue.list(["queued"])[:max(0, free)]:
+            self.start(job)
+
+    def run_job(self, queue_id: int, request: dict, job_id: int=None) -> None:
+        # Imported here so that submitting a job does not load everything that running one needs.
+        from recover_batch_requests import recover_job
+        from send_batch_request import make_and_send_batch_request
+        from send_pipeline import make_and_send_pipeline
+
+        batch_dir = os.path.join(self.work_dir, f"job_{queue_id}")
+        os.makedirs(batch_dir, exist_ok=True)
+        options = {"queue": self.queue.db_path, "queue_id": queue_id}
+        print(f"starting job {queue_id}")
+        try:
+            if job_id is not None:
+                recover_job(job_id, limits=self.limits, record_metrics=False)
+            elif request["pipeline"]:
+                make_and_send_pipeline(request["input_file"], request["output_file"], request["config_path"], request["data_key"], request["pipeline"],
+                                       request["max_in_flight"], request["max_enqueued_tokens"], limits=self.limits, batch_dir=batch_dir, options=options,
+                                       record_metrics=False)
+            else:
+                make_and_send_batch_request(request["input_file"], request["step"], request["response_key"], request["output_file"], request["config_path"],
+                                            request["data_key"], request["max_in_flight"], request["max_enqueued_tokens"], request["pack"],
+                                            limits=self.limits, batch_dir=batch_dir, options=options, record_metrics=False)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"job {queue_id} failed ({e})")
+            self.queue.set_status(queue_id, "failed", error=str(e))
+        else:
+            stored = find_stored_job(self.queue, queue_id)
+            print(f"job {queue_id} completed")
+            self.queue.set_status(queue_id, "completed", job_id=stored["job_id"] if stored else None)
+        finally:
+            self.wakeup.set()
+
+    def recover(self) -> None:
+        # Jobs that were running when the server last stopped pick up where they were, and the ones that never got as far as
+        # creating their job in the store start over.
+        for job in self.queue.list(["running"]):
+            stored = find_stored_job(self.queue, job["queue_id"])
+            if stored is None:
+                self.queue.set_status(job["queue_id"], "queued")
+            elif stored["status"] == "completed":
+                self.queue.set_status(job["queue_id"], "completed", job_id=stored["job_id"])
+            else:
+                print(f"recovering job {job['queue_id']}")
+                self.start(job, job_id=stored["job_id"])
+
+    def handle(self, message: dict) -> dict:
+        action = message.get("action")
+        if action == "submit":
+            return {"queue_id": self.submit(make_job_request(**message["job"]))}
+        if action == "jobs":
+            return {"jobs": self.queue.list(limit=message.get("limit")), "limits": self.limits.usage()}
+        raise ValueError(f"Unknown action {action}")
+
+    def serve(self, until_done: bool=False) -> None:
+        # until_done stops the server once nothing is left in the queue, instead of waiting for more jobs.
+        socket_path = self.settings["socket"]
+        if os.path.exists(socket_path):
+            if is_listening(socket_path):
+                raise ValueError(f"A job server is already listening on {socket_path}")
+            os.remove(socket_path)
+        listener = JobSocketServer(socket_path, JobRequestHandler)
+        listener.job_server = self
+        threading.Thread(target=listener.serve_forever, name="job socket", daemon=True).start()
+        metrics = enable_metrics(self.config_data, server=socket_path)
+        print(f"job server listening on {socket_path}, running up to {self.settings['max_jobs']} jobs at once")
+
+        try:
+            self.recover()
+            while True:
+                self.wakeup.clear()
+                self.start_jobs()
+                if until_done and not self.threads and not self.queue.list(["queued"]):
+                    break
+                self.wakeup.wait(QUEUE_POLL)
+        except KeyboardInterrupt:
+            print("stopping, jobs that are still running are recovered the next time the server starts")
+        finally:
+            listener.shutdown()
+            listener.server_close()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            write_metrics(metrics)
+
+class JobSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    # One json message per line, each answered with a line of json that has ok and either the result or the error.
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                reply = {"ok": True, **self.server.job_server.handle(json.loads(line))}
+            except Exception as e:
+                # A bad message only fails its own reply, the server keeps running.
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+def send_message(socket_path: str, message: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(30)
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(message) + "\n").encode())
+        reply = json.loads(conn.makefile().readline())
+    if not reply.get("ok"):
+        raise ValueError(reply.get("error"))
+    return reply
+
+def is_listening(socket_path: str) -> bool:
+    try:
+        send_message(socket_path, {"action": "jobs", "limit": 1})
+    except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+        return False
+    return True
+
+def submit_job(request: dict, socket_path: str=SERVER_DEFAULTS["socket"], queue_path: str=SERVER_DEFAULTS["queue"]) -> int:
+    # request comes from make_job_request. It goes through the server when it is listening, and otherwise is left in the queue file
+    # for when the server starts.
+    try:
+        return send_message(socket_path, {"action": "submit", "job": request})["queue_id"]
+    except (ConnectionRefusedError, FileNotFoundError):
+        queue_id = JobQueue(queue_path).add(request)
+        print(f"no job server is listening on {socket_path}, job {queue_id} will start once it is")
+        return queue_id
+
+def main(config: str, until_done: bool=False) -> None:
+    JobServer(load_config(config)).serve(until_done)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run batch request jobs from a local queue under shared limits")
+    parser.add_argument("--config", "-c", type=str, required=True, help="Path to the config file with the api keys, limits and server settings")
+    parser.add_argument("--until_done", action="store_true", help="Stop once every queued job is done instead of waiting for more")
+    args = parser.parse_args()
+
+    main(args.config, args.until_done)